@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+SAMPLE_BLOCK = 64 * 1024
+SAMPLE_COUNT = 3
+
+
+def fingerprint(path: str, stat: os.stat_result = None, samples=SAMPLE_COUNT, block=SAMPLE_BLOCK,
+                mtime=True) -> str:
+    """Size, mtime and `samples` blocks spread over the file (first and
+    last included). Does not depend on the mountpoint; with mtime=False,
+    neither on copying"""
+    if stat is None:
+        stat = os.stat(path)
+    digest = hashlib.blake2b(f"{stat.st_size}|{stat.st_mtime_ns if mtime else ''}".encode(), digest_size=16)
+    last = max(stat.st_size - block, 0)
+    with open(path, "rb") as video_file:
+        for idx in range(samples):
+            digest.update(os.pread(video_file.fileno(), block, last * idx // max(samples - 1, 1)))
+    return digest.hexdigest()
+
+
+class RecordingCatalog:
+    """Persistent catalog of recording groups seen on cards.
+
+    A group is keyed by its recordings' fingerprints. It is numbered once
+    within its date, so that re-imports keep destinations. A changed group
+    (a known recording with new ones appended) keeps the destination of the
+    group it shares recordings with. Groups are marked done once uploaded.
+    Thread-safe, path=None keeps the catalog in memory.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._recordings = {}  # fingerprint -> group key
+        self._groups = {}  # group key -> {"date", "index", "destination", "done"}
+        self._next_index = {}  # date -> first free index
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        if path:
+            self.load()
+
+    @staticmethod
+    def group_key(fingerprints: List[str]) -> str:
+        return hashlib.blake2b("|".join(fingerprints).encode(), digest_size=16).hexdigest()
+
+    def place(self, fingerprints: List[str], date: str, make_destination: Callable[[int], str]) -> Dict:
+        """make_destination(index): destination of a new group, relative to
+        the storage root. Return value: copy of the group's record"""
+        key = self.group_key(fingerprints)
+        with self._lock:
+            record = self._groups.get(key)
+            if record is None:
+                previous = self._find_previous(fingerprints)
+                if previous is not None:
+                    index, destination = previous["index"], previous["destination"]
+                else:
+                    index = self._next_index.get(date, 0)
+                    destination = make_destination(index)
+                self._next_index[date] = max(self._next_index.get(date, 0), index + 1)
+                record = self._groups[key] = {"date": date, "index": index,
+                                              "destination": destination, "done": False}
+                for fp in fingerprints:
+                    self._recordings[fp] = key
+            return dict(record)
+
+    def _find_previous(self, fingerprints) -> Optional[Dict]:
+        for fp in fingerprints:
+            key = self._recordings.get(fp)
+            if key is not None:
+                return self._groups[key]
+        return None
+
+    def complete(self, destination: str):
+        """Marks groups with the (relative) destination as imported"""
+        with self._lock:
+            for record in self._groups.values():
+                if record["destination"] == destination:
+                    record["done"] = True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"recordings": len(self._recordings), "groups": len(self._groups),
+                    "done": sum(record["done"] for record in self._groups.values())}
+
+    def load(self):
+        try:
+            with open(self.path, "r") as catalog_file:
+                state = json.load(catalog_file)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, OSError) as e:
+            logging.error("Cannot read recording catalog %s: %s", self.path, e)
+            raise
+        with self._lock:
+            self._recordings = state["recordings"]
+            self._groups = state["groups"]
+            self._next_index = state["next_index"]
+
+    def save(self):
+        """Atomically rewrites catalog file. No-op for in-memory catalog."""
+        if not self.path:
+            return
+        with self._lock:
+            payload = json.dumps({"recordings": self._recordings, "groups": self._groups,
+                                  "next_index": self._next_index})
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self._save_lock:
+            with open(tmp_path, "w") as catalog_file:
+                catalog_file.write(payload)
+            os.replace(tmp_path, self.path)
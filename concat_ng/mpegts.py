@@ -0,0 +1,216 @@
+"""Subprocess-free timing reader for MPEG-TS / AVCHD (.MTS) files.
+
+Only looks at the first and last few megabytes of a file: start time is the
+smallest PTS near the head, duration is the largest PTS near the tail minus
+start. Returns None when undecidable, callers should fall back to ffprobe.
+"""
+
+import mmap
+import os
+from typing import Dict, Iterator, Optional, Tuple
+
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PACKET_LAYOUTS = [  # (packet size, sync byte offset)
+    (192, 4),  # BDAV / AVCHD: 4-byte TP_extra_header
+    (TS_PACKET_SIZE, 0),
+]
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+
+WINDOW_SIZE = 4 << 20
+SYNC_CHECK_PACKETS = 8
+PES_SAMPLES = 64
+
+
+def _find_layout(data, start=0) -> Optional[Tuple[int, int]]:
+    """Return value: (packet size, offset of first packet) or None"""
+    for packet_size, sync_offset in PACKET_LAYOUTS:
+        span = packet_size * SYNC_CHECK_PACKETS
+        for shift in range(packet_size):
+            base = start + shift
+            if base + span > len(data):
+                break
+            if all(data[base + sync_offset + k * packet_size] == TS_SYNC_BYTE
+                   for k in range(SYNC_CHECK_PACKETS)):
+                return packet_size, base
+    return None
+
+
+def _decode_pts(data, pos) -> int:
+    return (((data[pos] >> 1) & 0x07) << 30 | data[pos + 1] << 22
+            | (data[pos + 2] >> 1) << 15 | data[pos + 3] << 7 | data[pos + 4] >> 1)
+
+
+def _packet_pts(data, pos) -> Optional[int]:
+    """pos: offset of TS packet sync byte. Return value: PES PTS or None"""
+    if data[pos] != TS_SYNC_BYTE or not data[pos + 1] & 0x40:  # PUSI
+        return None
+    adaptation_control = (data[pos + 3] >> 4) & 0x03
+    if not adaptation_control & 0x01:  # no payload
+        return None
+    payload = pos + 4
+    if adaptation_control & 0x02:
+        payload += 1 + data[pos + 4]
+    if payload + 14 > pos + TS_PACKET_SIZE:
+        return None
+    if data[payload] != 0 or data[payload + 1] != 0 or data[payload + 2] != 1:
+        return None
+    stream_id = data[payload + 3]
+    if not (0xC0 <= stream_id <= 0xEF or stream_id == 0xBD or stream_id == 0xFD):
+        return None
+    if not data[payload + 7] & 0x80:  # PTS_DTS_flags
+        return None
+    return _decode_pts(data, payload + 9)
+
+
+def _iter_pts(data, packet_size, first, reverse=False) -> Iterator[int]:
+    sync_offset = packet_size - TS_PACKET_SIZE
+    count = (len(data) - first) // packet_size
+    indices = range(count - 1, -1, -1) if reverse else range(count)
+    for idx in indices:
+        pts = _packet_pts(data, first + idx * packet_size + sync_offset)
+        if pts is not None:
+            yield pts
+
+
+def _sample_pts(data, packet_size, first, reverse=False) -> list:
+    samples = []
+    for pts in _iter_pts(data, packet_size, first, reverse):
+        samples.append(pts)
+        if len(samples) >= PES_SAMPLES:
+            break
+    return samples
+
+
+def read_format_info(path, window_size=WINDOW_SIZE) -> Optional[Dict[str, str]]:
+    """Same keys and value format as `ffprobe -show_format` subset:
+    "format_name", "start_time", "duration"."""
+    size = os.path.getsize(path)
+    if size < TS_PACKET_SIZE * SYNC_CHECK_PACKETS:
+        return None
+
+    with open(path, "rb") as stream, \
+            mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        head = view[:min(window_size, size)]
+        tail = view[max(0, size - window_size):]
+        try:
+
+            layout = _find_layout(head)
+            if layout is None:
+                return None
+            packet_size, head_first = layout
+            head_samples = _sample_pts(head, packet_size, head_first)
+
+            tail_first = _find_layout(tail)
+            if tail_first is None or tail_first[0] != packet_size:
+                return None
+            tail_samples = _sample_pts(tail, packet_size, tail_first[1], reverse=True)
+        finally:
+            head.release()
+            tail.release()
+            view.release()
+
+    if not head_samples or not tail_samples:
+        return None
+
+    start = min(head_samples)
+    end = max(tail_samples)
+    if end < start:  # 33-bit PTS wrap inside the file
+        end += PTS_WRAP
+    duration = end - start
+    if duration > PTS_WRAP // 2:
+        return None
+
+    return {
+        "format_name": "mpegts",
+        "start_time": f"{start / PTS_CLOCK:.6f}",
+        "duration": f"{duration / PTS_CLOCK:.6f}",
+    }
+
+
+def _write_synthetic_mts(path, start, duration, size, packet_size=192):
+    """Writes an AVCHD-like file: PES headers with PTS on video and audio PIDs,
+    rest of the packets are padding."""
+    def pts_bytes(pts):
+        return bytes([
+            0x21 | ((pts >> 29) & 0x0E), (pts >> 22) & 0xFF,
+            ((pts >> 14) & 0xFE) | 1, (pts >> 7) & 0xFF,
+            ((pts << 1) & 0xFE) | 1,
+        ])
+
+    def packet(pid, pts=None):
+        unit_start = 0x40 if pts is not None else 0x00
+        body = bytes([TS_SYNC_BYTE, unit_start | (pid >> 8) & 0x1F, pid & 0xFF, 0x10])
+        if pts is not None:
+            stream_id = 0xE0 if pid == 0x1011 else 0xC0
+            body += b"\x00\x00\x01" + bytes([stream_id]) + b"\x00\x00\x80\x80\x05" + pts_bytes(pts % PTS_WRAP)
+        body += b"\xFF" * (TS_PACKET_SIZE - len(body))
+        return b"\x00" * (packet_size - TS_PACKET_SIZE) + body
+
+    count = size // packet_size
+    pes_every = 50
+    frames = (count + pes_every - 1) // pes_every
+    with open(path, "wb") as stream:
+        for idx in range(count):
+            if idx % pes_every == 0:
+                frame = idx // pes_every
+                pts = int((start + duration * frame / max(1, frames - 1)) * PTS_CLOCK)
+                stream.write(packet(0x1011 if frame % 2 == 0 else 0x1100, pts))
+            else:
+                stream.write(packet(0x1FFF))
+
+
+if __name__ == "__main__":
+    import datetime
+    import shutil
+    import sys
+    import tempfile
+    import time
+    from concat_ng.probe import VideoFile, extract_groups, ffprobe_format_info
+
+    chunk_size = int(sys.argv[1]) if len(sys.argv) > 1 else 16 << 20
+    layout = [  # (start, duration) per chunk; 3 groups
+        (0.0, 1200.0), (1200.0, 1200.0), (2400.0, 700.0),
+        (0.0, 900.0), (900.0, 600.0),
+        (5000.0, 300.0),
+    ]
+    expected_groups = [[0, 1, 2], [3, 4], [5]]  # indices into layout
+    tolerance = 0.05  # seconds; synthetic PES carry exact start and end PTS
+    workdir = tempfile.mkdtemp(prefix="mpegts_bench_")
+    try:
+        paths = []
+        for idx, (start, duration) in enumerate(layout):
+            path = os.path.join(workdir, f"{idx:05}.MTS")
+            _write_synthetic_mts(path, start, duration, chunk_size)
+            paths.append(path)
+
+        def timed_groups(reader):
+            videos = []
+            began = time.perf_counter()
+            for path in paths:
+                info = reader(path)
+                assert info is not None, f"{reader.__name__}: undecidable {path}"
+                videos.append(VideoFile(
+                    path, float(info["start_time"]), float(info["duration"]),
+                    datetime.datetime.fromtimestamp(os.stat(path).st_mtime)))
+            elapsed = time.perf_counter() - began
+            for video, (start, duration) in zip(videos, layout):
+                assert abs(video.start - start) <= tolerance, (reader.__name__, video, start)
+                assert abs(video.duration - duration) <= tolerance, (reader.__name__, video, duration)
+            groups = [[paths.index(vid.path) for vid in group] for group in extract_groups(videos)]
+            assert groups == expected_groups, (reader.__name__, groups)
+            return elapsed, groups
+
+        native_time, native_groups = timed_groups(read_format_info)
+        print(f"native:  {native_time * 1000 / len(paths):8.2f} ms/file, groups: {[len(g) for g in native_groups]}")
+        if shutil.which("ffprobe"):
+            ffprobe_time, ffprobe_groups = timed_groups(ffprobe_format_info)
+            print(f"ffprobe: {ffprobe_time * 1000 / len(paths):8.2f} ms/file, groups: {[len(g) for g in ffprobe_groups]}")
+            print(f"speedup: {ffprobe_time / native_time:.1f}x")
+        else:
+            print("ffprobe not found, native timings checked against the synthetic layout only")
+    finally:
+        shutil.rmtree(workdir)
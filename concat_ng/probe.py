@@ -6,26 +6,44 @@ import logging
 import subprocess
 import datetime
 import json
+import functools
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+from concat_ng import mpegts
+from concat_ng.probe_cache import ProbeCache
 
 
 class VideoFile(namedtuple("VideoFile", "path start duration modification_time".split())):
+    FORMAT_KEYS = ["start_time", "duration", "format_name"]
+
     @staticmethod
-    def from_path(path):
-        format_info: dict = get_video_format_info(path)
+    def from_path(path, root=None, cache: ProbeCache = None, native=True):
+        """root: device root, cache keys are relative to it
+        native: try to read timings without ffprobe"""
+        stat = os.stat(path)
+        format_info = None
+        if cache is not None:
+            cache_key = ProbeCache.make_key(path, root, stat)
+            format_info = cache.get(cache_key)
+
+        if format_info is None:
+            format_info = get_video_format_info(path, native)
 
-        if not all(key in format_info for key in ["start_time", "duration", "format_name"]):
-            raise RuntimeError(f"failed to get video metadata of {path!r}")
+            if not all(key in format_info for key in VideoFile.FORMAT_KEYS):
+                raise RuntimeError(f"failed to get video metadata of {path!r}")
 
-        if format_info["format_name"] != "mpegts":
-            raise RuntimeError(f"unexpected format {format_info['format_name']!r} of {path!r}")
+            if format_info["format_name"] != "mpegts":
+                raise RuntimeError(f"unexpected format {format_info['format_name']!r} of {path!r}")
+
+            if cache is not None:
+                cache.put(cache_key, {key: format_info[key] for key in VideoFile.FORMAT_KEYS})
 
         return VideoFile(
             path=path,
             start=float(format_info["start_time"]),
             duration=float(format_info["duration"]),
-            modification_time=datetime.datetime.fromtimestamp(os.stat(path).st_mtime)
+            modification_time=datetime.datetime.fromtimestamp(stat.st_mtime)
         )
 
     @property
@@ -48,11 +66,25 @@ class VideoFile(namedtuple("VideoFile", "path start duration modification_time".
         return f"[{self.start:11.2f} - {self.end:11.2f}) {self.duration:11.2f}   [{self.start_date.time():%H:%M:%S} - {self.end_date.time():%H:%M:%S})"
 
 
-def get_video_format_info(path) -> dict:
+def get_video_format_info(path, native=True) -> dict:
     """
         Probably avaliable and interesting keys:
             "format_name", "start_time", "duration"
+        With native=True, tries concat_ng.mpegts first, falls back to ffprobe
     """
+    if native:
+        try:
+            format_info = mpegts.read_format_info(path)
+        except (OSError, ValueError) as e:
+            logging.debug("Native probe of %r failed: %s", path, e)
+        else:
+            if format_info is not None:
+                return format_info
+        logging.debug("Native probe of %r undecided, using ffprobe", path)
+    return ffprobe_format_info(path)
+
+
+def ffprobe_format_info(path) -> dict:
     ffprobe_cmd = [
         "ffprobe",
         "-hide_banner", "-loglevel", "fatal",
@@ -64,15 +96,53 @@ def get_video_format_info(path) -> dict:
     return video_info["format"]
 
 
-def listdir_videos(path) -> List[VideoFile]:
+def ffprobe_stream_info(path) -> dict:
+    """Parameters of the first video stream: "video_codec", "width", "height"
+    and "video_bit_rate" (the container's overall rate if the stream has
+    none, as is usual for MPEG-TS)"""
+    ffprobe_cmd = [
+        "ffprobe",
+        "-hide_banner", "-loglevel", "fatal",
+        "-print_format", "json",
+        "-show_format", "-show_streams",
+        "-select_streams", "v:0",
+        "-i", path,
+    ]
+    video_info = json.loads(subprocess.check_output(ffprobe_cmd))
+    video = (video_info.get("streams") or [{}])[0]
+    bit_rate = video.get("bit_rate") or video_info.get("format", {}).get("bit_rate")
+    return {
+        "video_codec": video.get("codec_name"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "video_bit_rate": int(bit_rate) if bit_rate else None
+    }
+
+
+def get_stream_info(path, root=None, cache: ProbeCache = None) -> dict:
+    """ffprobe_stream_info, kept in the probe cache next to format info"""
+    if cache is None:
+        return ffprobe_stream_info(path)
+    cache_key = ProbeCache.make_key(path, root) + "|streams"
+    stream_info = cache.get(cache_key)
+    if stream_info is None:
+        stream_info = ffprobe_stream_info(path)
+        cache.put(cache_key, stream_info)
+    return stream_info
+
+
+def listdir_videos(path, root=None, cache: ProbeCache = None, workers=1) -> List[VideoFile]:
+    """Probes up to `workers` files concurrently, order is preserved"""
     names = sorted(filter(
         lambda name: name.endswith(".MTS"),
         os.listdir(path)
     ))
-    return [
-        VideoFile.from_path(os.path.join(path, name))
-        for name in names
-    ]
+    paths = [os.path.join(path, name) for name in names]
+    probe = functools.partial(VideoFile.from_path, root=root, cache=cache)
+    if workers <= 1 or len(paths) <= 1:
+        return list(map(probe, paths))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(probe, paths))
 
 
 def extract_groups(videos: List[VideoFile]) -> List[List[VideoFile]]:
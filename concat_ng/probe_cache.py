@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class ProbeCache:
+    """Persistent LRU cache of probe results.
+
+    Keyed by (device-relative path, size, mtime), so a card re-inserted under
+    another mountpoint still hits. Holds at most max_entries records, the least
+    recently used ones are evicted first. Thread-safe.
+    """
+
+    def __init__(self, path: str = None, max_entries: int = 4096):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # one writer of the tmp file
+        if path:
+            self.load()
+
+    @staticmethod
+    def make_key(path: str, root: str = None, stat: os.stat_result = None) -> str:
+        if stat is None:
+            stat = os.stat(path)
+        rel = os.path.relpath(path, start=root) if root else path
+        return f"{rel}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Dict):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def load(self):
+        try:
+            with open(self.path, "r") as cache_file:
+                entries = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, OSError) as e:
+            logging.warning("Discarding probe cache %s: %s", self.path, e)
+            return
+        with self._lock:
+            self._entries = OrderedDict(entries[-self.max_entries:])
+
+    def save(self):
+        """Atomically rewrites cache file. No-op for in-memory cache."""
+        if not self.path:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self._save_lock:
+            with open(tmp_path, "w") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp_path, self.path)
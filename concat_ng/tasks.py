@@ -5,39 +5,57 @@ import os
 import logging
 from collections import namedtuple
 from typing import List, Dict, Callable
+from concat_ng.catalog import RecordingCatalog, fingerprint
 from concat_ng.probe import VideoFile, extract_groups, listdir_videos
+from concat_ng.probe_cache import ProbeCache
 
 
 ConcatTask = namedtuple("ConcatTask", ["sources", "destination"])
 
-# TODO by-date task indices
-g_task_index = 0
+# numbering for callers without a persistent catalog, lives as long as the process
+g_session_catalog = RecordingCatalog()
 
-def into_tasks(sd_root, storage_root) -> List[ConcatTask]:
+def catalog_destination(destination, storage_root) -> str:
+    """Task destination -> its RecordingCatalog destination"""
+    return os.path.relpath(os.path.dirname(destination), storage_root)
+
+def into_tasks(sd_root, storage_root, probe_cache: ProbeCache = None, probe_workers=1,
+               catalog: RecordingCatalog = None) -> List[ConcatTask]:
+    """Groups are numbered within their date by the catalog, groups it has
+    as done are skipped. Logged group numbers are indices into the result"""
+    if catalog is None:
+        catalog = g_session_catalog
     raw_sources_path = os.path.join(sd_root, "PRIVATE", "AVCHD", "BDMV", "STREAM")
-    groups = extract_groups(listdir_videos(raw_sources_path))
+    videos = listdir_videos(raw_sources_path, root=sd_root, cache=probe_cache, workers=probe_workers)
+    if probe_cache is not None:
+        probe_cache.save()
+        logging.info("Probe cache: %s", probe_cache.stats())
+    groups = extract_groups(videos)
     
     month_names_ru = "января февраля марта апреля мая июня июля августа сентября октября ноября декабря".split()
     dow_names_ru = "понедельник вторник среда четверг пятница суббота воскресенье".split()
     
     concat_tasks = []
     
-    for idx, group in enumerate(groups):
+    for group in groups:
         date = group[0].start_date.date()
 
-        global g_task_index
         mon = month_names_ru[date.month - 1]
         dow = dow_names_ru[date.weekday()]  # weekday 0~6
-        destination = os.path.join(
-            storage_root,
-            f"{date:%Y.%m.%d} - {date.day} {mon} - {dow}",
-            f"#{g_task_index:02}-{group[0].start_date.time():%H_%M_%S}",
-            f"source"
+        record = catalog.place(
+            [fingerprint(vid.path) for vid in group], f"{date:%Y.%m.%d}",
+            lambda task_index: os.path.join(
+                f"{date:%Y.%m.%d} - {date.day} {mon} - {dow}",
+                f"#{task_index:02}-{group[0].start_date.time():%H_%M_%S}"
+            )
         )
-        g_task_index += 1
+        if record["done"]:
+            logging.info(f"=== Group already imported to {record['destination']!r}, skipping ===")
+            continue
+        destination = os.path.join(storage_root, record["destination"], f"source")
+        logging.info(f"=== Group #{len(concat_tasks)} for {destination!r} ===")
         concat_tasks.append(ConcatTask(group, destination))
 
-        logging.info(f"=== Group #{idx} for {destination!r} ===")
         logging.info(f"{'Name':10} {VideoFile.TIME_INFO_HEADER}")
         for vid in group:
             logging.info(f"{os.path.basename(vid.path):10} {vid.time_info_str()}")
@@ -45,14 +63,16 @@ def into_tasks(sd_root, storage_root) -> List[ConcatTask]:
         if not all(date == vid.start_date.date() for vid in group):
             logging.info(f"Warning: not all videos in group have same record date ({date})")
     
+    catalog.save()
     return concat_tasks
 
-def execute_from(args, transcode: Callable) -> List[str]:
+def execute_from(args, transcode: Callable, probe_cache: ProbeCache = None, probe_workers=1,
+                 catalog: RecordingCatalog = None) -> List[str]:
     """Return value: list of output files"""
     if not os.path.exists(args.output):
         raise RuntimeError(f"Output directory {args.output!r} does not exist")
 
-    concat_tasks = into_tasks(args.input, args.output)
+    concat_tasks = into_tasks(args.input, args.output, probe_cache, probe_workers, catalog)
 
     input("Concatenate? (or KeyboardInterrupt)")
 
@@ -69,7 +89,8 @@ def execute_from(args, transcode: Callable) -> List[str]:
 
     return outputs
 
-def execute_from_v2(args, transcode: Callable) -> Dict[str, List[str]]:
+def execute_from_v2(args, transcode: Callable, probe_cache: ProbeCache = None, probe_workers=1,
+                    catalog: RecordingCatalog = None) -> Dict[str, List[str]]:
     """
     Return value: 'directory' -> ['children']
     Also selects groups to process by index
@@ -77,7 +98,7 @@ def execute_from_v2(args, transcode: Callable) -> Dict[str, List[str]]:
     if not os.path.exists(args.output):
         raise RuntimeError(f"Output directory {args.output!r} does not exist")
 
-    concat_tasks = into_tasks(args.input, args.output)
+    concat_tasks = into_tasks(args.input, args.output, probe_cache, probe_workers, catalog)
 
     selected_tasks = input("Select groups (empty = all, KeyboardInterrupt = none): ")
     selected_tasks = list(map(int, selected_tasks.split()))
@@ -11,6 +11,13 @@ class Config:
         
             Config.scopes = config['gdrive']['scopes']
             Config.root_id = config['gdrive']['root_id']
+            Config.gdrive_upload_workers = config['gdrive'].get('upload_workers', 2)
+            Config.gdrive_chunk_size = config['gdrive'].get('chunk_size', 8 * 1024 * 1024)
+            Config.gdrive_discovery_url = config['gdrive'].get('discovery_url')
+            Config.gdrive_upload_url = config['gdrive'].get('upload_url')
+            Config.gdrive_folder_index = config['gdrive'].get('folder_index')
+            Config.gdrive_upload_state = config['gdrive'].get('upload_state')
+            Config.gdrive_upload_retries = config['gdrive'].get('upload_retries', 8)
             
             secrets_path = config['secrets_path']
             Config.token_path = os.path.join(
@@ -23,5 +30,34 @@ class Config:
             Config.ff_general_options = config['ffmpeg']['general_options']
             Config.ff_default_profile = config['ffmpeg']['default_profile']
             Config.ff_preset_dir = config['ffmpeg']['preset_dir']
+            Config.ff_segments = config['ffmpeg'].get('segments', 1)
+            Config.ff_stream_upload = config['ffmpeg'].get('stream_upload', False)
+            Config.ff_auto_remux = config['ffmpeg'].get('auto_remux', True)
+
+            Config.queue_disciplines = config.get('scheduling', {})
+
+            probe = config.get('probe', {})
+            Config.probe_workers = probe.get('workers', 4)
+            Config.probe_cache_path = probe.get('cache_path')
+            Config.probe_cache_size = probe.get('cache_size', 4096)
+
+            Config.catalog_path = config.get('catalog', {}).get('path')
+
+            ingest = config.get('ingest', {})
+            Config.ingest_workers = ingest.get('workers', 1)
+            Config.ingest_per_bus = ingest.get('per_bus', 1)
+
+            transcode_cache = config.get('transcode_cache', {})
+            Config.transcode_cache_dir = transcode_cache.get('dir')
+            Config.transcode_cache_max_bytes = int(transcode_cache.get('max_gb', 100) * 2**30)
+
+            proxy = config.get('proxy', {})
+            Config.proxy_profile = proxy.get('profile')
+            Config.proxy_priority = proxy.get('priority', 10)
+
+            staging = config.get('staging', {})
+            Config.staging_dir = staging.get('dir')
+            Config.staging_verify = staging.get('verify', 'sampled')
+            Config.staging_samples = staging.get('samples', 16)
         except (json.JSONDecodeError, KeyError) as e:
             print(f"Error reading config file: {e}", file=sys.stderr)
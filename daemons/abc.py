@@ -1,12 +1,16 @@
 import functools
+import heapq
 import io
+import itertools
 import json
 import logging
 import queue
+import socket
 import socketserver
 import time
-from threading import Thread
-from typing import Callable, List
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+from daemons import metrics, rpc
 
 
 class BaseDaemon:
@@ -42,14 +46,100 @@ class BaseDaemon:
         self._threads = []
         logging.info("BaseDaemon shutdown finished")
 
+def job_field(job, name, default):
+    """Reads a scheduling field of a dict or object job"""
+    if isinstance(job, dict):
+        return job.get(name, default)
+    return getattr(job, name, default)
+
+class FifoJobQueue(queue.Queue):
+    """queue.Queue recording each job's wait time (metrics.QUEUE_WAIT)"""
+
+    def __init__(self, maxsize=0, name=""):
+        self.name = name
+        super(FifoJobQueue, self).__init__(maxsize)
+
+    def _put(self, job):
+        self.queue.append((time.monotonic(), job))
+
+    def _get(self):
+        enqueued_at, job = self.queue.popleft()
+        metrics.QUEUE_WAIT.observe(time.monotonic() - enqueued_at, queue=self.name)
+        return job
+
+class PriorityJobQueue(queue.Queue):
+    """Smallest key(job) first, FIFO among equal keys.
+    aging: key units subtracted per second of waiting, so that a job with a
+    large key is not overtaken forever (starvation protection).
+    by_priority: higher "priority" jobs first whatever their key and age,
+    key orders jobs of the same priority."""
+
+    def __init__(self, key: Callable, aging=0.0, maxsize=0, name="", by_priority=False):
+        self.key = key
+        self.aging = aging
+        self.name = name
+        self.by_priority = by_priority
+        super(PriorityJobQueue, self).__init__(maxsize)
+
+    def score(self, job, enqueued_at) -> Tuple[float, float]:
+        return discipline_score(self.key, self.by_priority, self.aging, job, enqueued_at)
+
+    def _init(self, maxsize):
+        self.queue = []
+        self._seq = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, job):
+        enqueued_at = time.monotonic()
+        heapq.heappush(self.queue, (self.score(job, enqueued_at), next(self._seq), enqueued_at, job))
+
+    def _get(self):
+        _, _, enqueued_at, job = heapq.heappop(self.queue)
+        metrics.QUEUE_WAIT.observe(time.monotonic() - enqueued_at, queue=self.name)
+        return job
+
+def job_priority(job) -> float:
+    return float(job_field(job, "priority", 0) or 0)
+
+QUEUE_DISCIPLINES = {
+    # higher "priority" first
+    "priority": lambda job: -job_priority(job),
+    # smaller "size" (e.g. seconds of video) first, unknown size counts as 0
+    "sjf": lambda job: float(job_field(job, "size", 0) or 0),
+    # smaller expected run time "eta" first, "size" if not estimated
+    "eta": lambda job: float(job_field(job, "eta", None) or job_field(job, "size", 0) or 0),
+}
+# Disciplines ordering jobs within a "priority" level, the levels go first to last
+BY_PRIORITY = {"sjf", "eta"}
+
+def discipline_score(key: Callable, by_priority, aging, job, enqueued_at) -> Tuple[float, float]:
+    return (-job_priority(job) if by_priority else 0.0, key(job) + aging * enqueued_at)
+
+def make_queue(discipline="fifo", aging=0.0, name="") -> queue.Queue:
+    """name: queue label in metrics"""
+    if discipline == "fifo":
+        return FifoJobQueue(name=name)
+    try:
+        return PriorityJobQueue(QUEUE_DISCIPLINES[discipline], aging, name=name,
+                                by_priority=discipline in BY_PRIORITY)
+    except KeyError:
+        raise ValueError(f"Unknown queue discipline: {discipline}")
+
 class JobQueueDaemon(BaseDaemon):
-    def __init__(self, queues: List[str]):
+    def __init__(self, queues: List[str], disciplines: Dict[str, Dict] = None):
         """Constructs executor instance with (self.job_queue, *args, **kwargs)
         
         executor_cls.shutdown method should block until executor_cls.run finishes
+
+        disciplines: queue key -> make_queue kwargs, FIFO by default
         """
         super(JobQueueDaemon, self).__init__()
-        self.job_queues = {key: queue.Queue() for key in queues}
+        disciplines = disciplines or {}
+        self.job_queues = {key: make_queue(name=key, **disciplines.get(key, {})) for key in queues}
+        for key, job_queue in self.job_queues.items():
+            metrics.QUEUE_DEPTH.set_function(job_queue.qsize, queue=key)
         self.executors = []
         self._executor_threads = []
 
@@ -59,6 +149,7 @@ class JobQueueDaemon(BaseDaemon):
             args = (self.job_queues[queue_key], *args)
         executor = executor_cls(*args, **kwargs)
         self.executors.append(executor)
+        return executor
 
     def shutdown(self):
         super(JobQueueDaemon, self).shutdown()
@@ -95,21 +186,34 @@ class BaseLoopExecutor:
 
     def run(self):
         self._running = True # thread-safety left
+        name = type(self).__name__
         while not self._shutdown_requested:
             # TODO after shutdown request, poll until etimeout (= empty event queue)
+            began = time.monotonic()
             try:
                 event = self.event_poll(timeout=self._poll_interval)
             except self.etimeout_cls:
+                metrics.EXECUTOR_IDLE.inc(time.monotonic() - began, executor=name)
                 continue
             except Exception as e:
                 logging.exception(e)
             else:
+                polled = time.monotonic()
+                metrics.EXECUTOR_IDLE.inc(polled - began, executor=name)
                 try:
                     self.handle_event(event)
                 except Exception as e:
                     logging.exception(e)
+                self.record_service(polled)
         self._running = False
 
+    def record_service(self, began):
+        """Accounts one handled event, began: time.monotonic() before handling"""
+        elapsed = time.monotonic() - began
+        name = type(self).__name__
+        metrics.EXECUTOR_BUSY.inc(elapsed, executor=name)
+        metrics.JOB_SERVICE.observe(elapsed, executor=name)
+
     def shutdown(self):
         self._shutdown_requested = True
         while self._running:
@@ -128,28 +232,93 @@ class BaseQueueExecutor(BaseLoopExecutor):
     def handle_job(self, job):
         raise NotImplementedError()
 
+    def room(self) -> Optional[int]:
+        """How many more jobs the executor takes now, None if not limited.
+        Runtimes pulling jobs for the executor (see daemons.aio) honor it"""
+        return None
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    """Persistent RPC connections (see daemons.rpc) occupy a thread each,
+    server_close() closes them"""
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        self._connections = set()
+        self._connections_lock = Lock()
+        super(ThreadingTCPServer, self).__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self._connections.add(request)
+        super(ThreadingTCPServer, self).process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.discard(request)
+        super(ThreadingTCPServer, self).shutdown_request(request)
+
+    def server_close(self):
+        super(ThreadingTCPServer, self).server_close()
+        with self._connections_lock:
+            connections = list(self._connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
 class JsonRequestHandler(socketserver.StreamRequestHandler):
     """RequestHandler helper for json-based services.
     A concrete handler should define handle() method. Defines additional
     properties: self.request_obj and self.response_obj to use inside handle().
-    self.request_obj will be None in case request was not valid JSON."""
+    self.request_obj will be None in case request was not valid JSON.
+    Connections starting with rpc.MAGIC carry a sequence of requests, each
+    one is handled the same way."""
 
     def setup(self):
         super(JsonRequestHandler, self).setup()
         self.response_obj = {}
+        self.request_obj = None
+        self.persistent = self.rfile.peek(1)[:1] == rpc.MAGIC[:1]
+        if not self.persistent:
+            self.request_obj = self.decode_request(self.rfile.read()) # Client should send SHUT_WR
+
+    def decode_request(self, data):
         try:
-            self.request_obj = json.load(self.rfile) # Client should send SHUT_WR
+            return json.loads(data)
         except json.JSONDecodeError as e:
-            logging.exception("JSONDecodeError client={}", self.client_address)
-            self.request_obj = None
+            logging.exception("JSONDecodeError client=%s", self.client_address)
+            return None
     
     def handle(self):
+        if self.persistent:
+            self.handle_frames()
+            return
         self.handle_obj()
         try:
             json.dump(self.response_obj, io.TextIOWrapper(self.wfile))
         except Exception as e:
             logging.exception(e)
 
+    def handle_frames(self):
+        if self.rfile.read(len(rpc.MAGIC)) != rpc.MAGIC:
+            return
+        try:
+            while True:
+                frame = rpc.read_frame(self.rfile)
+                if frame is None:
+                    break
+                request_id, payload = frame
+                self.request_obj = self.decode_request(payload)
+                self.response_obj = {}
+                try:
+                    self.handle_obj()
+                except Exception as e:
+                    logging.exception(e)
+                self.wfile.write(rpc.pack_frame(request_id, json.dumps(self.response_obj).encode()))
+        except (OSError, ValueError) as e:
+            logging.warning("RPC connection client=%s: %s", self.client_address, e)
+
 class HandlerDispatcher:
     """RequestHandler helper to dispatch requests."""
     def __init__(self):
@@ -0,0 +1,408 @@
+"""asyncio runtime for daemons, a drop-in for daemons.abc daemons and servers.
+
+Keeps the programming model: the same JsonRequestHandler/DispatchedRequestHandler
+subclasses serve requests, the same BaseQueueExecutor subclasses consume
+queues. Differences from the threaded runtime:
+- one event loop accepts any number of concurrent clients, a slow handler
+  does not hold back others (TCPServer serves one connection at a time and
+  resets clients past its listen backlog)
+- handlers and jobs (ffmpeg, Drive) run in a thread pool off the loop, which
+  costs a thread hop per request when there is no contention
+
+Latency benchmark of both runtimes:
+(venv) $ python -m daemons.aio --clients 32 --requests 50
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from daemons import metrics, rpc
+from daemons.abc import BY_PRIORITY, QUEUE_DISCIPLINES, BaseQueueExecutor, discipline_score
+
+
+class AsyncJobQueue:
+    """Thread-safe put() for handlers and executors, awaitable get() for the loop.
+    Items put before the loop starts are kept until bind().
+    Disciplines are the same as daemons.abc.make_queue ones."""
+
+    def __init__(self, discipline="fifo", aging=0.0, name=""):
+        if discipline != "fifo" and discipline not in QUEUE_DISCIPLINES:
+            raise ValueError(f"Unknown queue discipline: {discipline}")
+        self.discipline = discipline
+        self.aging = aging
+        self.name = name
+        self._loop = None
+        self._queue = None
+        self._early = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def score(self, job, enqueued_at) -> Tuple[float, float]:
+        return discipline_score(QUEUE_DISCIPLINES[self.discipline], self.discipline in BY_PRIORITY,
+                                self.aging, job, enqueued_at)
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        with self._lock:
+            self._loop = loop
+            if self.discipline == "fifo":
+                self._queue = asyncio.Queue()
+            else:
+                self._queue = asyncio.PriorityQueue()
+            for item in self._early:
+                self._queue.put_nowait(item)
+            self._early = []
+
+    def put(self, item):
+        enqueued_at = time.monotonic()
+        if self.discipline != "fifo":
+            item = (self.score(item, enqueued_at), next(self._seq), enqueued_at, item)
+        else:
+            item = (enqueued_at, item)
+        with self._lock:
+            if self._loop is None:
+                self._early.append(item)
+                return
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def _unwrap(self, item):
+        metrics.QUEUE_WAIT.observe(time.monotonic() - item[-2], queue=self.name)
+        return item[-1]
+
+    async def get(self):
+        return self._unwrap(await self._queue.get())
+
+    def get_ready(self, limit=None) -> List:
+        """Items available without waiting, at most limit. Loop thread only"""
+        items = []
+        while not self._queue.empty() and (limit is None or len(items) < limit):
+            items.append(self._unwrap(self._queue.get_nowait()))
+        return items
+
+    def qsize(self) -> int:
+        with self._lock:
+            if self._queue is None:
+                return len(self._early)
+            return self._queue.qsize()
+
+class AsyncTCPServer:
+    """Same constructor as socketserver.TCPServer. Reads a request until the
+    client's SHUT_WR (or rpc frames), runs handler_cls.handle_obj() and writes
+    the response."""
+
+    def __init__(self, server_address, handler_cls):
+        self.server_address = server_address
+        self.handler_cls = handler_cls
+        self.daemon = None
+        self._server = None
+        self._pool = None
+        self._writers = set()
+
+    async def start(self, pool: ThreadPoolExecutor):
+        self._pool = pool
+        host, port = self.server_address
+        self._server = await asyncio.start_server(self._on_client, host, port)
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        self._server.close()
+        for writer in list(self._writers):  # persistent RPC connections
+            writer.close()
+        await self._server.wait_closed()
+
+    def make_handler(self, request_obj, client_address):
+        """Handler instance bypassing socketserver I/O, has the attributes
+        concrete handlers use: server, client_address, request_obj, response_obj"""
+        handler = self.handler_cls.__new__(self.handler_cls)
+        handler.server = self
+        handler.client_address = client_address
+        handler.request_obj = request_obj
+        handler.response_obj = {}
+        return handler
+
+    def decode_request(self, data, client_address):
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError:
+            logging.exception("JSONDecodeError client=%s", client_address)
+            return None
+
+    async def handle_request(self, data, client_address) -> bytes:
+        handler = self.make_handler(self.decode_request(data, client_address), client_address)
+        await asyncio.get_running_loop().run_in_executor(self._pool, handler.handle_obj)
+        return json.dumps(handler.response_obj).encode()
+
+    async def _on_client(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        self._writers.add(writer)
+        try:
+            try:
+                head = await reader.readexactly(len(rpc.MAGIC))
+            except asyncio.IncompleteReadError as e:
+                head = e.partial
+            if head == rpc.MAGIC:
+                await self._serve_frames(reader, writer, client_address)
+                return
+            data = head + await reader.read()
+            writer.write(await self.handle_request(data, client_address))
+            await writer.drain()
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _serve_frames(self, reader, writer, client_address):
+        """Pipelined requests are handled concurrently, responses are written
+        as they complete"""
+        write_lock = asyncio.Lock()
+        in_flight = set()
+
+        async def respond(request_id, payload):
+            try:
+                response = await self.handle_request(payload, client_address)
+                async with write_lock:
+                    writer.write(rpc.pack_frame(request_id, response))
+                    await writer.drain()
+            except Exception as e:
+                logging.exception(e)
+
+        try:
+            while True:
+                header = await reader.readexactly(rpc.HEADER.size)
+                length, request_id = rpc.unpack_header(header)
+                payload = await reader.readexactly(length)
+                task = asyncio.create_task(respond(request_id, payload))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+        except asyncio.IncompleteReadError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning("RPC connection client=%s: %s", client_address, e)
+        if in_flight:
+            await asyncio.gather(*in_flight)
+
+class AsyncBaseDaemon:
+    """start()/shutdown() are called from the main thread as with BaseDaemon,
+    the event loop runs in its own thread."""
+    POOL_SIZE = 16
+
+    def __init__(self):
+        self.servers = []
+        self.loop = None
+        self._pool = None
+        self._thread = None
+        self._stop = None
+        self._server_threads = []
+        self._ready = threading.Event()
+        self._started = False
+
+    def add_server(self, server):
+        """Sets server.daemon property to access daemon instance"""
+        server.daemon = self
+        self.servers.append(server)
+
+    def start(self):
+        if self._started:
+            raise RuntimeError("Already started")
+        self._pool = ThreadPoolExecutor(max_workers=self.POOL_SIZE)
+        self._ready.clear()
+        self._thread = threading.Thread(target=asyncio.run, args=(self._main(),))
+        self._thread.start()
+        self._ready.wait()
+        self._started = True
+
+    def shutdown(self):
+        if not self._started:
+            raise RuntimeError("Not started")
+        self.loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+        self._pool.shutdown()
+        self._started = False
+        logging.info("AsyncBaseDaemon shutdown finished")
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        try:
+            await self.on_start()
+        finally:
+            self._ready.set()
+        await self._stop.wait()
+        await self.on_shutdown()
+
+    async def on_start(self):
+        """socketserver servers (e.g. bulk data ports) keep serve_forever() threads"""
+        for srv in self.servers:
+            if isinstance(srv, AsyncTCPServer):
+                await srv.start(self._pool)
+            else:
+                srv_thread = threading.Thread(target=srv.serve_forever)
+                srv_thread.start()
+                self._server_threads.append((srv, srv_thread))
+
+    async def on_shutdown(self):
+        for srv in self.servers:
+            if isinstance(srv, AsyncTCPServer):
+                await srv.close()
+        for srv, srv_thread in self._server_threads:
+            srv.shutdown()
+            srv_thread.join()
+            srv.server_close()
+        self._server_threads = []
+
+class AsyncJobQueueDaemon(AsyncBaseDaemon):
+    """Same interface as daemons.abc.JobQueueDaemon. Queue executors are
+    driven by the loop: one job at a time per executor, as with threads.
+    Other loop executors (e.g. udev polling) keep their own run() thread."""
+
+    def __init__(self, queues: List[str], disciplines: Dict[str, Dict] = None):
+        super(AsyncJobQueueDaemon, self).__init__()
+        disciplines = disciplines or {}
+        self.job_queues = {key: AsyncJobQueue(name=key, **disciplines.get(key, {})) for key in queues}
+        for key, job_queue in self.job_queues.items():
+            metrics.QUEUE_DEPTH.set_function(job_queue.qsize, queue=key)
+        self.executors = []
+        self._tasks = []
+        self._loop_threads = []
+
+    def add_executor(self, queue_key: str, executor_cls, *args, **kwargs):
+        """if executor_cls is not a BaseQueueExecutor, queue_key is ignored"""
+        if issubclass(executor_cls, BaseQueueExecutor):
+            args = (self.job_queues[queue_key], *args)
+        executor = executor_cls(*args, **kwargs)
+        self.executors.append(executor)
+        return executor
+
+    async def on_start(self):
+        for job_queue in self.job_queues.values():
+            job_queue.bind(self.loop)
+        for executor in self.executors:
+            if isinstance(executor, BaseQueueExecutor):
+                self._tasks.append(asyncio.create_task(self._drive(executor)))
+            else:
+                thread = threading.Thread(target=executor.run)
+                thread.start()
+                self._loop_threads.append(thread)
+        await super(AsyncJobQueueDaemon, self).on_start()
+
+    async def _drive(self, executor: BaseQueueExecutor):
+        """Jobs stay queued while executor.room() is 0"""
+        name = type(executor).__name__
+        while True:
+            began = time.monotonic()
+            room = executor.room()  # cheap, not worth a pool round trip
+            while room is not None and room <= 0:
+                await asyncio.sleep(BaseQueueExecutor.DEFAULT_TIMEOUT)
+                room = executor.room()
+            jobs = [await executor.job_queue.get()]
+            metrics.EXECUTOR_IDLE.inc(time.monotonic() - began, executor=name)
+            jobs.extend(executor.job_queue.get_ready(None if room is None else room - 1))
+            await self.loop.run_in_executor(self._pool, self._handle_jobs, executor, jobs)
+
+    @staticmethod
+    def _handle_jobs(executor: BaseQueueExecutor, jobs: List):
+        """Jobs queued meanwhile are handled in one pool call, one loop round trip per batch"""
+        for job in jobs:
+            began = time.monotonic()
+            try:
+                executor.handle_event(job)
+            except Exception as e:
+                logging.exception(e)
+            executor.record_service(began)
+
+    async def on_shutdown(self):
+        await super(AsyncJobQueueDaemon, self).on_shutdown()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for executor in self.executors:
+            await self.loop.run_in_executor(None, executor.shutdown)
+        for thread in self._loop_threads:
+            thread.join()
+        self._loop_threads = []
+        logging.info("AsyncJobQueueDaemon shutdown finished")
+
+
+if __name__ == "__main__":
+    import argparse
+    import socket
+    import socketserver
+    import statistics
+    from daemons.abc import DispatchedRequestHandler, HandlerDispatcher, JobQueueDaemon
+
+    class PingHandler(DispatchedRequestHandler):
+        mesg_dispatcher = HandlerDispatcher()
+
+        @mesg_dispatcher.add_handler("ping")
+        def on_ping(self):
+            self.server.daemon.job_queues["q_ping"].put(time.monotonic())
+
+    class WakeupRecorder(BaseQueueExecutor):
+        def __init__(self, job_queue, wakeups):
+            super(WakeupRecorder, self).__init__(job_queue)
+            self.wakeups = wakeups
+
+        def handle_job(self, put_at):
+            self.wakeups.append(time.monotonic() - put_at)
+
+    def request(addr):
+        began = time.monotonic()
+        with socket.create_connection(addr) as sock:
+            sock.sendall(json.dumps({"message_type": "ping", "message": {}}).encode())
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile("r") as sock_r:
+                json.load(sock_r)
+        return time.monotonic() - began
+
+    def bench(daemon, server_cls, clients, requests):
+        wakeups = []
+        daemon.add_executor("q_ping", WakeupRecorder, wakeups)
+        server = server_cls(("127.0.0.1", 0), PingHandler)
+        daemon.add_server(server)
+        daemon.start()
+        addr = server.server_address
+        latencies = []
+        failures = []
+        lock = threading.Lock()
+
+        def client():
+            for _ in range(requests):
+                try:
+                    latency = request(addr)
+                except OSError as e:
+                    failures.append(e)
+                    continue
+                with lock:
+                    latencies.append(latency)
+
+        began = time.monotonic()
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - began
+        while len(wakeups) < len(latencies):
+            time.sleep(0.1)
+        daemon.shutdown()
+
+        def ms(values, q):
+            return 1000 * statistics.quantiles(values, n=100)[q - 1]
+        return (f"{len(latencies) / elapsed:8.0f} req/s  rpc p50 {ms(latencies, 50):7.2f} ms"
+                f"  p99 {ms(latencies, 99):7.2f} ms  queue wakeup p50 {ms(wakeups, 50):7.2f} ms"
+                f"  failed {len(failures)}")
+
+    parser = argparse.ArgumentParser(description="RPC latency of threaded vs asyncio runtime")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    print("threads:", bench(JobQueueDaemon(["q_ping"]), socketserver.TCPServer, args.clients, args.requests))
+    print("asyncio:", bench(AsyncJobQueueDaemon(["q_ping"]), AsyncTCPServer, args.clients, args.requests))
@@ -3,9 +3,11 @@ import logging
 import os
 import pyudev
 import signal
-import socketserver
-from daemons.abc import JobQueueDaemon
-from .devwatch import DevwatchExecutor, DevwatchRequestHandler, ImportExecutor
+from daemons.abc import JobQueueDaemon, ThreadingTCPServer
+from daemons.aio import AsyncJobQueueDaemon, AsyncTCPServer
+from daemons.journal import Journal
+from daemons.metrics import MetricsServer
+from .devwatch import DevwatchExecutor, DevwatchRequestHandler, ImportExecutor, resume_from_journal
 
 def check_match(device):
     try:
@@ -21,6 +23,11 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Watch block devices to search and import sources")
     parser.add_argument("--importer", required=True, help="Importer daemon address")
     parser.add_argument("--bind", required=False, default="127.0.0.1:1339", help="Bind address")
+    parser.add_argument("--mount-workers", required=False, type=int, default=4, help="Devices mounted and checked concurrently")
+    parser.add_argument("--runtime", required=False, choices=["threads", "asyncio"], default="threads",
+                        help="Request serving and queue runtime")
+    parser.add_argument("--journal", required=False, help="Path to device journal, mounted cards are imported again after restart (default - in memory)")
+    parser.add_argument("--metrics-bind", required=False, help="Bind address for Prometheus metrics (default - disabled)")
     parser.add_argument("--logfile", required=False, help="Path to log file (default - stderr)")
     return parser.parse_args()
 
@@ -33,13 +40,22 @@ def main(args):
     importer_addr = to_addr(args.importer)
     # TODO check mount privilege
     
-    daemon = JobQueueDaemon(["q_import"])
+    if args.runtime == "asyncio":
+        daemon_cls, server_cls = AsyncJobQueueDaemon, AsyncTCPServer
+    else:
+        daemon_cls, server_cls = JobQueueDaemon, ThreadingTCPServer
+    daemon = daemon_cls(["q_import"])
+    daemon.journal = Journal(args.journal)
     udev_context = pyudev.Context()
     daemon.add_executor(None, DevwatchExecutor, udev_context,
                         daemon, daemon.job_queues["q_import"],
-                        udev_filter="block", event_filter=check_match)
+                        udev_filter="block", event_filter=check_match,
+                        workers=args.mount_workers)
+    resume_from_journal(daemon, daemon.job_queues["q_import"])
     daemon.add_executor("q_import", ImportExecutor, importer_addr)
-    daemon.add_server(socketserver.TCPServer(bind_addr, DevwatchRequestHandler))
+    daemon.add_server(server_cls(bind_addr, DevwatchRequestHandler))
+    if args.metrics_bind:
+        daemon.add_server(MetricsServer(to_addr(args.metrics_bind)))
     
     daemon.start()
     logging.info("Started")
@@ -51,6 +67,7 @@ def main(args):
         sig = signal.Signals(sig.si_signo)
         logging.info("Shutting down after %s", sig.name)
         daemon.shutdown()
+        daemon.journal.close()
 
 if __name__ == "__main__":
     args  = parse_args()
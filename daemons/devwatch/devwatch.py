@@ -1,12 +1,21 @@
-import json
 import logging
 import pyudev
 import os.path
-import socket
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Dict
 import daemons.abc
+from daemons import journal, metrics, rpc
 from .mount import mount, umount
 
+ACTIVE_DEVICES = metrics.REGISTRY.gauge("lectorium_active_devices", "Mounted devices not yet imported")
+
+def bus_of(device: pyudev.Device) -> str or None:
+    """sys_path of the hub a USB reader is plugged into: readers on one hub
+    share its bandwidth. None for other devices"""
+    usb_device = device.find_parent("usb", "usb_device")
+    if usb_device is None or usb_device.parent is None:
+        return None
+    return usb_device.parent.sys_path
 
 class DevwatchRequestHandler(daemons.abc.DispatchedRequestHandler):
     mesg_dispatcher = daemons.abc.DispatchedRequestHandler.mesg_dispatcher
@@ -22,23 +31,42 @@ class DevwatchRequestHandler(daemons.abc.DispatchedRequestHandler):
             logging.info("import finished: device=%s mountpoint=%s", device, mountpoint)
             del self.server.daemon.active_devices[device]
             umount(mountpoint)
+            self.server.daemon.journal.record(device, journal.REPORTED)
         else:
             self.error("Device not active")
 
+def resume_from_journal(daemon, import_queue):
+    """Devices journaled as importing are imported again if still mounted:
+    the importer skips what it has already done"""
+    for device, entry in daemon.journal.unfinished().items():
+        mountpoint = entry.data["path"]
+        if not os.path.ismount(mountpoint):
+            logging.warning("journaled device is gone: device=%s mountpoint=%s", device, mountpoint)
+            daemon.journal.record(device, journal.FAILED)
+            continue
+        logging.info("resuming import: device=%s mountpoint=%s", device, mountpoint)
+        daemon.active_devices[device] = mountpoint
+        import_queue.put(entry.data)
+
 class DevwatchExecutor(daemons.abc.BaseLoopExecutor):
     action_dispatcher = daemons.abc.HandlerDispatcher()
 
     def __init__(self, context: pyudev.Context,
                  daemon, import_queue,
                  udev_filter=None,
-                 event_filter: Callable[[pyudev.Device], bool] = None):
+                 event_filter: Callable[[pyudev.Device], bool] = None,
+                 workers=4):
+        """Devices are mounted and checked by up to `workers` threads, so that
+        a slow card does not hold back udev events of others"""
         self.monitor = pyudev.Monitor.from_netlink(context)
         if udev_filter:
             self.monitor.filter_by(udev_filter)
         self.event_filter = event_filter
         self.daemon = daemon
         self.daemon.active_devices = {}
+        ACTIVE_DEVICES.set_function(lambda: len(self.daemon.active_devices))
         self.import_queue = import_queue
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="devwatch")
         super(DevwatchExecutor, self).__init__(self.event_poll, BlockingIOError)
 
     def handle_event(self, event):
@@ -60,15 +88,23 @@ class DevwatchExecutor(daemons.abc.BaseLoopExecutor):
 
     @action_dispatcher.add_handler("add")
     def on_add(self, event):
-        mountpoint = mount(event)
-        if mountpoint:
-            content = self._guess_content(mountpoint)
-            logging.info("device=%s mountpoint=%s content=%s", event.sys_path, mountpoint, content)
-            if content:
-                self.daemon.active_devices[event.sys_path] = mountpoint
-                self.import_queue.put({"path": mountpoint, "content": content})
-            else:
-                umount(mountpoint)
+        self._pool.submit(self._attach, event)
+
+    def _attach(self, event):
+        try:
+            mountpoint = mount(event)
+            if mountpoint:
+                content = self._guess_content(mountpoint)
+                logging.info("device=%s mountpoint=%s content=%s", event.sys_path, mountpoint, content)
+                if content:
+                    self.daemon.active_devices[event.sys_path] = mountpoint
+                    job = {"path": mountpoint, "content": content, "bus": bus_of(event)}
+                    self.daemon.journal.record(event.sys_path, journal.QUEUED, **job)
+                    self.import_queue.put(job)
+                else:
+                    umount(mountpoint)
+        except Exception as e:
+            logging.exception(e)
 
     @action_dispatcher.add_handler("remove")
     def on_remove(self, event):
@@ -77,12 +113,17 @@ class DevwatchExecutor(daemons.abc.BaseLoopExecutor):
             logging.warning("active device removed: device=%s mountpoint=%s", event.sys_path, mountpoint)
             umount(mountpoint)
             del self.daemon.active_devices[event.sys_path]
+            self.daemon.journal.record(event.sys_path, journal.FAILED)
 
     def _guess_content(self, path: str) -> str or None:
         if os.path.isdir(os.path.join(path, "PRIVATE", "AVCHD", "BDMV", "STREAM")):
             return "video_sony"
         return None
 
+    def shutdown(self):
+        super(DevwatchExecutor, self).shutdown()
+        self._pool.shutdown(wait=True)
+
 class ImportExecutor(daemons.abc.BaseQueueExecutor):
     def __init__(self, job_queue, importer_address):
         super(ImportExecutor, self).__init__(job_queue)
@@ -93,16 +134,12 @@ class ImportExecutor(daemons.abc.BaseQueueExecutor):
             "message_type": "import_request",
             "message": {
                 "path": job["path"],
-                "content": job["content"]
+                "content": job["content"],
+                "bus": job.get("bus")
             }
         }
-        with socket.create_connection(self.importer_address) as sock:
-            with sock.makefile(mode="w") as sock_w:
-                json.dump(request, sock_w)
-            sock.shutdown(socket.SHUT_WR)
-            with sock.makefile(mode="r") as sock_r:
-                try:
-                    response = json.load(sock_r)
-                    logging.info("importer response: %s", response)
-                except Exception as e:
-                    logging.exception(e)
+        try:
+            response = rpc.get_channel(self.importer_address).call(request)
+            logging.info("importer response: %s", response)
+        except Exception as e:
+            logging.exception(e)
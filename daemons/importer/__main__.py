@@ -2,21 +2,34 @@ import argparse
 import logging
 import os
 import signal
-import socketserver
+import threading
+from concat_ng.catalog import RecordingCatalog
+from concat_ng.probe_cache import ProbeCache
 from config import Config
-from daemons.abc import JobQueueDaemon
+from daemons.abc import JobQueueDaemon, ThreadingTCPServer
+from daemons.aio import AsyncJobQueueDaemon, AsyncTCPServer
+from daemons.journal import Journal
+from daemons.metrics import REGISTRY, MetricsServer
 from gdrive_client import GDriveClient
-from .importer import ImportExecutor, UploadExecutor, ImportRequestHandler
+from .dispatch import TranscoderHealthPoller, TranscoderPool
+from .importer import BusLimiter, ImportExecutor, RemoteTranscodeExecutor, UploadExecutor, StreamUploadExecutor, ImportRequestHandler, resume_from_journal
+from .staging import Stager
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Search directories for sources, distribute preprocessing, upload result")
     parser.add_argument("--output-dir", required=True, help="Path to output directory")
-    parser.add_argument("--transcoder", required=True, help="Transcoder daemon address")
+    parser.add_argument("--transcoder", required=True, help="Transcoder daemon address(es), comma-separated")
+    parser.add_argument("--transcoder-data", required=False, help="Remote transcoder data address, sources are shipped there")
+    parser.add_argument("--remote-streams", required=False, type=int, default=2, help="Concurrent remote transcode transfers")
     parser.add_argument("--devwatch", required=True, help="Devwatch daemon address")
     parser.add_argument("--bind", required=False, default="127.0.0.1:1338", help="Bind address")
     parser.add_argument("--config", required=False, default="config.json", help="Path to configuration")
     parser.add_argument("--gdrive-root", required=False, default="root", help="Root directory for uploads")
+    parser.add_argument("--runtime", required=False, choices=["threads", "asyncio"], default="threads",
+                        help="Request serving and queue runtime")
+    parser.add_argument("--journal", required=False, help="Path to job journal, unfinished jobs resume after restart (default - in memory)")
+    parser.add_argument("--metrics-bind", required=False, help="Bind address for Prometheus metrics (default - disabled)")
     parser.add_argument("--logfile", required=False, help="Path to log file (default - stderr)")
     return parser.parse_args()
 
@@ -26,21 +39,61 @@ def to_addr(url):
 
 def main(args, gdrive_client):
     bind_addr = to_addr(args.bind)
-    transcoder_addr = to_addr(args.transcoder)
+    transcoders = TranscoderPool([to_addr(url) for url in args.transcoder.split(",")])
     devwatch_addr = to_addr(args.devwatch)
     
-    daemon = JobQueueDaemon(["q_import", "q_upload"])
+    if args.runtime == "asyncio":
+        daemon_cls, server_cls = AsyncJobQueueDaemon, AsyncTCPServer
+    else:
+        daemon_cls, server_cls = JobQueueDaemon, ThreadingTCPServer
+    daemon = daemon_cls(["q_import", "q_upload", "q_proxy_upload", "q_stream_upload", "q_remote_transcode"],
+                        Config.queue_disciplines)
     daemon.active_imports = {}
     daemon.active_transcodes = {}
-    daemon.add_executor("q_import", ImportExecutor, args.output_dir,
-                        transcoder_addr, daemon)
+    daemon.failed_imports = set()  # import keys with a job not imported
+    daemon.imports_lock = threading.Lock()
+    daemon.bus_limiter = BusLimiter(Config.ingest_per_bus)
+    daemon.probe_cache = ProbeCache(Config.probe_cache_path, Config.probe_cache_size)
+    daemon.catalog = RecordingCatalog(Config.catalog_path)
+    daemon.journal = Journal(args.journal)
+    daemon.stream_uploads = {}
+    daemon.transcode_progress = {}  # output base -> last transcode_progress message
+    daemon.remote_folders = {}  # output base -> Drive folder id, see ImportExecutor
+    daemon.transcoders = transcoders
+    daemon.stager = None
+    if Config.staging_dir:
+        daemon.stager = Stager(Config.staging_dir, Config.staging_verify, Config.staging_samples)
+    REGISTRY.gauge("lectorium_active_imports", "Imports with unfinished groups").set_function(
+        lambda: len(daemon.active_imports))
+    REGISTRY.gauge("lectorium_active_transcodes", "Groups not yet uploaded").set_function(
+        lambda: len(daemon.active_transcodes))
+    daemon.add_executor(None, TranscoderHealthPoller, transcoders)
+    remote_queue = None
+    if args.transcoder_data:
+        remote_queue = daemon.job_queues["q_remote_transcode"]
+        for _ in range(args.remote_streams):
+            daemon.add_executor("q_remote_transcode", RemoteTranscodeExecutor,
+                                to_addr(args.transcoder_data), daemon)
+    for _ in range(Config.ingest_workers):
+        daemon.add_executor("q_import", ImportExecutor, args.output_dir,
+                            transcoders, daemon, gdrive_client, args.gdrive_root,
+                            remote_queue, devwatch_addr)
     daemon.add_executor("q_upload", UploadExecutor, gdrive_client,
                         args.gdrive_root, args.output_dir, devwatch_addr,
                         daemon)
-    daemon.add_server(socketserver.TCPServer(bind_addr, ImportRequestHandler))
+    daemon.add_executor("q_proxy_upload", UploadExecutor, gdrive_client,
+                        args.gdrive_root, args.output_dir, devwatch_addr,
+                        daemon)
+    daemon.add_executor("q_stream_upload", StreamUploadExecutor, gdrive_client,
+                        args.gdrive_root, args.output_dir, devwatch_addr,
+                        daemon)
+    daemon.add_server(server_cls(bind_addr, ImportRequestHandler))
+    if args.metrics_bind:
+        daemon.add_server(MetricsServer(to_addr(args.metrics_bind)))
     
     daemon.start()
     logging.info("Started")
+    resume_from_journal(daemon, remote_queue)
     try:
         sig = signal.sigwaitinfo({signal.SIGINT}) # TODO handle sigterm
     except KeyboardInterrupt:
@@ -49,6 +102,7 @@ def main(args, gdrive_client):
         sig = signal.Signals(sig.si_signo)
         logging.info("Shutting down after %s", sig.name)
         daemon.shutdown()
+        daemon.journal.close()
 
 if __name__ == '__main__':
     args  = parse_args()
@@ -0,0 +1,193 @@
+"""Placement of transcode jobs across several transcoder daemons.
+
+Every node is polled for {"message_type": "status"}. A job goes to the
+healthy node with the least load per unit of CPU budget; load is the
+larger of what the node reported and what this importer has in flight
+there. After `failure_threshold` unanswered polls a node is marked down.
+
+A job is placed on another node only once its node confirmed it does not
+hold the job ({"message_type": "jobs"}), so two transcoders never write the
+same outputs. Jobs whose placement is unknown (the request timed out, the
+node went down) stay with their node, marked unconfirmed, until it answers.
+All in-flight jobs of a node are checked the same way every
+`reconcile_interval` seconds, and whenever it reports fewer jobs than are
+in flight there: a job it lost (e.g. dropped on a restart) goes elsewhere.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional
+from daemons import rpc
+from daemons.abc import BaseLoopExecutor
+
+
+class TranscoderNode:
+    def __init__(self, address):
+        self.address = address
+        self.healthy = True  # until proven otherwise
+        self.failures = 0
+        self.status = {}
+        self.in_flight = {}  # output base -> job
+        self.unconfirmed = set()  # in-flight outputs the node may or may not hold
+        self.reconciled_at = time.monotonic()
+
+    def reported(self) -> int:
+        return self.status.get("queued", 0) + self.status.get("running", 0)
+
+    def load(self) -> float:
+        capacity = self.status.get("cpu_budget") or 1.0
+        return max(self.reported(), len(self.in_flight)) / capacity
+
+    def __repr__(self):
+        host, port = self.address
+        return f"{host}:{port}"
+
+class TranscoderPool:
+    def __init__(self, addresses: List, rpc_timeout=5.0, failure_threshold=3, reconcile_interval=60.0):
+        self.nodes = [TranscoderNode(tuple(address)) for address in addresses]
+        self.rpc_timeout = rpc_timeout
+        self.failure_threshold = failure_threshold
+        self.reconcile_interval = reconcile_interval
+        self.backlog = []  # jobs waiting for any healthy node
+        self._submitting = set()  # not re-placed by a concurrent failure
+        self._lock = threading.Lock()
+
+    def submit(self, job: Dict):
+        """Sends job to the least loaded healthy node, keeps it in the
+        backlog if no node answers. A discarded job is not placed anywhere
+        else, the same request would fail there too"""
+        tried = set()
+        while True:
+            with self._lock:
+                candidates = [node for node in self.nodes if node.healthy and node not in tried]
+                if not candidates:
+                    logging.warning("No transcoder available, job deferred: %s", job["output"])
+                    self.backlog.append(job)
+                    return
+                node = min(candidates, key=TranscoderNode.load)
+                node.in_flight[job["output"]] = job  # before the result can arrive
+                self._submitting.add(job["output"])
+            tried.add(node)
+            try:
+                response = rpc.get_channel(node.address).call([job], timeout=self.rpc_timeout)
+            except (OSError, FutureTimeoutError) as e:
+                logging.warning("Transcoder %s: request failed: %s", node, e)
+                with self._lock:
+                    node.unconfirmed.add(job["output"])
+                self._record_failure(node)
+                if self._reconcile(node, [job["output"]]) is None:
+                    logging.warning("Transcoder %s: may hold %s, not placing it elsewhere", node, job["output"])
+                    return
+                with self._lock:
+                    if job["output"] in node.in_flight:
+                        logging.info("Transcoder %s: placed %s despite the error", node, job["output"])
+                        return
+                continue
+            finally:
+                with self._lock:
+                    self._submitting.discard(job["output"])
+            if response.get("error") or response.get("result", {}).get("discard"):
+                logging.error("Transcoder %s: job discarded: %s %s", node, job["output"], response)
+                with self._lock:
+                    node.in_flight.pop(job["output"], None)
+                return
+            logging.info("Transcoder %s: placed %s (load %.2f)", node, job["output"], node.load())
+            return
+
+    def complete(self, output_base) -> bool:
+        """Return value: False if the job is unknown, e.g. resumed from the
+        journal and not placed by this pool"""
+        with self._lock:
+            for node in self.nodes:
+                node.unconfirmed.discard(output_base)
+                if node.in_flight.pop(output_base, None) is not None:
+                    return True
+        return False
+
+    def _reconcile(self, node: TranscoderNode, outputs) -> Optional[List[Dict]]:
+        """Asks node which of outputs it holds, the rest are taken off it.
+        Return value: jobs taken off, None if node did not answer"""
+        try:
+            response = rpc.get_channel(node.address).call(
+                {"message_type": "jobs", "outputs": list(outputs)}, timeout=self.rpc_timeout)
+            states = response["result"]
+        except (OSError, FutureTimeoutError, KeyError, TypeError) as e:
+            logging.warning("Transcoder %s: cannot query jobs: %s", node, e)
+            return None
+        orphans = []
+        with self._lock:
+            for output in outputs:
+                node.unconfirmed.discard(output)
+                if states.get(output) is None and output in node.in_flight:
+                    orphans.append(node.in_flight.pop(output))
+        return orphans
+
+    def poll(self):
+        for node in self.nodes:
+            try:
+                response = rpc.get_channel(node.address).call(
+                    {"message_type": "status"}, timeout=self.rpc_timeout)
+            except (OSError, FutureTimeoutError) as e:
+                logging.debug("Transcoder %s: status failed: %s", node, e)
+                self._record_failure(node)
+                continue
+            with self._lock:
+                node.status = response.get("result", {})
+                node.failures = 0
+                if not node.healthy:
+                    logging.info("Transcoder %s: back online", node)
+                node.healthy = True
+                now = time.monotonic()
+                if (node.reported() < len(node.in_flight)
+                        or now - node.reconciled_at >= self.reconcile_interval):
+                    node.reconciled_at = now
+                    suspects = set(node.in_flight) | node.unconfirmed
+                else:
+                    suspects = node.unconfirmed
+                outputs = [output for output in suspects if output not in self._submitting]
+            if outputs:
+                orphans = self._reconcile(node, outputs) or []
+                if orphans:
+                    logging.warning("Transcoder %s: does not hold %d jobs, placing again", node, len(orphans))
+                with self._lock:
+                    self.backlog.extend(orphans)
+        with self._lock:
+            backlog, self.backlog = self.backlog, []
+        for job in backlog:
+            self.submit(job)
+
+    def _record_failure(self, node: TranscoderNode):
+        """A node marked down keeps its jobs until it tells which it holds"""
+        with self._lock:
+            node.failures += 1
+            if not node.healthy or node.failures < self.failure_threshold:
+                return
+            node.healthy = False
+            node.unconfirmed.update(node.in_flight)
+        logging.error("Transcoder %s: not answering, %d jobs wait for it", node, len(node.in_flight))
+
+    def describe(self) -> List[Dict]:
+        with self._lock:
+            return [{"address": f"{node}", "healthy": node.healthy, "load": node.load(),
+                     "in_flight": len(node.in_flight), "unconfirmed": len(node.unconfirmed),
+                     "eta": node.status.get("eta")}
+                    for node in self.nodes]
+
+class TranscoderHealthPoller(BaseLoopExecutor):
+    """Polls TranscoderPool nodes every poll_interval seconds"""
+
+    def __init__(self, pool: TranscoderPool, poll_interval=2.0):
+        super(TranscoderHealthPoller, self).__init__(self._tick, poll_interval=poll_interval)
+        self.pool = pool
+        self._polled = False
+
+    def _tick(self, timeout):
+        if self._polled:
+            time.sleep(timeout)
+        self._polled = True
+        return time.monotonic()
+
+    def handle_event(self, event):
+        self.pool.poll()
@@ -1,109 +1,497 @@
-import json
 import logging
 import os
-import socket
 import socketserver
-from concat_ng.tasks import into_tasks
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+from concat_ng.probe import get_stream_info
+from concat_ng.tasks import catalog_destination, into_tasks
 from config import Config
 import daemons.abc
+from daemons import journal, metrics, rpc
+from daemons.transcoder.remote import run_remote
+from transcode_v2 import TranscodeError, is_append_only, select_profile
+from .staging import StagingError
+
+UPLOADED_BYTES = metrics.REGISTRY.counter("lectorium_upload_bytes_total", "Bytes uploaded to Drive", ("mode",))
+UPLOAD_TIME = metrics.REGISTRY.histogram("lectorium_upload_seconds", "Upload time of one transcode job's outputs", ("mode",))
+PROXY_NAME = "proxy"  # output base of a group's proxy, next to its full output
+
+PROFILE_DECISIONS = metrics.REGISTRY.counter(
+    "lectorium_profile_decisions_video_seconds_total", "Source seconds by requested and chosen profile",
+    ("requested", "profile"))
 
 class ImportRequestHandler(daemons.abc.DispatchedRequestHandler):
     mesg_dispatcher = daemons.abc.DispatchedRequestHandler.mesg_dispatcher
 
     @mesg_dispatcher.add_handler("import_request")
     def handle_import_request(self):
-        sd_root = self.request_obj["message"]["path"]
-        self.server.daemon.job_queues["q_import"].put(sd_root)
+        message = self.request_obj["message"]
+        self.server.daemon.job_queues["q_import"].put({"path": message["path"], "bus": message.get("bus")})
+
+    @mesg_dispatcher.add_handler("transcode_started")
+    def handle_transcode_started(self):
+        base = self.request_obj["message"]["output_base"]
+        outputs = self.request_obj["message"]["outputs"]
+        logging.info("Transcode started, streaming upload: %s", base)
+        exitcode = Future()
+        self.server.daemon.stream_uploads[base] = exitcode
+        self.server.daemon.job_queues["q_stream_upload"].put((base, outputs, exitcode))
+
+    @mesg_dispatcher.add_handler("transcode_progress")
+    def handle_transcode_progress(self):
+        progress = self.request_obj["message"]
+        self.server.daemon.transcode_progress[progress["output_base"]] = progress
+        logging.info("Transcode progress: %s out_time=%.1f speed=%s eta=%.0f s",
+                     progress["output_base"], progress["out_time"], progress["speed"], progress["eta"])
 
     @mesg_dispatcher.add_handler("transcode_result")
     def handle_transcode_result(self):
         base = self.request_obj["message"]["output_base"]
         outputs = self.request_obj["message"]["outputs"]
-        logging.info("Transcode finished: %s", base)
-        self.server.daemon.job_queues["q_upload"].put((base, outputs))
+        exitcode = self.request_obj["message"].get("exitcode", 0)
+        if exitcode is None:
+            logging.error("Transcode failed to run: %s", base)
+        logging.info("Transcode finished: %s exitcode=%s cache=%s", base, exitcode,
+                     self.request_obj["message"].get("cache"))
+        self.server.daemon.transcode_progress.pop(base, None)
+        placed = self.server.daemon.transcoders.complete(base)
+        entry = self.server.daemon.journal.get(base)
+        if not placed and (entry is None or "exitcode" in entry.data):
+            logging.warning("Ignoring result of a job placed elsewhere: %s", base)
+            return
+        self.server.daemon.journal.record(base, journal.TRANSCODED, outputs=outputs, exitcode=exitcode)
+        stream_exitcode = self.server.daemon.stream_uploads.pop(base, None)
+        if stream_exitcode:
+            stream_exitcode.set_result(exitcode)
+        else:
+            upload_queue(self.server.daemon.job_queues, base).put((base, outputs, exitcode))
+
+def upload_queue(job_queues, base):
+    """Proxies have their own upload queue, so they are not held up by full outputs"""
+    return job_queues["q_proxy_upload" if os.path.basename(base) == PROXY_NAME else "q_upload"]
+
+def resume_from_journal(daemon, remote_queue=None):
+    """Rebuilds active imports from daemon.journal, call once the server is
+    up. Finished transcodes go to upload (uploaded ones are only reported),
+    others are placed again: a transcoder still running one accepts it
+    without starting over. Their results are accepted though the pool did
+    not place them"""
+    entries = daemon.journal.unfinished()
+    with daemon.imports_lock:
+        for base, entry in entries.items():
+            import_key = entry.data["import_key"]
+            daemon.active_transcodes[base] = import_key
+            daemon.active_imports[import_key] = daemon.active_imports.get(import_key, 0) + 1
+    for base, entry in entries.items():
+        logging.info("Resuming %s job: %s", entry.state, base)
+        if "exitcode" in entry.data:
+            upload_queue(daemon.job_queues, base).put((base, entry.data["outputs"], entry.data["exitcode"]))
+        elif remote_queue is not None:
+            remote_queue.put(entry.data["job"])
+        else:
+            daemon.transcoders.submit(entry.data["job"])
+
+def report_import_finish(report_addr, sd_root):
+    """Tells devwatch the card is no longer needed"""
+    message = {
+        "message_type": "import_result",
+        "message": {"path": sd_root}
+    }
+    ans = rpc.get_channel(report_addr).call(message)
+    logging.info("Devwatch response: %s", ans)
+
+class BusLimiter:
+    """At most `per_bus` cards are read at once through readers on one bus"""
+
+    def __init__(self, per_bus=1):
+        self.per_bus = per_bus
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, bus):
+        with self._lock:
+            semaphore = self._semaphores.setdefault(bus, threading.BoundedSemaphore(self.per_bus))
+        if not semaphore.acquire(blocking=False):
+            logging.info("waiting for bus: %s", bus)
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
 
 class ImportExecutor(daemons.abc.BaseQueueExecutor):
-    def __init__(self, job_queue, output_dir, transcoder_address, daemon):
+    def __init__(self, job_queue, output_dir, transcoders, daemon,
+                 gdrive_client=None, remote_root_id=None, remote_queue=None,
+                 report_addr=None):
+        """transcoders: dispatch.TranscoderPool, each group is placed separately.
+        With gdrive_client, remote folders of the whole import are created
+        in advance with batched requests, their ids are kept in
+        daemon.remote_folders for the upload executors.
+        With remote_queue, jobs go there (see RemoteTranscodeExecutor) instead
+        of the transcoders.
+        With daemon.stager, sources are staged first and the card is
+        released to report_addr right away (see staging.Stager); the import
+        is then tracked by its staging dir.
+        Several executors may share daemon's state: cards are read under
+        daemon.bus_limiter, active imports change under daemon.imports_lock.
+        Jobs are journaled in daemon.journal from the moment they are queued.
+        With Config.ff_auto_remux, every group's first recording is probed
+        and the profile's remux rule may pick stream copy instead (see
+        transcode_v2.select_profile), the job's "decision" tells why"""
         super(ImportExecutor, self).__init__(job_queue)
         self.output_dir = output_dir
-        self.transcoder_addr = transcoder_address
+        self.transcoders = transcoders
+        self.remote_queue = remote_queue
+        self.gdrive_client = gdrive_client
+        self.remote_root_id = remote_root_id
+        self.report_addr = report_addr
+        self.stager = daemon.stager
+        self.bus_limiter = daemon.bus_limiter
+        self.imports_lock = daemon.imports_lock
         self.active_imports = daemon.active_imports
         self.active_transcodes = daemon.active_transcodes
+        self.probe_cache = daemon.probe_cache
+        self.catalog = daemon.catalog
+        self.journal = daemon.journal
+        self.remote_folders = daemon.remote_folders
 
-    def handle_job(self, sd_root: str):
-        concat_tasks = into_tasks(sd_root, self.output_dir)
-        if sd_root in self.active_imports:
-            raise KeyError(f"import already in progress: from={sd_root}")
-        self.active_imports[sd_root] = 0
-        transcode_request = []
-        for task in concat_tasks:
-            old_from = self.active_transcodes.get(task.destination)
-            if old_from:
-                logging.warning(
-                    "transcode already in progress: from=%s old_from=%s output_file=%s",
-                    sd_root, old_from, task.destination)
-                continue
-            self.active_transcodes[task.destination] = sd_root
-            self.active_imports[sd_root] += 1
-            os.makedirs(os.path.dirname(task.destination), exist_ok=True)
-            transcode_request.append({
-                "inputs": [[f.path for f in task.sources]],
+    def handle_job(self, job: Dict):
+        """job: {"path": card root, "bus": reader's bus or None (not limited)}"""
+        sd_root = job["path"]
+        with self.imports_lock:
+            if sd_root in self.active_imports:
+                raise KeyError(f"import already in progress: from={sd_root}")
+            self.active_imports[sd_root] = 0  # claimed while the card is read
+        new_tasks = []
+        try:
+            with self.bus_limiter.hold(job.get("bus") or sd_root):
+                concat_tasks = into_tasks(sd_root, self.output_dir,
+                                          self.probe_cache, Config.probe_workers, self.catalog)
+                new_tasks = self._claim_tasks(sd_root, concat_tasks)
+                decisions = {task.destination: self._decide(sd_root, task) for task in new_tasks}
+                import_key, sources = self._stage(sd_root, new_tasks)
+        except BaseException:
+            with self.imports_lock:
+                del self.active_imports[sd_root]
+                for task in new_tasks:
+                    self.active_transcodes.pop(task.destination, None)
+            raise
+        transcode_request = self._make_jobs(new_tasks, sources, decisions)
+        with self.imports_lock:
+            del self.active_imports[sd_root]
+            if transcode_request:
+                self.active_imports[import_key] = len(transcode_request)
+            for job in transcode_request:
+                self.active_transcodes[job["output"]] = import_key
+        if not transcode_request:
+            logging.info("nothing to import: from=%s", sd_root)
+            if self.report_addr:
+                report_import_finish(self.report_addr, sd_root)
+            return
+        for job in transcode_request:
+            os.makedirs(os.path.dirname(job["output"]), exist_ok=True)
+            self.journal.record(job["output"], journal.QUEUED, job=job, card=sd_root, import_key=import_key)
+        self._prepare_remote_dirs([job["output"] for job in transcode_request])
+        if self.remote_queue is not None:
+            for job in transcode_request:
+                self.remote_queue.put(job)
+        else:
+            self._send_transcode_request(transcode_request)
+
+    def _make_jobs(self, tasks, sources, decisions) -> List[Dict]:
+        """With Config.proxy_profile, proxy jobs of all groups come first, at
+        a higher priority, their output base is PROXY_NAME in the group dir"""
+        jobs, proxies = [], []
+        for task in tasks:
+            inputs = [[sources.get(f.path, f.path) for f in task.sources]]
+            size = sum(f.duration for f in task.sources)
+            jobs.append({
+                "inputs": inputs,
                 "output": task.destination,
-                "profile": Config.ff_default_profile
+                "profile": decisions[task.destination]["profile"],
+                "decision": decisions[task.destination],
+                "segments": Config.ff_segments,
+                "stream_upload": Config.ff_stream_upload,
+                "priority": 0,
+                "size": size
             })
-        self._send_transcode_request(transcode_request)
+            if Config.proxy_profile:
+                proxies.append({
+                    "inputs": inputs,
+                    "output": os.path.join(os.path.dirname(task.destination), PROXY_NAME),
+                    "profile": Config.proxy_profile,
+                    "priority": Config.proxy_priority,
+                    "size": size
+                })
+        return proxies + jobs
+
+    def _claim_tasks(self, sd_root, concat_tasks):
+        """Skips groups another import is transcoding"""
+        new_tasks = []
+        with self.imports_lock:
+            for task in concat_tasks:
+                old_from = self.active_transcodes.get(task.destination)
+                if old_from:
+                    logging.warning(
+                        "transcode already in progress: from=%s old_from=%s output_file=%s",
+                        sd_root, old_from, task.destination)
+                    continue
+                self.active_transcodes[task.destination] = sd_root
+                new_tasks.append(task)
+        return new_tasks
+
+    def _decide(self, sd_root, task) -> Dict:
+        requested = Config.ff_default_profile
+        decision = {"requested": requested, "profile": requested, "reason": "auto_remux is off"}
+        if Config.ff_auto_remux:
+            try:
+                streams = get_stream_info(task.sources[0].path, sd_root, self.probe_cache)
+                profile, reason = select_profile(requested, streams)
+            except (OSError, ValueError, subprocess.CalledProcessError, TranscodeError) as e:
+                logging.warning("cannot choose profile, keeping %s: %s", requested, e)
+                profile, reason, streams = requested, f"not decided: {e}", None
+            decision.update(profile=profile, reason=reason, streams=streams)
+        PROFILE_DECISIONS.inc(sum(f.duration for f in task.sources), requested=requested, profile=decision["profile"])
+        logging.info("profile for %s: %s (%s)", task.destination, decision["profile"], decision["reason"])
+        return decision
+
+    def _stage(self, sd_root, tasks):
+        """Return value: (import key, source path -> path to transcode from)"""
+        if self.stager is None or not tasks:
+            return sd_root, {}
+        try:
+            card_dir, staged = self.stager.stage(sd_root, [f.path for task in tasks for f in task.sources])
+        except (OSError, StagingError) as e:
+            logging.error("staging failed, transcoding from the card: %s", e)
+            return sd_root, {}
+        report_import_finish(self.report_addr, sd_root)
+        return card_dir, staged
+
+    def _prepare_remote_dirs(self, output_bases):
+        """Before the transcodes start, so that no upload has to look its folder up"""
+        if self.gdrive_client is None or not output_bases:
+            return
+        local_dirs = sorted({os.path.dirname(base) for base in output_bases})
+        try:
+            folder_ids = self.gdrive_client.makedirs_many(local_dirs, self.output_dir, self.remote_root_id)
+        except Exception as e:
+            logging.exception(e)
+            return
+        logging.info("remote folders ready: %s", folder_ids)
+        for base in output_bases:
+            self.remote_folders[base] = folder_ids[os.path.dirname(base)]
 
     def _send_transcode_request(self, transcode_request):
-        with socket.create_connection(self.transcoder_addr) as sock:
-            with sock.makefile(mode="w") as sock_w:
-                json.dump(transcode_request, sock_w)
-            sock.shutdown(socket.SHUT_WR)
-            with sock.makefile(mode="r") as sock_r:
-                response = json.load(sock_r)
+        for job in transcode_request:
+            self.transcoders.submit(job)
+            self.journal.record(job["output"], journal.TRANSCODING)
+        logging.info("transcoders: %s", self.transcoders.describe())
+
+class RemoteTranscodeExecutor(daemons.abc.BaseQueueExecutor):
+    """Ships a job's sources to a transcoder's data port and receives the
+    sinks into the output dir. Add several to keep more transfers in flight.
+    A failed transfer is retried up to `retries` times; after that, or if
+    the transcoder refuses the job, it is journaled as failed and its import
+    stays open (the card is not reported finished)."""
+
+    def __init__(self, job_queue, data_address, daemon, retries=3):
+        super(RemoteTranscodeExecutor, self).__init__(job_queue)
+        self.data_address = data_address
+        self.retries = retries
+        self.job_queues = daemon.job_queues
+        self.journal = daemon.journal
+
+    def handle_job(self, job):
+        if job.get("stream_upload"):
+            logging.warning("remote transcode: stream_upload is not supported, uploading after: %s", job["output"])
+        self.journal.record(job["output"], journal.TRANSCODING)
+        retries = 0
+        while True:
+            try:
+                exitcode, outputs = run_remote(self.data_address, job)
+                break
+            except Exception as e:
+                logging.exception(e)
+                if isinstance(e, TranscodeError) or retries >= self.retries:
+                    logging.error("Remote transcode failed, import stays open: %s", job["output"])
+                    self.journal.record(job["output"], journal.FAILED, error=f"{e}")
+                    return
+                delay = min(2 ** retries, 30)
+                retries += 1
+                logging.warning("Remote transcode: retry %d in %ds: %s", retries, delay, job["output"])
+                time.sleep(delay)
+        logging.info("Remote transcode finished: %s exitcode=%s", job["output"], exitcode)
+        self.journal.record(job["output"], journal.TRANSCODED, outputs=outputs, exitcode=exitcode)
+        upload_queue(self.job_queues, job["output"]).put((job["output"], outputs, exitcode))
 
 class UploadExecutor(daemons.abc.BaseQueueExecutor):
+    """Groups transcoded and uploaded in full are marked done in
+    daemon.catalog, re-imports skip them. A staged copy is removed once its
+    import finishes, unless a job of it failed: the card was released after
+    staging, so the copy is the only one left. A job journaled as uploaded
+    before a restart is only reported. Remote folders come from
+    daemon.remote_folders (see ImportExecutor), looked up if missing"""
+
     def __init__(self, job_queue, gdrive_client, remote_root_id, sources_root, report_addr, daemon):
         super(UploadExecutor, self).__init__(job_queue)
         self.gdrive_client = gdrive_client
         self.remote_root_id = remote_root_id
         self.sources_root = sources_root
         self.report_addr = report_addr
+        self.stager = daemon.stager
+        self.imports_lock = daemon.imports_lock
         self.active_imports = daemon.active_imports
         self.active_transcodes = daemon.active_transcodes
+        self.failed_imports = daemon.failed_imports
+        self.catalog = daemon.catalog
+        self.journal = daemon.journal
+        self.remote_folders = daemon.remote_folders
+
+    def _remote_folder(self, base_path) -> str:
+        folder_id = self.remote_folders.get(base_path)
+        if folder_id is None:
+            folder_id = self.gdrive_client.makedirs(
+                os.path.dirname(base_path), self.sources_root, self.remote_root_id, exist_ok=True
+            )
+            self.remote_folders[base_path] = folder_id
+        return folder_id
 
     def handle_job(self, job):
-        base_path, outputs = job
-        local_dir = os.path.dirname(base_path)
-        folder_id = self.gdrive_client.makedirs(
-            local_dir, self.sources_root, self.remote_root_id, exist_ok=True
-        )
+        base_path, outputs, exitcode = job
+        entry = self.journal.get(base_path)
+        if entry is not None and entry.state == journal.UPLOADED:
+            self._unregister_transcode_job(base_path, entry.data["imported"])
+            return
+        if exitcode is None:
+            logging.error('upload: transcode did not run, nothing to upload: %s', base_path)
+            self.journal.record(base_path, journal.UPLOADED, imported=False)
+            self._unregister_transcode_job(base_path)
+            return
+        self.journal.record(base_path, journal.UPLOADING)
+        began = time.monotonic()
+        folder_id = self._remote_folder(base_path)
         logging.info('upload: local=%s remote=%s', base_path, folder_id)
-        self.gdrive_client.upload_files(
+        results = self.gdrive_client.upload_files(
             outputs, folder_id,
-            on_each=lambda path: logging.info("upload finished: local=%s", path),
-            on_progress=lambda progress: logging.info("upload progress: %s%%", 100 * progress.progress())
+            on_file_progress=self._file_progress_recorder("batch"),
+            on_total_progress=lambda progress: logging.info(
+                "upload progress: local=%s %.1f%% %.2f MB/s", base_path,
+                100 * progress.sent / max(progress.total, 1), progress.rate / 1e6)
         )
-        self._unregister_transcode_job(base_path)
+        UPLOAD_TIME.observe(time.monotonic() - began, mode="batch")
+        imported = exitcode == 0 and bool(outputs) and all(results.get(path) for path in outputs)
+        self.journal.record(base_path, journal.UPLOADED, imported=imported)
+        self._unregister_transcode_job(base_path, imported)
 
-    def _unregister_transcode_job(self, base_path):
-        sd_root = self.active_transcodes.pop(base_path)
-        if self.active_imports[sd_root] == 1:
-            del self.active_imports[sd_root]
-            self._report_import_finish(sd_root)
-        else:
-            self.active_imports[sd_root] -= 1
-        print('! ' + f'active_transcodes: {self.active_transcodes}')
-        print('! ' + f'active_imports: {self.active_imports}')
-    
-    def _report_import_finish(self, sd_root):
-        message = {
-            "message_type": "import_result",
-            "message": {"path": sd_root}
-        }
-        with socket.create_connection(self.report_addr) as sock:
-            with sock.makefile("w") as sock_w:
-                json.dump(message, sock_w)
-            sock.shutdown(socket.SHUT_WR)
-            with sock.makefile("r") as sock_r:
-                ans = json.load(sock_r)
-            logging.info("Devwatch response: %s", ans)
+    @staticmethod
+    def _file_progress_recorder(mode):
+        """on_progress callback counting uploaded bytes, progress is cumulative per file"""
+        sent = {}
+        lock = threading.Lock()
+
+        def on_progress(progress):
+            with lock:
+                delta = progress.sent - sent.get(progress.path, 0)
+                sent[progress.path] = progress.sent
+            if delta > 0:
+                UPLOADED_BYTES.inc(delta, mode=mode)
+            if progress.sent == progress.total:
+                logging.info("upload finished: local=%s %.2f MB/s", progress.path, progress.rate / 1e6)
+        return on_progress
+
+    def _unregister_transcode_job(self, base_path, imported=False):
+        if imported and os.path.basename(base_path) == PROXY_NAME:
+            logging.info("proxy published: %s", base_path)
+        elif imported:
+            self.catalog.complete(catalog_destination(base_path, self.sources_root))
+            self.catalog.save()
+        self.remote_folders.pop(base_path, None)
+        with self.imports_lock:
+            sd_root = self.active_transcodes.pop(base_path)
+            if not imported:
+                self.failed_imports.add(sd_root)
+            finished = self.active_imports[sd_root] == 1
+            failed = False
+            if finished:
+                del self.active_imports[sd_root]
+                failed = sd_root in self.failed_imports
+                self.failed_imports.discard(sd_root)
+            else:
+                self.active_imports[sd_root] -= 1
+        if finished and self.stager is not None and self.stager.owns(sd_root):
+            if failed:
+                logging.error("import had failed jobs, keeping staged sources: %s", sd_root)
+            else:
+                self.stager.release(sd_root)  # the card was released after staging
+        elif finished:
+            report_import_finish(self.report_addr, sd_root)
+        self.journal.record(base_path, journal.REPORTED)
+        logging.debug("active transcodes: %s", self.active_transcodes)
+        logging.debug("active imports: %s", self.active_imports)
+
+class StreamUploadExecutor(UploadExecutor):
+    """Uploads sinks while the transcoder is still writing them (see
+    GDriveClient.upload_growing_file). Every job streams in its own thread
+    until transcode_result resolves the job's exitcode future. Sinks which
+    are not append-only (see transcode_v2.is_append_only), or whose
+    streaming failed, are uploaded once the transcode succeeded."""
+
+    def __init__(self, *args, **kwargs):
+        super(StreamUploadExecutor, self).__init__(*args, **kwargs)
+        self._streams = {}
+        self._streams_lock = threading.Lock()
+
+    def handle_job(self, job):
+        base_path, outputs, exitcode = job
+        thread = threading.Thread(target=self._stream, args=(base_path, outputs, exitcode))
+        with self._streams_lock:
+            self._streams[base_path] = (thread, exitcode)
+        thread.start()
+
+    def _stream(self, base_path, outputs, exitcode):
+        try:
+            folder_id = self._remote_folder(base_path)
+            logging.info('streaming upload: local=%s remote=%s', base_path, folder_id)
+            self.journal.record(base_path, journal.UPLOADING)
+            began = time.monotonic()
+            on_progress = self._file_progress_recorder("stream")
+
+            def upload(path):
+                remote = self.gdrive_client.RemoteNode(os.path.basename(path), folder_id)
+                if is_append_only(path):
+                    result = self.gdrive_client.upload_growing_file(path, remote, exitcode, on_progress=on_progress)
+                    if result is not None or exitcode.result() != 0:
+                        return result
+                    logging.warning("streaming upload failed, uploading the finished file: %s", path)
+                if exitcode.result() != 0:
+                    return None
+                return self.gdrive_client.upload_file(path, remote, on_progress=on_progress)
+
+            with ThreadPoolExecutor(max_workers=len(outputs)) as pool:
+                results = list(pool.map(upload, outputs))
+            UPLOAD_TIME.observe(time.monotonic() - began, mode="stream")
+            for path, result in zip(outputs, results):
+                logging.info("streaming upload %s: local=%s",
+                             "finished" if result else "failed", path)
+            imported = bool(outputs) and all(results)
+            self.journal.record(base_path, journal.UPLOADED, imported=imported)
+            self._unregister_transcode_job(base_path, imported)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            with self._streams_lock:
+                self._streams.pop(base_path, None)
+
+    def shutdown(self):
+        super(StreamUploadExecutor, self).shutdown()
+        with self._streams_lock:
+            streams = list(self._streams.values())
+        for thread, exitcode in streams:
+            if not exitcode.done():
+                exitcode.set_result(None)  # aborts the upload
+            thread.join()
@@ -0,0 +1,163 @@
+"""Staging of card contents to local disk before transcoding.
+
+Sources are copied with large sequential reads (copy_file_range, else
+sendfile, else a buffered loop) and checked after dropping both copies from
+the page cache, so the check reads what actually reached the disks. Once a
+card is staged, the importer reports import_result and the card can be
+unmounted while its groups are still encoding.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from typing import Dict, List, Tuple
+from daemons import metrics
+
+
+COPY_CHUNK = 64 << 20
+BUFFER_SIZE = 8 << 20  # buffered fallback
+VERIFY_BLOCK = 1 << 20
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+STAGED_BYTES = metrics.REGISTRY.counter("lectorium_staged_bytes_total", "Bytes copied from cards to staging")
+STAGING_TIME = metrics.REGISTRY.histogram("lectorium_staging_seconds", "Copy and verification time of a card")
+
+
+class StagingError(Exception):
+    pass
+
+def _fadvise(fd, advice):
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except (AttributeError, OSError):
+        pass
+
+def _copy_file_range(fd_in, fd_out, size) -> int:
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(fd_in, fd_out, min(COPY_CHUNK, size - copied))
+        if not count:
+            break
+        copied += count
+    return copied
+
+def _sendfile(fd_in, fd_out, size) -> int:
+    copied = 0
+    while copied < size:
+        count = os.sendfile(fd_out, fd_in, None, min(COPY_CHUNK, size - copied))
+        if not count:
+            break
+        copied += count
+    return copied
+
+def _copy_buffered(fd_in, fd_out, size) -> int:
+    buffer = memoryview(bytearray(BUFFER_SIZE))
+    copied = 0
+    with open(fd_in, "rb", buffering=0, closefd=False) as src:
+        while copied < size:
+            count = src.readinto(buffer[:min(len(buffer), size - copied)])
+            if not count:
+                break
+            written = 0
+            while written < count:
+                written += os.write(fd_out, buffer[written:count])
+            copied += count
+    return copied
+
+def copy_file(src_path, dst_path) -> int:
+    """Copies through the file positions, so that a method failing as
+    unsupported is continued by the next one. Return value: bytes copied"""
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        fd_in, fd_out = src.fileno(), dst.fileno()
+        size = os.fstat(fd_in).st_size
+        _fadvise(fd_in, getattr(os, "POSIX_FADV_SEQUENTIAL", 2))
+        copied = 0
+        for method in (_copy_file_range, _sendfile, _copy_buffered):
+            try:
+                copied += method(fd_in, fd_out, size - copied)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                logging.debug("staging: %s unsupported (%s), falling back", method.__name__, e)
+                continue
+            break
+        os.fdatasync(fd_out)
+    return copied
+
+def verify_copy(src_path, dst_path, mode="sampled", samples=16) -> bool:
+    """mode: "size", "sampled" (`samples` blocks spread over the file,
+    first and last included) or "full" (crc32 of both)"""
+    size = os.path.getsize(src_path)
+    if os.path.getsize(dst_path) != size:
+        return False
+    if mode == "size" or size == 0:
+        return True
+    with open(src_path, "rb") as src, open(dst_path, "rb") as dst:
+        fds = (src.fileno(), dst.fileno())
+        for fd in fds:
+            _fadvise(fd, getattr(os, "POSIX_FADV_DONTNEED", 4))
+        if mode == "full":
+            crcs = []
+            for fd in fds:
+                crc, offset = 0, 0
+                while offset < size:
+                    block = os.pread(fd, COPY_CHUNK, offset)
+                    if not block:
+                        break
+                    crc = zlib.crc32(block, crc)
+                    offset += len(block)
+                crcs.append(crc)
+            return crcs[0] == crcs[1]
+        last = max(size - VERIFY_BLOCK, 0)
+        offsets = sorted({last * idx // max(samples - 1, 1) for idx in range(max(samples, 2))})
+        return all(os.pread(fds[0], VERIFY_BLOCK, offset) == os.pread(fds[1], VERIFY_BLOCK, offset)
+                   for offset in offsets)
+
+class Stager:
+    """Copies a card's sources into a fresh directory under staging_dir,
+    layout relative to the card root is kept"""
+
+    def __init__(self, staging_dir, verify="sampled", samples=16):
+        self.staging_dir = staging_dir
+        self.verify = verify
+        self.samples = samples
+        os.makedirs(staging_dir, exist_ok=True)
+
+    def stage(self, sd_root, paths: List[str]) -> Tuple[str, Dict[str, str]]:
+        """Return value: (staged card dir, source path -> staged path).
+        Raises StagingError (nothing is left behind) if sources do not fit
+        or a copy does not verify"""
+        total = sum(os.path.getsize(path) for path in paths)
+        free = shutil.disk_usage(self.staging_dir).free
+        if total > free:
+            raise StagingError(f"Not enough space to stage {sd_root}: {total} > {free} bytes")
+        card_dir = tempfile.mkdtemp(prefix=os.path.basename(os.path.normpath(sd_root)) + "_",
+                                    dir=self.staging_dir)
+        began = time.monotonic()
+        staged = {}
+        try:
+            for path in paths:
+                dst = os.path.join(card_dir, os.path.relpath(path, sd_root))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                STAGED_BYTES.inc(copy_file(path, dst))
+                if not verify_copy(path, dst, self.verify, self.samples):
+                    raise StagingError(f"Staged copy differs: {path}")
+                staged[path] = dst
+        except BaseException:
+            self.release(card_dir)
+            raise
+        elapsed = time.monotonic() - began
+        STAGING_TIME.observe(elapsed)
+        logging.info("staged %s: %d files, %.1f MB in %.1f s (%.1f MB/s)", sd_root, len(staged),
+                     total / 1e6, elapsed, total / 1e6 / max(elapsed, 1e-6))
+        return card_dir, staged
+
+    def owns(self, path) -> bool:
+        return os.path.dirname(os.path.normpath(path)) == os.path.normpath(self.staging_dir)
+
+    def release(self, card_dir):
+        shutil.rmtree(card_dir, ignore_errors=True)
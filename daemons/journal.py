@@ -0,0 +1,107 @@
+"""Durable journal of job state transitions.
+
+Every transition is a row appended to an SQLite database in WAL mode; with
+synchronous=NORMAL a commit is a sequential append, fsync happens at
+checkpoints. Every `snapshot_every` records the events are folded into the
+snapshot table and finished jobs are dropped, so replay on startup reads
+one row per unfinished job plus a short tail of events.
+
+State of a job is its last transition together with the data of all its
+transitions, merged in order.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, Optional
+
+
+QUEUED = "queued"
+TRANSCODING = "transcoding"
+TRANSCODED = "transcoded"
+UPLOADING = "uploading"
+UPLOADED = "uploaded"
+REPORTED = "reported"
+FAILED = "failed"
+FINISHED = {REPORTED, FAILED}
+
+Entry = namedtuple("Entry", ["state", "data"])
+
+
+class Journal:
+    """Thread-safe, path=None keeps the journal in memory"""
+
+    def __init__(self, path: str = None, snapshot_every=256):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False, isolation_level=None)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS events "
+                         "(seq INTEGER PRIMARY KEY, t REAL, key TEXT, state TEXT, data TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS snapshot "
+                         "(key TEXT PRIMARY KEY, state TEXT, data TEXT)")
+        self._entries = {}
+        self._since_snapshot = 0
+        self._lock = threading.Lock()
+        self._replay()
+
+    def _replay(self):
+        for key, state, data in self._db.execute("SELECT key, state, data FROM snapshot"):
+            self._entries[key] = Entry(state, json.loads(data))
+        for key, state, data in self._db.execute("SELECT key, state, data FROM events ORDER BY seq"):
+            self._apply(key, state, json.loads(data))
+            self._since_snapshot += 1
+        if self._entries:
+            logging.info("Journal %s: %d unfinished jobs", self.path, len(self._entries))
+
+    def _apply(self, key, state, data):
+        if state in FINISHED:
+            self._entries.pop(key, None)
+            return
+        previous = self._entries.get(key)
+        merged = dict(previous.data) if previous else {}
+        merged.update(data)
+        self._entries[key] = Entry(state, merged)
+
+    def record(self, key: str, state: str, **data):
+        """data: JSON-serializable, merged into the job's data"""
+        payload = json.dumps(data)
+        with self._lock:
+            self._db.execute("INSERT INTO events (t, key, state, data) VALUES (?, ?, ?, ?)",
+                             (time.time(), key, state, payload))
+            self._apply(key, state, data)
+            self._since_snapshot += 1
+            if self._since_snapshot >= self.snapshot_every:
+                self._snapshot()
+
+    def _snapshot(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("DELETE FROM snapshot")
+            self._db.executemany("INSERT INTO snapshot (key, state, data) VALUES (?, ?, ?)",
+                                 [(key, entry.state, json.dumps(entry.data))
+                                  for key, entry in self._entries.items()])
+            self._db.execute("DELETE FROM events")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        self._since_snapshot = 0
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def unfinished(self) -> Dict[str, Entry]:
+        with self._lock:
+            return dict(self._entries)
+
+    def close(self):
+        with self._lock:
+            self._snapshot()
+            self._db.close()
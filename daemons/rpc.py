@@ -0,0 +1,159 @@
+"""Persistent multiplexed RPC between daemons.
+
+A client opens one connection per peer and sends MAGIC, then frames:
+    !II header (payload length, request id) + JSON payload
+The server answers each request frame with a frame carrying the same id,
+so requests can be pipelined. Payloads are the same JSON objects the
+one-shot protocol (json + SHUT_WR) carries, handlers see no difference.
+"""
+
+import itertools
+import json
+import logging
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+from typing import Optional, Tuple
+
+
+MAGIC = b"\x00RPC"  # never a valid start of JSON
+HEADER = struct.Struct("!II")
+MAX_FRAME_SIZE = 64 << 20
+
+
+def pack_frame(request_id: int, payload: bytes) -> bytes:
+    return HEADER.pack(len(payload), request_id) + payload
+
+def unpack_header(header: bytes) -> Tuple[int, int]:
+    """Return value: (payload length, request id)"""
+    length, request_id = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large: {length}")
+    return length, request_id
+
+def _read_exactly(stream, size) -> Optional[bytes]:
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+def read_frame(stream) -> Optional[Tuple[int, bytes]]:
+    """stream: buffered binary file. Return value: (request id, payload) or
+    None on EOF"""
+    header = _read_exactly(stream, HEADER.size)
+    if header is None:
+        return None
+    length, request_id = unpack_header(header)
+    payload = _read_exactly(stream, length)
+    if payload is None:
+        return None
+    return request_id, payload
+
+
+class RpcChannel:
+    """Long-lived connection to one peer, (re)connected on demand.
+    call_async() sends a frame right away, a reader thread resolves the
+    returned future with the response object. Thread-safe."""
+
+    def __init__(self, address, connect_timeout=10):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self._sock = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def call(self, body, timeout=None):
+        return self.call_async(body).result(timeout)
+
+    def call_async(self, body) -> Future:
+        payload = json.dumps(body).encode()
+        future = Future()
+        with self._send_lock:
+            for attempt in range(2):
+                sock = self._connected()
+                request_id = next(self._ids) & 0xFFFFFFFF
+                with self._lock:
+                    self._pending[request_id] = future
+                try:
+                    sock.sendall(pack_frame(request_id, payload))
+                    return future
+                except OSError as e:
+                    logging.warning("RpcChannel %s: send failed: %s", self.address, e)
+                    with self._lock:
+                        self._pending.pop(request_id, None)
+                    self._drop(sock)
+                    if attempt:  # stale connection is retried once
+                        raise
+
+    def close(self):
+        with self._lock:
+            sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._drop(sock)
+
+    def _connected(self) -> socket.socket:
+        """Called under _send_lock"""
+        with self._lock:
+            if self._sock is not None:
+                return self._sock
+        sock = socket.create_connection(self.address, timeout=self.connect_timeout)
+        sock.settimeout(None)
+        sock.sendall(MAGIC)
+        with self._lock:
+            self._sock = sock
+        threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+        logging.info("RpcChannel %s: connected", self.address)
+        return sock
+
+    def _read_loop(self, sock):
+        try:
+            with sock.makefile("rb") as stream:
+                while True:
+                    frame = read_frame(stream)
+                    if frame is None:
+                        break
+                    request_id, payload = frame
+                    with self._lock:
+                        future = self._pending.pop(request_id, None)
+                    if future is None:
+                        logging.warning("RpcChannel %s: unexpected response id=%d", self.address, request_id)
+                        continue
+                    try:
+                        future.set_result(json.loads(payload))
+                    except json.JSONDecodeError as e:
+                        future.set_exception(e)
+        except (OSError, ValueError) as e:
+            logging.warning("RpcChannel %s: %s", self.address, e)
+        finally:
+            self._drop(sock)
+
+    def _drop(self, sock):
+        """Closes sock and fails requests in flight on it"""
+        with self._lock:
+            if self._sock is not sock:
+                return
+            self._sock = None
+            pending, self._pending = self._pending, {}
+        sock.close()
+        for future in pending.values():
+            future.set_exception(ConnectionError(f"Connection to {self.address} lost"))
+
+
+_channels = {}
+_channels_lock = threading.Lock()
+
+def get_channel(address) -> RpcChannel:
+    """Shared channel per peer address"""
+    address = tuple(address)
+    with _channels_lock:
+        channel = _channels.get(address)
+        if channel is None:
+            channel = _channels[address] = RpcChannel(address)
+        return channel
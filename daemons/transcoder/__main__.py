@@ -2,10 +2,14 @@ import argparse
 import logging
 import os
 import signal
-import socketserver
 from config import Config
-from daemons.abc import JobQueueDaemon
-from .transcoder import TranscodeExecutor, TranscodeRequestHandler, ResultReporter
+from daemons.abc import JobQueueDaemon, ThreadingTCPServer
+from daemons.aio import AsyncJobQueueDaemon, AsyncTCPServer
+from daemons.journal import Journal
+from daemons.metrics import MetricsServer
+from transcode_v2.cache import OutputCache
+from .remote import TranscodeDataServer
+from .transcoder import SlotBudget, TranscodeExecutor, TranscodeRequestHandler, ResultReporter, resume_from_journal
 
 
 def parse_args():
@@ -13,6 +17,14 @@ def parse_args():
     parser.add_argument("--importer", required=True, help="Importer daemon address")
     parser.add_argument("--bind", required=False, default="127.0.0.1:1337", help="Bind address")
     parser.add_argument("--config", required=False, default="config.json", help="Path to configuration")
+    parser.add_argument("--cpu-budget", required=False, type=float, default=1.0, help="Sum of running profiles' CPU cost")
+    parser.add_argument("--io-budget", required=False, type=float, default=1.0, help="Sum of running profiles' IO cost")
+    parser.add_argument("--data-bind", required=False, help="Bind address for remote jobs' media (default - disabled)")
+    parser.add_argument("--spool-dir", required=False, help="Working directory for remote jobs (default - system temp)")
+    parser.add_argument("--runtime", required=False, choices=["threads", "asyncio"], default="threads",
+                        help="Request serving and queue runtime")
+    parser.add_argument("--journal", required=False, help="Path to job journal, unfinished jobs resume after restart (default - in memory)")
+    parser.add_argument("--metrics-bind", required=False, help="Bind address for Prometheus metrics (default - disabled)")
     parser.add_argument("--logfile", required=False, help="Path to log file (default - stderr)")
     return parser.parse_args()
 
@@ -24,11 +36,26 @@ def main(args):
     bind_addr = to_addr(args.bind)
     importer_addr = to_addr(args.importer)
     
-    daemon = JobQueueDaemon(["q_transcode_accept", "q_transcode_finished"])
+    if args.runtime == "asyncio":
+        daemon_cls, server_cls = AsyncJobQueueDaemon, AsyncTCPServer
+    else:
+        daemon_cls, server_cls = JobQueueDaemon, ThreadingTCPServer
+    daemon = daemon_cls(["q_transcode_accept", "q_transcode_finished"], Config.queue_disciplines)
     report_queue = daemon.job_queues["q_transcode_finished"]
-    daemon.add_executor("q_transcode_accept", TranscodeExecutor, report_queue)
-    daemon.add_executor("q_transcode_finished", ResultReporter, importer_addr)
-    daemon.add_server(socketserver.TCPServer(bind_addr, TranscodeRequestHandler))
+    daemon.journal = Journal(args.journal)
+    resume_from_journal(daemon.journal, daemon.job_queues["q_transcode_accept"], report_queue)
+    budget = SlotBudget(args.cpu_budget, args.io_budget)
+    cache = None
+    if Config.transcode_cache_dir:
+        cache = OutputCache(Config.transcode_cache_dir, Config.transcode_cache_max_bytes)
+    daemon.transcode_executor = daemon.add_executor("q_transcode_accept", TranscodeExecutor, report_queue, budget,
+                                                    jobs=daemon.journal, cache=cache)
+    daemon.add_executor("q_transcode_finished", ResultReporter, importer_addr, daemon.journal)
+    daemon.add_server(server_cls(bind_addr, TranscodeRequestHandler))
+    if args.data_bind:
+        daemon.add_server(TranscodeDataServer(to_addr(args.data_bind), args.spool_dir))
+    if args.metrics_bind:
+        daemon.add_server(MetricsServer(to_addr(args.metrics_bind)))
     
     daemon.start()
     logging.info("Started")
@@ -40,6 +67,7 @@ def main(args):
         sig = signal.Signals(sig.si_signo)
         logging.info("Shutting down after %s", sig.name)
         daemon.shutdown()
+        daemon.journal.close()
 
 if __name__ == '__main__':
     args  = parse_args()
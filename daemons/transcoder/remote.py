@@ -0,0 +1,201 @@
+"""Media data plane for transcoding on another machine.
+
+One job per connection to the transcoder's data port:
+    client: header {"inputs", "output", "profile", "segments"}, pack of input files
+    server: header {"exitcode", "suffixes"} or {"error"}, pack of sinks
+Headers are 8-byte big-endian length + JSON, packs are packed_stream format.
+Input and output names are basenames only, the server spools inputs into
+its own workdir and removes it once sinks are sent back.
+
+Throughput benchmark on loopback (encoding replaced by a copy):
+(venv) $ python -m daemons.transcoder.remote --files 4 --size 256
+"""
+
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import tempfile
+from concurrent.futures import Future
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Tuple
+from packed_stream import BUFFER_SIZE, SIZE, StreamPackReader, StreamPackWriter
+from transcode_v2 import TranscodeError
+from daemons.abc import ThreadingTCPServer
+from .transcoder import TranscodeJob
+
+
+MAX_HEADER_SIZE = 1 << 20
+
+
+def send_header(sock: socket.socket, obj):
+    payload = json.dumps(obj).encode()
+    sock.sendall(SIZE.pack(len(payload)) + payload)
+
+def _recv_exactly(sock: socket.socket, size) -> bytearray:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise EOFError("Connection closed")
+        received += count
+    return data
+
+def recv_header(sock: socket.socket):
+    size = SIZE.unpack(_recv_exactly(sock, SIZE.size))[0]
+    if size > MAX_HEADER_SIZE:
+        raise ValueError(f"Header too large: {size}")
+    return json.loads(_recv_exactly(sock, size))
+
+def send_files(sock: socket.socket, paths: List[str], **pack_options):
+    with ExitStack() as stack:
+        writer = StreamPackWriter(sock, **pack_options)
+        for path in paths:
+            writer.add_input(stack.enter_context(open(path, "rb")))
+        writer.transmit()
+
+def recv_files(sock: socket.socket, paths: List[str], buffer_size=BUFFER_SIZE):
+    reader = StreamPackReader(sock, buffer_size)
+    with ExitStack() as stack:
+        reader.receive([stack.enter_context(open(path, "wb")) for path in paths])
+
+
+def run_remote(address, job: Dict, buffer_size=BUFFER_SIZE, use_sendfile=True) -> Tuple[Optional[int], List[str]]:
+    """Ships job's inputs to a remote transcoder, blocks until sinks are
+    received next to job["output"].
+    job: same keys as a transcode request item.
+    Return value: (exitcode, sinks)"""
+    with socket.create_connection(address) as sock:
+        sock.settimeout(None)  # sendfile needs a blocking socket
+        send_header(sock, {
+            "inputs": [[os.path.basename(path) for path in group] for group in job["inputs"]],
+            "output": os.path.basename(job["output"]),
+            "profile": job["profile"],
+            "segments": job.get("segments", 1)
+        })
+        send_files(sock, [path for group in job["inputs"] for path in group],
+                   buffer_size=buffer_size, use_sendfile=use_sendfile)
+        result = recv_header(sock)
+        if "error" in result:
+            raise TranscodeError(f"Remote transcoder refused job: {result['error']}")
+        for suffix in result["suffixes"]:
+            if os.sep in suffix or suffix.startswith(".."):
+                raise ValueError(f"Bad sink suffix: {suffix}")
+        sinks = [job["output"] + suffix for suffix in result["suffixes"]]
+        recv_files(sock, sinks, buffer_size)
+        return result["exitcode"], sinks
+
+
+class TranscodeDataHandler(socketserver.BaseRequestHandler):
+    """Spools a remote job's inputs, queues it as a local TranscodeJob and
+    streams sinks back once it finishes"""
+
+    def handle(self):
+        sock = self.request
+        sock.settimeout(None)
+        header = recv_header(sock)
+        workdir = tempfile.mkdtemp(prefix="remote_", dir=self.server.spool_dir)
+        try:
+            inputs = self._spool_inputs(sock, header["inputs"], workdir)
+            output = os.path.join(workdir, "out", os.path.basename(header["output"]))
+            os.makedirs(os.path.dirname(output))
+            try:
+                job = TranscodeJob({"inputs": inputs, "output": output,
+                                    "profile": header["profile"],
+                                    "segments": header.get("segments", 1)})
+            except TranscodeError as e:
+                send_header(sock, {"error": f"{e}"})
+                return
+            done = Future()
+            job.on_done = done.set_result
+            logging.info("Remote job from %s: %s", self.client_address, header["output"])
+            self.server.daemon.job_queues["q_transcode_accept"].put(job)
+            result = done.result()
+            sinks = [sink for sink in result["outputs"] if os.path.exists(sink)]
+            send_header(sock, {"exitcode": result["exitcode"],
+                               "suffixes": [sink[len(output):] for sink in sinks]})
+            send_files(sock, sinks)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _spool_inputs(self, sock, names, workdir) -> List[List[str]]:
+        """Input files are renamed to {group}_{index}{ext}"""
+        os.makedirs(os.path.join(workdir, "in"))
+        inputs = [
+            [os.path.join(workdir, "in", f"{group_idx:02}_{idx:03}{os.path.splitext(name)[1]}")
+             for idx, name in enumerate(group)]
+            for group_idx, group in enumerate(names)
+        ]
+        recv_files(sock, [path for group in inputs for path in group])
+        return inputs
+
+class TranscodeDataServer(ThreadingTCPServer):
+    def __init__(self, server_address, spool_dir=None):
+        """spool_dir: where remote inputs and sinks are kept while a job runs
+        (default: system temp dir)"""
+        super(TranscodeDataServer, self).__init__(server_address, TranscodeDataHandler)
+        self.spool_dir = spool_dir
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from config import Config
+    from daemons.abc import BaseQueueExecutor, JobQueueDaemon
+
+    class CopyExecutor(BaseQueueExecutor):
+        """Stands in for TranscodeExecutor: the sink is the concatenated input"""
+        def handle_job(self, job):
+            sink = job.output + ".mp4"
+            with open(sink, "wb") as sink_file:
+                for path in job.inputs[0]:
+                    with open(path, "rb") as source:
+                        shutil.copyfileobj(source, sink_file, 1 << 20)
+            job.on_done({"output_base": job.output, "outputs": [sink], "exitcode": 0})
+
+    parser = argparse.ArgumentParser(description="Remote transcode data plane throughput")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--size", type=int, default=128, help="MiB per file")
+    parser.add_argument("--config", default="config.json", help="Path to configuration (for presets)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    Config.update(args.config)
+
+    workdir = tempfile.mkdtemp(prefix="remote_bench_")
+    daemon = JobQueueDaemon(["q_transcode_accept"])
+    daemon.add_executor("q_transcode_accept", CopyExecutor)
+    server = TranscodeDataServer(("127.0.0.1", 0), spool_dir=workdir)
+    daemon.add_server(server)
+    daemon.start()
+    try:
+        chunk = os.urandom(1 << 20)
+        paths = []
+        for idx in range(args.files):
+            path = os.path.join(workdir, f"{idx:05}.MTS")
+            with open(path, "wb") as chunk_file:
+                for _ in range(args.size):
+                    chunk_file.write(chunk)
+            paths.append(path)
+        total = args.files * args.size * 2  # inputs there, sink back
+
+        def timed_run(label, buffer_size, use_sendfile):
+            job = {"inputs": [paths], "output": os.path.join(workdir, "bench"), "profile": "concat_copy"}
+            began = time.perf_counter()
+            exitcode, sinks = run_remote(server.server_address, job, buffer_size, use_sendfile)
+            elapsed = time.perf_counter() - began
+            assert exitcode == 0 and os.path.getsize(sinks[0]) == args.files * args.size << 20
+            os.remove(sinks[0])
+            print(f"{label:>22}: {total / elapsed:8.1f} MiB/s ({total} MiB in {elapsed:.2f} s)")
+
+        # the server side always uses sendfile + 1 MiB readinto
+        print(f"client side of the data plane, {args.files} x {args.size} MiB there and back:")
+        timed_run("4 KiB read/write", 0x1000, False)
+        timed_run("1 MiB readinto", BUFFER_SIZE, False)
+        timed_run("sendfile + readinto", BUFFER_SIZE, True)
+    finally:
+        daemon.shutdown()
+        shutil.rmtree(workdir)
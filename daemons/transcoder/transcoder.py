@@ -8,21 +8,55 @@ Example:
         ["input_dir/PRIVATE/AVCHD/BDMV/STREAM/00000.MTS"]
     ],
     "output": "output_dir/00000.mp4",
-    "profile": "concat_copy"
+    "profile": "concat_copy",
+    "priority": 0,
+    "size": 3600.0
 }]
 _DOC
 
 Output:
 {"error": 0, "result": {"accept": [0], "discard": []}}
+
+Load report: {"message_type": "status"}, includes "eta" - estimated
+seconds to finish everything accepted, from ffmpeg's reported speed.
+Job states: {"message_type": "jobs", "outputs": [...]}, result maps every
+output to its journal state, null if this transcoder does not hold it.
+While running, transcode_progress messages go to the importer.
+
+Jobs are journaled (see daemons.journal): after a restart unfinished ones
+run again and finished ones are reported without running ffmpeg. A job
+for an output that is already queued or running is accepted, not added.
 """
 
-import json
 import logging
-import socket
-from typing import Dict
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
 from config import Config
-from transcode_v2 import transcode, TranscodeError, validate_args
+from transcode_v2 import transcode, can_segment, Cost, PROFILE_SEPARATOR, TranscodeError, get_cost, validate_args
+from transcode_v2.cache import OutputCache
 from daemons.abc import BaseQueueExecutor, JobQueueDaemon, JsonRequestHandler
+from daemons import journal, metrics, rpc
+
+
+ADMISSION_WAIT = metrics.REGISTRY.histogram(
+    "lectorium_transcode_wait_seconds", "Time from acceptance to ffmpeg start", ("profile",))
+TRANSCODE_TIME = metrics.REGISTRY.histogram(
+    "lectorium_transcode_seconds", "Wall time of a transcode job", ("profile",))
+ENCODED_VIDEO = metrics.REGISTRY.counter(
+    "lectorium_encoded_video_seconds_total", "Seconds of source video transcoded", ("profile",))
+ENCODE_SPEED = metrics.REGISTRY.gauge(
+    "lectorium_encode_speed", "Source seconds per wall second of the last finished job", ("profile",))
+RUNNING = metrics.REGISTRY.gauge("lectorium_transcodes_running", "Admitted transcode jobs")
+CPU_SAVED = metrics.REGISTRY.counter(
+    "lectorium_cpu_seconds_saved_total", "Estimated CPU budget-seconds saved by a cheaper chosen profile",
+    ("requested", "profile"))
+CACHE_LOOKUPS = metrics.REGISTRY.counter(
+    "lectorium_transcode_cache_lookups_total", "Output cache lookups", ("result",))
+CACHE_BYTES = metrics.REGISTRY.gauge("lectorium_transcode_cache_bytes", "Size of cached transcode outputs")
 
 
 class TranscodeRequestHandler(JsonRequestHandler):
@@ -31,6 +65,14 @@ class TranscodeRequestHandler(JsonRequestHandler):
             self.response_obj["error"] = 1
             self.response_obj["error_desc"] = "Invalid JSON"
             return
+        if isinstance(self.request_obj, dict) and self.request_obj.get("message_type") == "status":
+            self.response_obj["error"] = 0
+            self.response_obj["result"] = self.server.daemon.transcode_executor.status()
+            return
+        if isinstance(self.request_obj, dict) and self.request_obj.get("message_type") == "jobs":
+            self.response_obj["error"] = 0
+            self.response_obj["result"] = job_states(self.server.daemon.journal, self.request_obj.get("outputs", []))
+            return
 
         self.response_obj["error"] = 0
         self.response_obj["result"] = {
@@ -40,52 +82,353 @@ class TranscodeRequestHandler(JsonRequestHandler):
 
         for idx, job in enumerate(self.request_obj):
             try:
-                self.server.daemon.job_queues["q_transcode_accept"].put(TranscodeJob(job))
+                self.accept(TranscodeJob(job), job)
                 self.response_obj["result"]["accept"].append(idx)
             except TranscodeError as e:
-                response["result"]["discard"].append({
+                self.response_obj["result"]["discard"].append({
                     "index": idx, "type": f"{type(e)}", "desc": f"{e}"
                 })
 
+    def accept(self, job, request):
+        daemon = self.server.daemon
+        entry = daemon.journal.get(job.output)
+        if entry is not None and entry.data["job"]["inputs"] == job.inputs:
+            if entry.state == journal.TRANSCODED:
+                logging.info("Already transcoded, reporting again: %s", job.output)
+                daemon.job_queues["q_transcode_finished"].put(finished_result(job.output, entry))
+            else:
+                logging.info("Already accepted: %s", job.output)
+            return
+        daemon.journal.record(job.output, journal.QUEUED, job=request)
+        job.eta = daemon.transcode_executor.estimate(job)  # the "eta" queue discipline orders by it
+        daemon.job_queues["q_transcode_accept"].put(job)
+
+def job_states(jobs: journal.Journal, outputs) -> Dict[str, Optional[str]]:
+    """None for outputs not accepted or already reported"""
+    states = {}
+    for output in outputs:
+        entry = jobs.get(output)
+        states[output] = entry.state if entry is not None else None
+    return states
+
+def finished_result(output, entry: journal.Entry) -> Dict:
+    return {"output_base": output, "outputs": entry.data["outputs"], "exitcode": entry.data["exitcode"]}
+
+def resume_from_journal(jobs: journal.Journal, accept_queue, report_queue):
+    """Unfinished jobs are accepted again, results not yet delivered are reported"""
+    for output, entry in jobs.unfinished().items():
+        if entry.state == journal.TRANSCODED:
+            report_queue.put(finished_result(output, entry))
+            continue
+        try:
+            accept_queue.put(TranscodeJob(entry.data["job"]))
+        except TranscodeError as e:
+            logging.error("Cannot resume %s: %s", output, e)
+            jobs.record(output, journal.FAILED, error=f"{e}")
+            continue
+        logging.info("Resuming %s job: %s", entry.state, output)
+
 class TranscodeJob:
+    SPEED_SAMPLES = 120  # a minute of ffmpeg progress reports
+
     def __init__(self, job: Dict):
         try:
             self.inputs = job["inputs"]
             self.output = job["output"]
             self.profile = job["profile"]
-        except TypeError as e:
+            if isinstance(self.profile, list):  # several at once, see transcode_v2.merge_presets
+                self.profile = PROFILE_SEPARATOR.join(self.profile)
+            self.segments = int(job.get("segments", 1))
+            self.stream_upload = bool(job.get("stream_upload", False))
+            self.priority = int(job.get("priority", 0))
+            self.size = float(job.get("size", 0))  # seconds of source video
+            self.decision = job.get("decision")  # importer's profile choice, see select_profile
+        except (TypeError, ValueError) as e:
             raise TranscodeError(f"Bad arguments types: {e}") from e
         except KeyError as e:
             raise TranscodeError(f"Missing argument: {e}") from e
         
         validate_args(self.inputs, self.output, self.profile)
+        self.cost = get_cost(self.profile)
+        self.workers = 1  # concurrent ffmpeg processes, see TranscodeExecutor.charge_segments
+        self.bypassed = 0
+        self.accepted_at = time.monotonic()
+        self.on_done = None  # called with the result instead of reporting it
+        self.eta = self.size  # expected encode seconds, realtime until measured
+        self.progress = None  # last transcode_v2.Progress
+        self.speed_history = deque(maxlen=self.SPEED_SAMPLES)  # (monotonic, speed)
+
+    def remaining(self) -> float:
+        """Expected seconds until finished, self.eta before start"""
+        if self.progress is None or not self.progress.speed:
+            return self.eta
+        return max(self.size - self.progress.out_time, 0.0) / self.progress.speed
+
+class SlotBudget:
+    """Admission control by declared profile cost (see transcode_v2.get_cost).
+    A job is admitted while the sums of running costs stay within the budget.
+    If nothing is running, any job is admitted, so an oversized profile cannot
+    stall the queue."""
+    EPSILON = 1e-6
+
+    def __init__(self, cpu=1.0, io=1.0):
+        self.cpu = cpu
+        self.io = io
+        self.used = Cost(0.0, 0.0)
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, cost: Cost) -> bool:
+        with self._lock:
+            fits = (self.used.cpu + cost.cpu <= self.cpu + self.EPSILON
+                    and self.used.io + cost.io <= self.io + self.EPSILON)
+            if not fits and self.running:
+                return False
+            self.used = Cost(self.used.cpu + cost.cpu, self.used.io + cost.io)
+            self.running += 1
+            return True
+
+    def release(self, cost: Cost):
+        with self._lock:
+            self.used = Cost(self.used.cpu - cost.cpu, self.used.io - cost.io)
+            self.running -= 1
 
 class TranscodeExecutor(BaseQueueExecutor):
-    def __init__(self, job_queue, report_queue):
+    """Runs jobs concurrently while their costs fit into the budget.
+    Up to `lookahead` accepted jobs wait for admission; a cheaper one may
+    overtake a job which does not fit, at most `max_bypass` times in a row.
+    Average speeds of the last `history` finished jobs per profile give ETAs
+    of pending jobs (the "eta" queue discipline orders by them).
+    With an OutputCache, a job with the same inputs, command line and
+    ffmpeg version as a stored one is linked from the cache, its result
+    has "cache": cache stats and whether it was a hit."""
+    PROGRESS_INTERVAL = 5.0  # seconds between transcode_progress reports
+
+    def __init__(self, job_queue, report_queue, budget: SlotBudget = None,
+                 lookahead=4, max_bypass=8, history=16, jobs: journal.Journal = None,
+                 cache: OutputCache = None):
+        """jobs: journal of accepted jobs, remote ones (with on_done) are not journaled"""
         super(TranscodeExecutor, self).__init__(job_queue)
+        self.event_poll = self._poll_when_room
         self.report_queue = report_queue
+        self.journal = jobs or journal.Journal()
+        self.cache = cache
+        if cache is not None:
+            CACHE_BYTES.set_function(lambda: cache.stats()["bytes"])
+        self.budget = budget or SlotBudget()
+        self.lookahead = lookahead
+        self.max_bypass = max_bypass
+        self._pending = []
+        self._workers = set()
+        self._running_jobs = set()
+        self._speeds = {}  # profile -> deque of finished jobs' average speeds
+        self._history = history
+        self._lock = threading.Lock()
+        RUNNING.set_function(lambda: self.budget.running)
+
+    def status(self) -> Dict:
+        """Load report for importers placing jobs across transcoders"""
+        with self._lock:
+            pending = list(self._pending)
+            running = list(self._running_jobs)
+        # jobs run in parallel up to the CPU budget, so is the work drained
+        work = sum(job.remaining() * job.cost.cpu for job in running + pending)
+        return {
+            "queued": self.job_queue.qsize() + len(pending),
+            "running": self.budget.running,
+            "cpu_used": self.budget.used.cpu, "io_used": self.budget.used.io,
+            "cpu_budget": self.budget.cpu, "io_budget": self.budget.io,
+            "eta": work / max(self.budget.cpu, SlotBudget.EPSILON),
+            "progress": [{"output": job.output, "eta": job.remaining(),
+                          "out_time": job.progress.out_time if job.progress else 0.0,
+                          "speed": job.progress.speed if job.progress else None}
+                         for job in running]
+        }
+
+    def expected_speed(self, profile) -> Optional[float]:
+        """Median speed of recent jobs of the profile, None if none finished yet"""
+        with self._lock:
+            speeds = list(self._speeds.get(profile, ()))
+        return statistics.median(speeds) if speeds else None
+
+    def estimate(self, job) -> float:
+        return job.size / (self.expected_speed(job.profile) or 1.0)
+
+    def cpu_saved(self, job, elapsed) -> float:
+        """Estimated CPU budget-seconds the requested profile would take
+        over what the chosen one took"""
+        requested = job.decision["requested"]
+        if requested == job.profile:
+            return 0.0
+        try:
+            cost = get_cost(requested)
+        except TranscodeError:
+            return 0.0
+        encode_time = job.size / (self.expected_speed(requested) or 1.0)
+        return max(encode_time * cost.cpu - elapsed * job.cost.cpu, 0.0)
+
+    def room(self) -> int:
+        with self._lock:
+            return self.lookahead - len(self._pending)
+
+    def _poll_when_room(self, timeout):
+        if self.room() <= 0:
+            time.sleep(timeout)
+            raise queue.Empty()
+        return self.job_queue.get(timeout=timeout)
+
+    def charge_segments(self, job):
+        """A segmented job runs up to job.segments ffmpeg processes at once:
+        their number is capped by what fits into the budget, the job is
+        charged the profile cost times that number. If only one fits, the
+        job is not segmented: parts one after another only add overhead"""
+        if job.segments <= 1 or job.stream_upload or not can_segment(job.profile):
+            return
+        fit = min(self.budget.cpu / max(job.cost.cpu, SlotBudget.EPSILON),
+                  self.budget.io / max(job.cost.io, SlotBudget.EPSILON))
+        job.workers = max(1, min(job.segments, int(fit + SlotBudget.EPSILON)))
+        if job.workers == 1:
+            logging.info("Budget fits one %s process, not segmenting: %s", job.profile, job.output)
+            job.segments = 1
+            return
+        job.cost = Cost(job.cost.cpu * job.workers, job.cost.io * job.workers)
 
     def handle_job(self, job):
-        with open(f"{job.output}.transcode_log", "w") as stderr:
-            exitcode, outputs = transcode(job.profile, job.inputs, job.output, stderr=stderr)
-            # TODO report progress
-            self.report_queue.put({"output_base": job.output, "outputs": outputs})
+        self.charge_segments(job)
+        job.eta = self.estimate(job)  # speeds may have changed while it was queued
+        with self._lock:
+            self._pending.append(job)
+            if hasattr(self.job_queue, "score"):  # keep the queue discipline among pending jobs
+                self._pending.sort(key=lambda pending: self.job_queue.score(pending, pending.accepted_at))
+        self._admit()
+
+    def _admit(self):
+        with self._lock:
+            for job in list(self._pending):
+                head = self._pending[0]
+                if job is not head and head.bypassed >= self.max_bypass:
+                    break
+                if not self.budget.try_acquire(job.cost):
+                    continue
+                self._pending.remove(job)
+                if job is not head:
+                    head.bypassed += 1
+                worker = threading.Thread(target=self._run_job, args=(job,))
+                self._workers.add(worker)
+                logging.info("TranscodeExecutor: admitted %s cost=%s used=%s",
+                             job.output, job.cost, self.budget.used)
+                worker.start()
+
+    def _run_job(self, job):
+        result = {"output_base": job.output, "outputs": [], "exitcode": None}
+        began = time.monotonic()
+        ADMISSION_WAIT.observe(began - job.accepted_at, profile=job.profile)
+        with self._lock:
+            self._running_jobs.add(job)
+        if not job.on_done:
+            self.journal.record(job.output, journal.TRANSCODING)
+        try:
+            on_start = None
+            if job.stream_upload:
+                on_start = lambda sinks: self.report_queue.put({
+                    "message_type": "transcode_started",
+                    "output_base": job.output, "outputs": sinks
+                })
+            with open(f"{job.output}.transcode_log", "w") as stderr:
+                options = dict(stderr=stderr, segments=job.segments, workers=job.workers,
+                               fragmented=job.stream_upload, on_start=on_start,
+                               on_progress=self._progress_recorder(job))
+                if self.cache is not None:
+                    exitcode, outputs, cached = self.cache.transcode(job.profile, job.inputs, job.output, **options)
+                    CACHE_LOOKUPS.inc(result="hit" if cached else "miss")
+                    result["cache"] = dict(self.cache.stats(), hit=cached)
+                else:
+                    exitcode, outputs = transcode(job.profile, job.inputs, job.output, **options)
+                    cached = False
+                result.update(outputs=outputs, exitcode=exitcode)
+            elapsed = time.monotonic() - began
+            if not cached:
+                TRANSCODE_TIME.observe(elapsed, profile=job.profile)
+            if exitcode == 0 and not cached:
+                encoded = job.progress.out_time if job.progress and job.progress.out_time else job.size
+                if encoded:
+                    speed = encoded / max(elapsed, 1e-6)
+                    ENCODED_VIDEO.inc(encoded, profile=job.profile)
+                    ENCODE_SPEED.set(speed, profile=job.profile)
+                    with self._lock:
+                        self._speeds.setdefault(job.profile, deque(maxlen=self._history)).append(speed)
+                if job.decision:
+                    saved = self.cpu_saved(job, elapsed)
+                    CPU_SAVED.inc(saved, requested=job.decision["requested"], profile=job.profile)
+                    result["decision"] = dict(job.decision, cpu_seconds_saved=saved)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            with self._lock:
+                self._running_jobs.discard(job)
+            self.budget.release(job.cost)
+            if job.on_done:
+                job.on_done(result)
+            else:
+                # exitcode None: transcode() raised, the importer fails the job. Stays
+                # held (not FAILED) until reported, so it is not placed elsewhere meanwhile
+                self.journal.record(job.output, journal.TRANSCODED,
+                                    outputs=result["outputs"], exitcode=result["exitcode"])
+                self.report_queue.put(result)
+            with self._lock:
+                self._workers.discard(threading.current_thread())
+            self._admit()
+
+    def _progress_recorder(self, job):
+        """on_progress callback: keeps job.progress and its speed history,
+        reports to the importer every PROGRESS_INTERVAL (remote jobs are not reported)"""
+        reported_at = time.monotonic()
+
+        def on_progress(progress):
+            nonlocal reported_at
+            now = time.monotonic()
+            job.progress = progress
+            if progress.speed is not None:
+                job.speed_history.append((now, progress.speed))
+            if job.on_done or progress.finished or now - reported_at < self.PROGRESS_INTERVAL:
+                return
+            reported_at = now
+            self.report_queue.put({
+                "message_type": "transcode_progress",
+                "output_base": job.output, "out_time": progress.out_time,
+                "fps": progress.fps, "speed": progress.speed, "eta": job.remaining()
+            })
+        return on_progress
+
+    def shutdown(self):
+        super(TranscodeExecutor, self).shutdown()
+        with self._lock:
+            workers = list(self._workers)
+            dropped, self._pending = self._pending, []
+        if dropped:
+            logging.warning("TranscodeExecutor: dropping %d pending jobs", len(dropped))
+        for job in dropped:
+            if job.on_done:
+                job.on_done({"output_base": job.output, "outputs": [], "exitcode": None})
+        for worker in workers:
+            worker.join()
 
 class ResultReporter(BaseQueueExecutor):
-    def __init__(self, job_queue, report_addr):
+    def __init__(self, job_queue, report_addr, jobs: journal.Journal = None):
         super(ResultReporter, self).__init__(job_queue)
         self.report_addr = report_addr
+        self.journal = jobs or journal.Journal()
 
     def handle_job(self, job):
-        logging.info("ResultReporter: finished %s", job)
+        """job: message body, optionally with "message_type" (default is
+        transcode_result)"""
+        logging.info("ResultReporter: reporting %s", job)
+        body = dict(job)
         message = {
-            "message_type": "transcode_result",
-            "message": {"output_base": job["output_base"], "outputs": job["outputs"]}
+            "message_type": body.pop("message_type", "transcode_result"),
+            "message": body
         }
-        with socket.create_connection(self.report_addr) as sock:
-            with sock.makefile("w") as sock_w:
-                json.dump(message, sock_w)
-            sock.shutdown(socket.SHUT_WR)
-            with sock.makefile("r") as sock_r:
-                ans = json.load(sock_r)
-            logging.info("ResultReporter: remote answer: %s", ans)
+        ans = rpc.get_channel(self.report_addr).call(message)
+        logging.info("ResultReporter: remote answer: %s", ans)
+        if message["message_type"] == "transcode_result":
+            self.journal.record(body["output_base"], journal.REPORTED)
@@ -1,25 +1,334 @@
 """Based on https://developers.google.com/drive/api/v3/manage-uploads"""
 
+import hashlib
+import json
+import logging
 import mimetypes
 import os.path
 import pathlib
 import pickle
+import threading
+import time
 from collections import namedtuple
-from typing import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List
+import requests
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 
 
 GDRIVE_MIMETYPES = {
     'folder': 'application/vnd.google-apps.folder'
 }
+GDRIVE_UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files'
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+BATCH_LIMIT = 100  # calls per Drive batch request
+
+UploadProgress = namedtuple('UploadProgress', ('path', 'sent', 'total', 'rate'))
+UploadProgress.__doc__ = """sent/total in bytes, rate in bytes per second since
+start. For aggregate progress path is None."""
+
+class ResumableUpload:
+    """Raw Drive resumable upload session, see
+    https://developers.google.com/drive/api/v3/manage-uploads#resumable
+    Total size may be unknown until the last chunk, which allows uploading
+    a file while it is still being written."""
+    CHUNK_ALIGN = 256 * 1024
+
+    def __init__(self, session: AuthorizedSession, upload_url, name, parent, mimetype=None,
+                 session_uri=None):
+        """session_uri: continue an earlier session, see query_offset()"""
+        self.session = session
+        self.upload_url = upload_url
+        self.metadata = {'name': name, 'parents': [parent]}
+        self.mimetype = mimetype or 'application/octet-stream'
+        self.session_uri = session_uri
+        self.offset = 0
+
+    def start(self) -> str:
+        """Return value: session URI"""
+        response = self.session.post(
+            self.upload_url,
+            params={'uploadType': 'resumable'},
+            headers={'X-Upload-Content-Type': self.mimetype},
+            json=self.metadata
+        )
+        response.raise_for_status()
+        self.session_uri = response.headers['Location']
+        return self.session_uri
+
+    def send(self, data: bytes, total_size: int = None):
+        """Appends data at self.offset. Chunks except the last one should be
+        multiples of CHUNK_ALIGN. Return value: file resource if total_size
+        is given and reached, else None"""
+        total = '*' if total_size is None else str(total_size)
+        if data:
+            content_range = f'bytes {self.offset}-{self.offset + len(data) - 1}/{total}'
+        else:
+            content_range = f'bytes */{total}'
+        response = self.session.put(
+            self.session_uri, data=data,
+            headers={'Content-Range': content_range}
+        )
+        if response.status_code == 308:
+            self.offset = self._parse_range(response)
+            return None
+        response.raise_for_status()
+        self.offset += len(data)
+        return response.json()
+
+    def query_offset(self) -> int:
+        """Asks the server how many bytes are persisted"""
+        response = self.session.put(
+            self.session_uri, headers={'Content-Range': 'bytes */*'}
+        )
+        if response.status_code != 308:
+            response.raise_for_status()
+        self.offset = self._parse_range(response)
+        return self.offset
+
+    def abort(self):
+        if self.session_uri:
+            self.session.delete(self.session_uri)
+            self.session_uri = None
+
+    @staticmethod
+    def _parse_range(response) -> int:
+        """308 response 'Range: bytes=0-N' means N+1 bytes persisted"""
+        persisted = response.headers.get('Range')
+        if not persisted:
+            return 0
+        return int(persisted.rsplit('-', 1)[1]) + 1
+
+    @staticmethod
+    def is_transient(error: Exception) -> bool:
+        """Whether retrying after query_offset() makes sense"""
+        if isinstance(error, requests.HTTPError):
+            status = error.response.status_code if error.response is not None else 0
+            return status >= 500 or status in (408, 429)
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+class UploadStateStore:
+    """Persisted resumable sessions: (local path, remote parent) -> session URI
+    and confirmed offset, so an upload survives a restart of the process"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._sessions = {}
+        self._lock = threading.Lock()
+        if path:
+            try:
+                with open(path, 'r') as state_file:
+                    self._sessions = json.load(state_file)
+            except FileNotFoundError:
+                pass
+            except (json.JSONDecodeError, OSError) as e:
+                logging.warning('Discarding upload state %s: %s', path, e)
+
+    @staticmethod
+    def make_key(local_path, parent):
+        return f'{os.path.abspath(local_path)}|{parent}'
+
+    def get(self, key):
+        with self._lock:
+            return self._sessions.get(key)
+
+    def put(self, key, session_uri, offset, stat: os.stat_result):
+        with self._lock:
+            self._sessions[key] = {
+                'session_uri': session_uri, 'offset': offset,
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns
+            }
+        self.save()
+
+    def remove(self, key):
+        with self._lock:
+            if self._sessions.pop(key, None) is None:
+                return
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as state_file:
+                json.dump(self._sessions, state_file)
+            os.replace(tmp_path, self.path)
+
+class FolderIndex:
+    """Persistent local mirror of remote folders: (parent_id, name) -> folder_id.
+    Filled by a paginated crawl, kept fresh by the changes feed (polled at
+    most every max_age seconds, and on every miss). Names which map to
+    several folders are ambiguous and never answered locally."""
+    CHANGES_FIELDS = ('nextPageToken,newStartPageToken,'
+                      'changes(fileId,removed,file(id,name,parents,mimeType,trashed))')
+
+    def __init__(self, path=None, max_age=60.0):
+        self.path = path
+        self.max_age = max_age
+        self.page_token = None
+        self._refreshed_at = None
+        self._folders = {}
+        self._ambiguous = set()
+        self._lock = threading.RLock()
+        if path:
+            self.load()
+
+    def get(self, parent_id, name):
+        with self._lock:
+            return self._folders.get((parent_id, name))
+
+    def put(self, parent_id, name, folder_id):
+        with self._lock:
+            key = (parent_id, name)
+            if key in self._ambiguous:
+                return
+            known = self._folders.get(key)
+            if known is not None and known != folder_id:
+                del self._folders[key]
+                self._ambiguous.add(key)
+            else:
+                self._folders[key] = folder_id
+
+    def remove(self, folder_id):
+        """Forgets the folder and everything below it"""
+        with self._lock:
+            removed = [folder_id]
+            while removed:
+                gone = removed.pop()
+                for key in [k for k, v in self._folders.items() if v == gone or k[0] == gone]:
+                    if key[0] == gone:
+                        removed.append(self._folders[key])
+                    del self._folders[key]
+
+    def invalidate(self, parent_id, name):
+        """Forget a mapping after the remote side contradicted it"""
+        with self._lock:
+            folder_id = self._folders.pop((parent_id, name), None)
+            if folder_id:
+                self.remove(folder_id)
+
+    def _apply(self, resource):
+        """Applies folder metadata from a listing or a change"""
+        if resource.get('trashed') or resource.get('mimeType') != GDRIVE_MIMETYPES['folder']:
+            self.remove(resource['id'])
+            return
+        with self._lock:
+            for key in [k for k, v in self._folders.items() if v == resource['id']]:
+                del self._folders[key]
+            for parent_id in resource.get('parents', []):
+                self.put(parent_id, resource['name'], resource['id'])
+
+    def crawl(self, client):
+        """Rebuilds the index from a full paginated folder listing"""
+        page_token = client.service.changes().getStartPageToken().execute()['startPageToken']
+        query = "mimeType = '{}'"
+        folders = client._list(query, (GDRIVE_MIMETYPES['folder'],),
+                               fields='files(id,name,parents,mimeType)')['files']
+        with self._lock:
+            self._folders = {}
+            self._ambiguous = set()
+            for resource in folders:
+                self._apply(resource)
+            self.page_token = page_token
+            self._refreshed_at = time.monotonic()
+        logging.info('FolderIndex: crawled %d folders', len(folders))
+        self.save()
+
+    def refresh(self, client) -> bool:
+        """Applies pending changes feed pages. Return value: any changes"""
+        if self.page_token is None:
+            self.crawl(client)
+            return True
+        changed = False
+        page_token = self.page_token
+        while page_token:
+            response = client.service.changes().list(
+                pageToken=page_token, pageSize=1000, spaces='drive',
+                fields=self.CHANGES_FIELDS
+            ).execute()
+            for change in response.get('changes', []):
+                changed = True
+                if change.get('removed') or 'file' not in change:
+                    self.remove(change['fileId'])
+                else:
+                    self._apply(change['file'])
+            page_token = response.get('nextPageToken')
+            if 'newStartPageToken' in response:
+                self.page_token = response['newStartPageToken']
+        self._refreshed_at = time.monotonic()
+        if changed:
+            self.save()
+        return changed
+
+    def refresh_if_stale(self, client):
+        if self._refreshed_at is None or time.monotonic() - self._refreshed_at > self.max_age:
+            self.refresh(client)
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as index_file:
+                state = json.load(index_file)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, OSError) as e:
+            logging.warning('Discarding folder index %s: %s', self.path, e)
+            return
+        with self._lock:
+            self.page_token = state['page_token']
+            self._folders = {(parent, name): id_ for parent, name, id_ in state['folders']}
+            self._ambiguous = {tuple(key) for key in state['ambiguous']}
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            state = {
+                'page_token': self.page_token,
+                'folders': [[parent, name, id_] for (parent, name), id_ in self._folders.items()],
+                'ambiguous': [list(key) for key in self._ambiguous]
+            }
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as index_file:
+                json.dump(state, index_file)
+            os.replace(tmp_path, self.path)
 
 class GDriveClient:
-    def __init__(self, config):
-        self.creds = GDriveClient.get_creds(config)
-        self.service = build('drive', 'v3', credentials=self.creds)
+    def __init__(self, config, creds=None):
+        """creds: skip OAuth flow and use these (e.g. anonymous credentials
+        for a fake endpoint, see gdrive_fake.py)"""
+        self.creds = creds or GDriveClient.get_creds(config)
+        self._build_kwargs = {}
+        if config.gdrive_discovery_url:
+            self._build_kwargs = {
+                'discoveryServiceUrl': config.gdrive_discovery_url,
+                'static_discovery': False
+            }
+        self._local = threading.local()
+        self.session = AuthorizedSession(self.creds)
+        self.upload_url = config.gdrive_upload_url or GDRIVE_UPLOAD_URL
+        self.upload_workers = config.gdrive_upload_workers
+        self.chunk_size = config.gdrive_chunk_size or DEFAULT_CHUNK_SIZE
+        self.folder_index = None
+        if config.gdrive_folder_index:
+            self.folder_index = FolderIndex(config.gdrive_folder_index)
+        self.upload_state = UploadStateStore(config.gdrive_upload_state)
+        self.upload_retries = config.gdrive_upload_retries
+
+    @property
+    def service(self):
+        """Per-thread service object: httplib2 connections are not thread-safe"""
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = build('drive', 'v3', credentials=self.creds,
+                            cache_discovery=False, **self._build_kwargs)
+            self._local.service = service
+        return service
     
     @staticmethod
     def get_creds(config):
@@ -45,67 +354,305 @@ class GDriveClient:
     
     RemoteNode = namedtuple('RemoteNode', ('name',  'parent'))
     
-    def upload_file(self, local_path, remote: RemoteNode, on_progress: Callable = None):
-        mimetype = mimetypes.guess_type(local_path)[0]
-        media = MediaFileUpload(
-            local_path,
-            mimetype=mimetype,
-            resumable=True
-        )
-        
+    def upload_file(self, local_path, remote: RemoteNode, on_progress: Callable = None, chunk_size=None):
+        """Skips the upload if remote folder has a file with the same name,
+        size and md5. Otherwise continues a persisted session if there is
+        one; transient errors are retried with exponential backoff.
+        on_progress receives UploadProgress. Return value: file resource or
+        None on failure (the session is kept for the next attempt)."""
+        stat = os.stat(local_path)
+        chunk_size = chunk_size or self.chunk_size
+        chunk_size = max(1, chunk_size // ResumableUpload.CHUNK_ALIGN) * ResumableUpload.CHUNK_ALIGN
         try:
-            request = self.service.files().create(
-                body={'name': remote.name, 'parents': [remote.parent]},
-                media_body=media
+            existing = self._find_uploaded(local_path, remote, stat.st_size)
+            if existing:
+                logging.info('already uploaded, skipping: local=%s remote=%s', local_path, existing['id'])
+                return existing
+
+            key = UploadStateStore.make_key(local_path, remote.parent)
+            upload = self._resume_or_start(key, local_path, remote, stat)
+            started = time.monotonic()
+            resumed_at = upload.offset
+            retries = 0
+            with open(local_path, 'rb') as stream:
+                while True:
+                    try:
+                        stream.seek(upload.offset)
+                        response = upload.send(stream.read(chunk_size), stat.st_size)
+                    except Exception as e:
+                        if not ResumableUpload.is_transient(e) or retries >= self.upload_retries:
+                            raise
+                        retries = self._backoff(e, retries, local_path)
+                        try:
+                            upload.query_offset()
+                        except Exception as query_error:
+                            if not ResumableUpload.is_transient(query_error):
+                                raise
+                        continue
+                    retries = 0
+                    if response is not None:
+                        self.upload_state.remove(key)
+                        return response
+                    self.upload_state.put(key, upload.session_uri, upload.offset, stat)
+                    if on_progress:
+                        rate = (upload.offset - resumed_at) / max(time.monotonic() - started, 1e-6)
+                        on_progress(UploadProgress(local_path, upload.offset, stat.st_size, rate))
+        except Exception as e:
+            logging.exception('Exception during upload of %s', local_path)
+
+    def _resume_or_start(self, key, local_path, remote: RemoteNode, stat) -> ResumableUpload:
+        mimetype = mimetypes.guess_type(local_path)[0]
+        state = self.upload_state.get(key)
+        if state and state['size'] == stat.st_size and state['mtime_ns'] == stat.st_mtime_ns:
+            upload = ResumableUpload(self.session, self.upload_url, remote.name, remote.parent,
+                                     mimetype, session_uri=state['session_uri'])
+            retries = 0
+            while True:
+                try:
+                    upload.query_offset()
+                    logging.info('resuming upload at %d/%d: %s', upload.offset, stat.st_size, local_path)
+                    return upload
+                except Exception as e:
+                    if ResumableUpload.is_transient(e) and retries < self.upload_retries:
+                        retries = self._backoff(e, retries, local_path)
+                        continue
+                    if not isinstance(e, requests.HTTPError) or ResumableUpload.is_transient(e):
+                        raise
+                    logging.warning('stale upload session (%s), starting over: %s', e, local_path)
+                    break
+        upload = ResumableUpload(self.session, self.upload_url, remote.name, remote.parent, mimetype)
+        upload.start()
+        self.upload_state.put(key, upload.session_uri, 0, stat)
+        return upload
+
+    @staticmethod
+    def _backoff(error, retries, local_path) -> int:
+        """Sleeps before retry number retries + 1. Return value: retries + 1"""
+        delay = min(2 ** retries, 64)
+        logging.warning('upload error (%s), retry %d in %ds: %s', error, retries + 1, delay, local_path)
+        time.sleep(delay)
+        return retries + 1
+
+    def _find_uploaded(self, local_path, remote: RemoteNode, size) -> dict:
+        """Return value: remote file with same name, size and md5, or None"""
+        query = "name = '{}' and '{}' in parents"
+        query_args = (self._escape(remote.name), remote.parent)
+        candidates = [
+            found for found in self._list(query, query_args, fields='files(id,name,size,md5Checksum)')['files']
+            if int(found.get('size', -1)) == size
+        ]
+        if not candidates:
+            return None
+        md5 = hashlib.md5()
+        with open(local_path, 'rb') as stream:
+            for block in iter(lambda: stream.read(self.chunk_size), b''):
+                md5.update(block)
+        digest = md5.hexdigest()
+        for found in candidates:
+            if found.get('md5Checksum') == digest:
+                return found
+        return None
+
+    def upload_files(self, local_paths: List[str], remote_folder,
+                     on_file_progress: Callable[[UploadProgress], None] = None,
+                     on_total_progress: Callable[[UploadProgress], None] = None,
+                     workers=None, chunk_size=None) -> Dict[str, dict]:
+        """Uploads up to `workers` files at once. Callbacks are called from
+        worker threads after every chunk, one at a time; a file is finished
+        when its progress has sent == total. Return value: path -> file resource
+        (None if upload failed)"""
+        sizes = {path: os.path.getsize(path) for path in local_paths}
+        sent = dict.fromkeys(local_paths, 0)
+        started = time.monotonic()
+        lock = threading.Lock()
+
+        def report(path, sent_bytes):
+            with lock:
+                sent[path] = sent_bytes
+                elapsed = max(time.monotonic() - started, 1e-6)
+                total_sent = sum(sent.values())
+                if on_file_progress:
+                    on_file_progress(UploadProgress(path, sent_bytes, sizes[path], sent_bytes / elapsed))
+                if on_total_progress:
+                    on_total_progress(UploadProgress(None, total_sent, sum(sizes.values()), total_sent / elapsed))
+
+        def upload_one(path):
+            remote = GDriveClient.RemoteNode(os.path.basename(path), remote_folder)
+            response = self.upload_file(
+                path, remote,
+                on_progress=lambda progress: report(path, progress.sent),
+                chunk_size=chunk_size
             )
-            
-            response = None
-            while response is None:
-                status, response = request.next_chunk()
-                if status and on_progress:
-                    on_progress(status)
+            if response is not None:
+                report(path, sizes[path])
             return response
-        
+
+        with ThreadPoolExecutor(max_workers=workers or self.upload_workers) as pool:
+            return dict(zip(local_paths, pool.map(upload_one, local_paths)))
+
+    def upload_growing_file(self, local_path, remote: RemoteNode, exitcode: Future,
+                            chunk_size=32 * ResumableUpload.CHUNK_ALIGN, poll_interval=1.0,
+                            on_progress: Callable = None):
+        """Uploads a file while its writer is running. Complete chunks are sent
+        as they appear; the session is finalized once `exitcode` resolves to 0
+        and aborted on any other result (None included). Transient errors
+        are retried with backoff as in upload_file. on_progress receives
+        UploadProgress after every chunk, total is the size written so far.
+        Return value: file resource or None"""
+        mimetype = mimetypes.guess_type(local_path)[0]
+        upload = ResumableUpload(self.session, self.upload_url, remote.name, remote.parent, mimetype)
+        started = time.monotonic()
+
+        def report(size):
+            if on_progress:
+                rate = upload.offset / max(time.monotonic() - started, 1e-6)
+                on_progress(UploadProgress(local_path, upload.offset, size, rate))
+
+        try:
+            upload.start()
+            with open_when_created(local_path, exitcode, poll_interval) as stream:
+                while True:
+                    finished = exitcode.done()
+                    available = os.fstat(stream.fileno()).st_size - upload.offset
+                    while available >= chunk_size:
+                        self._send_retrying(upload, stream, chunk_size, None, local_path)
+                        size = os.fstat(stream.fileno()).st_size
+                        report(size)
+                        available = size - upload.offset
+                    if not finished:
+                        time.sleep(poll_interval)
+                        continue
+                    code = exitcode.result()
+                    if code != 0:
+                        logging.warning('writer failed (%s), aborting upload: %s', code, local_path)
+                        upload.abort()
+                        return None
+                    total_size = os.fstat(stream.fileno()).st_size
+                    response = None
+                    while response is None:
+                        response = self._send_retrying(upload, stream, chunk_size, total_size, local_path)
+                    report(total_size)
+                    return response
         except Exception as e:
-            print(f'Exception during upload: {e}')
+            logging.exception('Exception during streaming upload of %s', local_path)
+            try:
+                upload.abort()
+            except Exception:
+                pass
 
-    def upload_files(self, local_paths, remote_folder, on_each = None, on_progress = None):
-        for path in local_paths:
-            name = os.path.basename(path)
-            self.upload_file(path, GDriveClient.RemoteNode(name, remote_folder), on_progress)
-            on_each(path)
+    def _send_retrying(self, upload: ResumableUpload, stream, chunk_size, total_size, local_path):
+        """Sends the chunk at upload.offset, transient errors are retried
+        up to upload_retries times. Return value: same as upload.send"""
+        retries = 0
+        while True:
+            try:
+                stream.seek(upload.offset)
+                return upload.send(stream.read(chunk_size), total_size)
+            except Exception as e:
+                if not ResumableUpload.is_transient(e) or retries >= self.upload_retries:
+                    raise
+                retries = self._backoff(e, retries, local_path)
+                try:
+                    upload.query_offset()
+                except Exception as query_error:
+                    if not ResumableUpload.is_transient(query_error):
+                        raise
 
     def _list(self, query, query_args, trashed=False, fields='*'):
         """
-        Query arguments should be properly escaped. Observes only first page
-        of results.
+        Query arguments should be properly escaped. Follows all pages, the
+        result has every page's files under 'files'.
         """
-        request = self.service.files().list(
-            q=query.format(*query_args) + ' and trashed = {}'.format(trashed),
-            fields=fields,
-            corpora='user'
-        )
-        return request.execute()
+        if fields != '*':
+            fields = 'nextPageToken,' + fields
+        files = []
+        page_token = None
+        while True:
+            request = self.service.files().list(
+                q=query.format(*query_args) + ' and trashed = {}'.format(trashed),
+                fields=fields,
+                corpora='user',
+                pageSize=1000,
+                pageToken=page_token
+            )
+            response = request.execute()
+            files.extend(response.get('files', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return {'files': files}
 
-    def _mkdir(self, name: str, parent_id: str) -> str:
-        """No existence checks. Return value: folder id."""
+    def _mkdir_request(self, name: str, parent_id: str):
         metadata = {
             'name': name,
             'parents': [parent_id],
             'mimeType': GDRIVE_MIMETYPES['folder']
         }
-        request = self.service.files().create(body=metadata, fields='id')
-        folder = request.execute()
+        return self.service.files().create(body=metadata, fields='id')
+
+    def _mkdir(self, name: str, parent_id: str) -> str:
+        """No existence checks. Return value: folder id."""
+        folder = self._mkdir_request(name, parent_id).execute()
         return folder.get('id')
 
-    def mkdir(self, name: str, parent_id: str, exist_ok=False) -> str:
-        """Return value: folder id."""
+    @staticmethod
+    def _escape(name: str) -> str:
+        return name.replace("\\", "\\\\").replace("'", "\\'")
+
+    @staticmethod
+    def _folder_query(name: str, parent_id: str):
+        """Return value: (query, query_args) for _list"""
         query = "name = '{}' and '{}' in parents and mimeType = '{}'"
         query_args = (
-            name.replace("\\", "\\\\").replace("'", "\\'"),
+            GDriveClient._escape(name),
             parent_id,
             GDRIVE_MIMETYPES['folder']
         )
+        return query, query_args
+
+    def _execute_batch(self, requests) -> list:
+        """Sends requests as Drive batch requests of up to BATCH_LIMIT calls.
+        Return value: responses in order. Raises the first call error."""
+        responses = [None] * len(requests)
+        for start in range(0, len(requests), BATCH_LIMIT):
+            errors = []
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    errors.append(exception)
+                else:
+                    responses[int(request_id)] = response
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for idx in range(start, min(start + BATCH_LIMIT, len(requests))):
+                batch.add(requests[idx], request_id=str(idx))
+            batch.execute()
+            if errors:
+                raise errors[0]
+        return responses
+
+    def mkdir(self, name: str, parent_id: str, exist_ok=False) -> str:
+        """Return value: folder id.
+        With a folder index, a lookup is a local hit or, after a changes feed
+        refresh, a definite miss followed by one create request."""
+        if self.folder_index is None:
+            return self._mkdir_remote(name, parent_id, exist_ok)
+
+        self.folder_index.refresh_if_stale(self)
+        folder_id = self.folder_index.get(parent_id, name)
+        if folder_id is None and self.folder_index.refresh(self):
+            folder_id = self.folder_index.get(parent_id, name)
+        if folder_id is not None:
+            if not exist_ok:
+                raise FileExistsError(folder_id)
+            return folder_id
+        folder_id = self._mkdir(name, parent_id)
+        self.folder_index.put(parent_id, name, folder_id)
+        self.folder_index.save()
+        return folder_id
+
+    def _mkdir_remote(self, name: str, parent_id: str, exist_ok=False) -> str:
+        """mkdir by remote lookup only"""
+        query, query_args = self._folder_query(name, parent_id)
         fields = 'files(id,kind,owners(emailAddress))'
         matches = self._list(query, query_args, fields=fields).get('files')
         if matches:
@@ -116,15 +663,99 @@ class GDriveClient:
         else:
             return self._mkdir(name, parent_id)
 
-    def makedirs(self, path: str, local_root: str, remote_root_id: str = 'root', exist_ok=False) -> str:
-        """Return value: folder id."""
+    @staticmethod
+    def _relative_parts(path: str, local_root: str) -> tuple:
         path_r, local_root_r = map(os.path.realpath, (path, local_root))
         common = os.path.commonpath((path_r, local_root_r))
         if not os.path.samefile(common, local_root):
             raise ValueError('path outside local_root')
         
         rel = os.path.relpath(path, start=local_root)
-        parts = pathlib.PurePath(rel).parts
+        return pathlib.PurePath(rel).parts
+
+    def makedirs(self, path: str, local_root: str, remote_root_id: str = 'root', exist_ok=False) -> str:
+        """Return value: folder id."""
+        parts = self._relative_parts(path, local_root)
+        try:
+            return self._makedirs(parts, remote_root_id, exist_ok)
+        except HttpError as e:
+            if self.folder_index is None or e.resp.status != 404:
+                raise
+            # Some cached parent is gone: drop the path and look it up remotely
+            logging.warning('Folder index conflict at %s: %s', path, e)
+            parent = remote_root_id
+            for idx, dirname in enumerate(parts):
+                self.folder_index.invalidate(parent, dirname)
+                last = idx == len(parts) - 1
+                child = self._mkdir_remote(dirname, parent, exist_ok=exist_ok or not last)
+                self.folder_index.put(parent, dirname, child)
+                parent = child
+            self.folder_index.save()
+            return parent
+
+    def makedirs_many(self, paths: List[str], local_root: str, remote_root_id: str = 'root') -> Dict[str, str]:
+        """Same as makedirs(path, local_root, remote_root_id, exist_ok=True)
+        for every path, but with one batch of lookups and one batch of
+        creates per tree level (lookups are local with a folder index).
+        Return value: path -> folder id."""
+        parts_of = {path: self._relative_parts(path, local_root) for path in paths}
+        prefixes = {parts[:depth] for parts in parts_of.values() for depth in range(1, len(parts) + 1)}
+        resolved = {(): remote_root_id}
+        depth = 1
+        while True:
+            level = sorted(prefix for prefix in prefixes if len(prefix) == depth)
+            if not level:
+                break
+            missing = self._lookup_level(level, resolved)
+            requests = [self._mkdir_request(prefix[-1], resolved[prefix[:-1]]) for prefix in missing]
+            for prefix, folder in zip(missing, self._execute_batch(requests)):
+                resolved[prefix] = folder['id']
+                if self.folder_index is not None:
+                    self.folder_index.put(resolved[prefix[:-1]], prefix[-1], folder['id'])
+            depth += 1
+        if self.folder_index is not None:
+            self.folder_index.save()
+        return {path: resolved[parts] for path, parts in parts_of.items()}
+
+    def _lookup_level(self, level, resolved) -> list:
+        """Resolves folders of one tree level into `resolved`.
+        Return value: prefixes which do not exist yet"""
+        if self.folder_index is not None:
+            self.folder_index.refresh_if_stale(self)
+            missing = self._lookup_in_index(level, resolved)
+            if missing and self.folder_index.refresh(self):
+                missing = self._lookup_in_index(missing, resolved)
+            return missing
+
+        requests = []
+        for prefix in level:
+            query, query_args = self._folder_query(prefix[-1], resolved[prefix[:-1]])
+            requests.append(self.service.files().list(
+                q=query.format(*query_args) + ' and trashed = false',
+                fields='files(id)', corpora='user', pageSize=1000
+            ))
+        missing = []
+        for prefix, response in zip(level, self._execute_batch(requests)):
+            matches = response.get('files', [])
+            if len(matches) > 1:
+                raise FileExistsError(str(matches))
+            elif matches:
+                resolved[prefix] = matches[0]['id']
+            else:
+                missing.append(prefix)
+        return missing
+
+    def _lookup_in_index(self, level, resolved) -> list:
+        missing = []
+        for prefix in level:
+            folder_id = self.folder_index.get(resolved[prefix[:-1]], prefix[-1])
+            if folder_id is None:
+                missing.append(prefix)
+            else:
+                resolved[prefix] = folder_id
+        return missing
+
+    def _makedirs(self, parts, remote_root_id, exist_ok):
         parent = remote_root_id
         if parts:
             for dirname in parts[:-1]:
@@ -133,6 +764,17 @@ class GDriveClient:
         else:
             return remote_root_id
 
+def open_when_created(path, writer_done: Future, poll_interval):
+    """Waits until the writer creates the file. Raises FileNotFoundError if
+    the writer finishes without creating it"""
+    while True:
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            if writer_done.done():
+                raise
+            time.sleep(poll_interval)
+
 if __name__ == '__main__':
     from config import Config
     Config.update('config.json')
@@ -0,0 +1,383 @@
+"""Local stand-in for the parts of Drive v3 API used by GDriveClient.
+
+Serves a rewritten discovery document, so a real GDriveClient (with
+gdrive.discovery_url pointing here) talks to it unmodified. Supports resumable
+uploads, folder create/list with pagination, the changes feed and batch
+requests of metadata calls. Every
+request can be slowed down to emulate one TCP stream that does not fill the
+uplink.
+
+Benchmarks of upload parallelism/chunk size and of batched folder creation:
+(venv) $ python gdrive_fake.py --files 4 --size 64 --stream-rate 20
+(venv) $ python gdrive_fake.py --bench folders --groups 10
+"""
+
+import email.parser
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+class FakeDriveServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, bind_addr, stream_rate=None, latency=0.0, page_size=100, failure_rate=0.0):
+        """stream_rate: bytes per second per request body, None = unlimited
+        latency: seconds added to every request
+        failure_rate: share of upload chunks answered with 503"""
+        super(FakeDriveServer, self).__init__(bind_addr, FakeDriveHandler)
+        self.stream_rate = stream_rate
+        self.latency = latency
+        self.page_size = page_size
+        self.failure_rate = failure_rate
+        self.files = {'root': {'id': 'root', 'name': 'root', 'parents': [], 'mimeType': FOLDER_MIMETYPE}}
+        self.sessions = {}
+        self.changes = []  # changed file ids, page token is an index here
+        self.request_count = 0  # HTTP requests, a batch counts once
+        self.call_count = 0  # API calls, including ones inside batches
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    @property
+    def discovery_url(self):
+        return self.base_url + 'discovery/{api}/{apiVersion}'
+
+    def new_id(self, prefix='file'):
+        return f'{prefix}{next(self._ids)}'
+
+    def add_file(self, metadata, size=None, md5=None):
+        with self.lock:
+            file_id = self.new_id()
+            resource = {
+                'id': file_id, 'kind': 'drive#file',
+                'name': metadata.get('name', 'Untitled'),
+                'parents': metadata.get('parents', ['root']),
+                'mimeType': metadata.get('mimeType', 'application/octet-stream'),
+                'trashed': False,
+            }
+            if size is not None:
+                resource['size'] = str(size)
+                resource['md5Checksum'] = md5
+            self.files[file_id] = resource
+            self.changes.append(file_id)
+            return resource
+
+    def trash(self, file_id):
+        """Out-of-band removal, as if done by another client"""
+        with self.lock:
+            self.files[file_id]['trashed'] = True
+            self.changes.append(file_id)
+
+    def serve_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _begin(self):
+        with self.server.lock:
+            self.server.request_count += 1
+            self.server.call_count += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.url = urllib.parse.urlsplit(self.path)
+        self.query = dict(urllib.parse.parse_qsl(self.url.query))
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.server.stream_rate and length:
+            time.sleep(length / self.server.stream_rate)
+        return body
+
+    def _reply(self, code, obj=None, headers=None):
+        payload = json.dumps(obj).encode() if obj is not None else b''
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if obj is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _metadata_call(self, method, path, query, body):
+        """Calls allowed both directly and inside a batch.
+        Return value: (HTTP code, JSON object)"""
+        path = path.rstrip('/')
+        parts = path.strip('/').split('/')
+        if method == 'GET' and path == '/drive/v3/files':
+            return 200, self._list_files(query)
+        if method == 'GET' and path == '/drive/v3/changes/startPageToken':
+            return 200, {'startPageToken': str(len(self.server.changes))}
+        if method == 'GET' and path == '/drive/v3/changes':
+            return 200, self._list_changes(query)
+        if method == 'GET' and path.startswith('/drive/v3/files/'):
+            resource = self.server.files.get(parts[-1])
+            if resource:
+                return 200, resource
+            return 404, {'error': {'code': 404, 'message': 'File not found'}}
+        if method == 'POST' and path == '/drive/v3/files':
+            metadata = json.loads(body or b'{}')
+            for parent in metadata.get('parents', []):
+                if parent not in self.server.files or self.server.files[parent].get('trashed'):
+                    return 404, {'error': {'code': 404, 'message': f'File not found: {parent}'}}
+            return 200, self.server.add_file(metadata)
+        return 404, {'error': {'code': 404, 'message': path}}
+
+    def do_GET(self):
+        self._begin()
+        parts = self.url.path.strip('/').split('/')
+        if parts[0] == 'discovery':
+            self._reply(200, self._discovery_doc(*parts[1:3]))
+        else:
+            self._reply(*self._metadata_call('GET', self.url.path, self.query, b''))
+
+    def do_POST(self):
+        self._begin()
+        body = self._read_body()
+        if self.url.path.rstrip('/') == '/batch/drive/v3':
+            self._batch(body)
+        elif self.url.path.startswith('/upload/') and self.query.get('uploadType') == 'resumable':
+            metadata = json.loads(body or b'{}')
+            with self.server.lock:
+                upload_id = self.server.new_id('upload')
+                self.server.sessions[upload_id] = {
+                    'metadata': metadata, 'received': 0, 'md5': hashlib.md5()
+                }
+            location = f'{self.server.base_url}upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}'
+            self._reply(200, headers={'Location': location})
+        else:
+            self._reply(*self._metadata_call('POST', self.url.path, self.query, body))
+
+    def _batch(self, body):
+        """multipart/mixed of application/http parts, answered in order"""
+        content_type = self.headers['Content-Type']
+        message = email.parser.BytesParser().parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        boundary = 'fake_batch_boundary'
+        answer = []
+        for part in message.get_payload():
+            request_line, _, serialized = part.get_payload().partition('\n')
+            method, target = request_line.split(' ')[:2]
+            inner = email.parser.Parser().parsestr(serialized)
+            url = urllib.parse.urlsplit(target)
+            with self.server.lock:
+                self.server.call_count += 1
+            code, obj = self._metadata_call(
+                method, url.path, dict(urllib.parse.parse_qsl(url.query)),
+                (inner.get_payload() or '').encode())
+            answer.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\n'
+                f'Content-ID: <response-{part["Content-ID"][1:-1]}>\r\n\r\n'
+                f'HTTP/1.1 {code} {self.responses.get(code, ("",))[0]}\r\n'
+                f'Content-Type: application/json\r\n\r\n{json.dumps(obj)}\r\n'
+            )
+        answer.append(f'--{boundary}--\r\n')
+        payload = ''.join(answer).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_PUT(self):
+        self._begin()
+        body = self._read_body()
+        session = self.server.sessions.get(self.query.get('upload_id'))
+        if session is None:
+            self._reply(404, {'error': {'code': 404, 'message': 'No such upload'}})
+            return
+        match = re.match(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)', self.headers.get('Content-Range', ''))
+        if not match:
+            self._reply(400, {'error': {'code': 400, 'message': 'Bad Content-Range'}})
+            return
+        if body and random.random() < self.server.failure_rate:
+            self._reply(503, {'error': {'code': 503, 'message': 'Backend Error'}})
+            return
+        if match.group(2) is not None and int(match.group(2)) == session['received']:
+            session['md5'].update(body)
+            session['received'] += len(body)
+        total = match.group(4)
+        if total != '*' and session['received'] == int(total):
+            del self.server.sessions[self.query['upload_id']]
+            resource = self.server.add_file(session['metadata'], session['received'], session['md5'].hexdigest())
+            self._reply(200, resource)
+        elif session['received']:
+            self._reply(308, headers={'Range': f'bytes=0-{session["received"] - 1}'})
+        else:
+            self._reply(308)
+
+    def do_DELETE(self):
+        self._begin()
+        self.server.sessions.pop(self.query.get('upload_id'), None)
+        self._reply(499, {'error': {'code': 499, 'message': 'Client Closed Request'}})
+
+    def _discovery_doc(self, api, version):
+        from googleapiclient.discovery_cache import get_static_doc
+        doc = json.loads(get_static_doc(api, version))
+        doc['rootUrl'] = doc['mtlsRootUrl'] = self.server.base_url
+        doc['baseUrl'] = self.server.base_url + doc['servicePath']
+        return doc
+
+    def _list_changes(self, query):
+        start = int(query.get('pageToken', 0))
+        page_size = min(int(query.get('pageSize', self.server.page_size)), self.server.page_size)
+        with self.server.lock:
+            file_ids = self.server.changes[start:start + page_size]
+            changes = [{'fileId': id_, 'removed': False, 'file': dict(self.server.files[id_])}
+                       for id_ in file_ids]
+            result = {'kind': 'drive#changeList', 'changes': changes}
+            if start + page_size < len(self.server.changes):
+                result['nextPageToken'] = str(start + page_size)
+            else:
+                result['newStartPageToken'] = str(len(self.server.changes))
+        return result
+
+    def _list_files(self, query):
+        """Understands the conjunctions GDriveClient builds:
+        name = '...', '...' in parents, mimeType = '...', trashed = ..."""
+        q = query.get('q', '')
+        conditions = []
+        for clause in re.split(r'\s+and\s+', q):
+            clause = clause.strip()
+            if not clause:
+                continue
+            match = re.match(r"'((?:[^'\\]|\\.)*)' in parents$", clause)
+            if match:
+                parent = match.group(1)
+                conditions.append(lambda f, p=parent: p in f.get('parents', []))
+                continue
+            match = re.match(r"(\w+)\s*=\s*'((?:[^'\\]|\\.)*)'$", clause)
+            if match:
+                key, value = match.group(1), re.sub(r'\\(.)', r'\1', match.group(2))
+                conditions.append(lambda f, k=key, v=value: f.get(k) == v)
+                continue
+            match = re.match(r'trashed\s*=\s*(true|false)$', clause, re.IGNORECASE)
+            if match:
+                trashed = match.group(1).lower() == 'true'
+                conditions.append(lambda f, t=trashed: f.get('trashed', False) == t)
+        with self.server.lock:
+            matches = [f for id_, f in sorted(self.server.files.items())
+                       if id_ != 'root' and all(cond(f) for cond in conditions)]
+        page_size = min(int(query.get('pageSize', self.server.page_size)), self.server.page_size)
+        start = int(query.get('pageToken', 0))
+        result = {'kind': 'drive#fileList', 'files': matches[start:start + page_size]}
+        if start + page_size < len(matches):
+            result['nextPageToken'] = str(start + page_size)
+        return result
+
+def bench_uploads(server, client, args):
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as workdir:
+        paths = []
+        for idx in range(args.files):
+            path = os.path.join(workdir, f'file_{idx}.bin')
+            with open(path, 'wb') as stream:
+                stream.write(os.urandom(args.size * 2**20))
+            paths.append(path)
+        total = args.files * args.size
+        print(f'{"workers":>8} {"chunk, KiB":>10} {"MiB/s":>8} {"requests":>9}')
+        for workers in (1, 2, 4):
+            for chunk_size in (256 * 1024, 2 * 2**20, 8 * 2**20, 32 * 2**20):
+                # a fresh folder, or files of the previous run are skipped as already uploaded
+                folder_id = client.mkdir(f'bench_{workers}_{chunk_size}', 'root')
+                requests_before = server.request_count
+                began = time.monotonic()
+                client.upload_files(paths, folder_id, workers=workers, chunk_size=chunk_size)
+                elapsed = time.monotonic() - began
+                print(f'{workers:8} {chunk_size // 1024:10} {total / elapsed:8.1f} '
+                      f'{server.request_count - requests_before:9}')
+
+def remote_path(server, file_id, root_id) -> tuple:
+    """Names from root_id (exclusive) down to file_id"""
+    parts = []
+    while file_id != root_id:
+        resource = server.files[file_id]
+        assert resource['mimeType'] == FOLDER_MIMETYPE and not resource['trashed'], resource
+        parts.append(resource['name'])
+        file_id = resource['parents'][0]
+    return tuple(reversed(parts))
+
+def bench_folders(server, client, args):
+    """date/#NN_time/ hierarchy of one card: makedirs one by one vs batched.
+    Checks that both build the same tree and that batching again creates nothing"""
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as workdir:
+        paths = []
+        for idx in range(args.groups):
+            path = os.path.join(workdir, f'2019.11.{1 + idx // 4:02}', f'#{idx:02}-10_00_00')
+            os.makedirs(path, exist_ok=True)
+            paths.append(path)
+        expected = [tuple(os.path.relpath(path, workdir).split(os.sep)) for path in paths]
+        request_counts = {}
+        for label, remote_root in (('makedirs', 'sequential'), ('makedirs_many', 'batched')):
+            root_id = client.mkdir(remote_root, 'root')
+            requests_before = server.request_count
+            began = time.monotonic()
+            if label == 'makedirs':
+                ids = [client.makedirs(path, workdir, root_id, exist_ok=True) for path in paths]
+            else:
+                ids = list(client.makedirs_many(paths, workdir, root_id).values())
+            elapsed = time.monotonic() - began
+            request_counts[label] = server.request_count - requests_before
+            print(f'{label:>14}: {request_counts[label]:4} HTTP requests, '
+                  f'{elapsed * 1000:8.1f} ms, {len(set(ids))} folders')
+            assert [remote_path(server, id_, root_id) for id_ in ids] == expected, label
+
+        files_before = len(server.files)
+        assert client.makedirs_many(paths, workdir, root_id) == dict(zip(paths, ids)), 'ids changed'
+        assert len(server.files) == files_before, 'existing folders created again'
+        assert request_counts['makedirs_many'] < request_counts['makedirs'], request_counts
+
+if __name__ == '__main__':
+    import argparse
+    import types
+    from google.auth.credentials import AnonymousCredentials
+    from gdrive_client import GDriveClient
+
+    parser = argparse.ArgumentParser(description='GDriveClient benchmarks against a local fake Drive')
+    parser.add_argument('--bench', choices=['uploads', 'folders'], default='uploads')
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--size', type=int, default=32, help='File size, MiB')
+    parser.add_argument('--groups', type=int, default=10, help='Folders for --bench folders')
+    parser.add_argument('--stream-rate', type=float, default=20, help='Per-request rate limit, MiB/s')
+    parser.add_argument('--latency', type=float, default=0.02, help='Per-request latency, s')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of failed upload chunks')
+    args = parser.parse_args()
+
+    server = FakeDriveServer(('127.0.0.1', 0), args.stream_rate * 2**20, args.latency,
+                             failure_rate=args.failure_rate)
+    server.serve_in_thread()
+    config = types.SimpleNamespace(
+        gdrive_discovery_url=server.discovery_url,
+        gdrive_upload_url=server.base_url + 'upload/drive/v3/files',
+        gdrive_upload_workers=1, gdrive_chunk_size=None, gdrive_folder_index=None,
+        gdrive_upload_state=None, gdrive_upload_retries=8
+    )
+    client = GDriveClient(config, creds=AnonymousCredentials())
+    if args.bench == 'uploads':
+        bench_uploads(server, client, args)
+    else:
+        bench_folders(server, client, args)
+    server.shutdown()
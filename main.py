@@ -7,9 +7,12 @@ import os.path
 import sys
 import progressbar
 import concat_ng.tasks
+from concat_ng.catalog import RecordingCatalog
+from concat_ng.probe_cache import ProbeCache
 from typing import List, Dict
 from config import Config
 from transcode_v2 import transcode
+from transcode_v2.cache import OutputCache
 from gdrive_client import GDriveClient
 
 def parse_cmdline():
@@ -17,6 +20,7 @@ def parse_cmdline():
     parser.add_argument("-i", "--input", required=True, help="Path to sd card root")
     parser.add_argument("-o", "--output", required=True, help="Path to lectorium folder root")
     parser.add_argument("-p", "--profile", required=False, help="Trancoding profile to use")
+    parser.add_argument("-s", "--segments", required=False, type=int, help="Encode this many keyframe-aligned parts in parallel")
     parser.add_argument("-c", "--config", required=False, default="config_default.json", help="Path to configuration")
     parser.add_argument("-u", "--upload", required=False, action='store_true', help="Upload output to Google Drive")
     parser.add_argument("--folder-id", required=False, dest="gdrive_parent", help="ID of Google Drive destination folder")
@@ -24,54 +28,75 @@ def parse_cmdline():
     return parser.parse_args()
 
 class GDriveProgressSentry:
-    def __init__(self, files):
-        self.files = functools.reduce(lambda flat, x: flat + x, files.values())
-        self.index = 0
-        self.next_file()
-    
-    def next_file(self):
-        logging.info("Uploading {}".format(self.files[self.index]))
-        self.bar = progressbar.ProgressBar(widgets=[progressbar.Percentage()], max_value=100.0).start()
+    """One progress bar per group, files of a group upload concurrently"""
+    def start(self, files):
+        logging.info("Uploading {}".format(files))
+        self.bar = progressbar.ProgressBar(
+            widgets=[progressbar.Percentage()],
+            max_value=100.0
+        ).start()
         self.bar.update(0)
     
-    def on_progress(self, upload_progress):
-        self.bar.update(int(100 * upload_progress.progress()))
+    def on_total_progress(self, upload_progress):
+        self.bar.update(100.0 * upload_progress.sent / max(upload_progress.total, 1))
+    
+    def on_file_progress(self, upload_progress):
+        if upload_progress.sent == upload_progress.total:
+            logging.info(f"Upload finished: {upload_progress.path}")
     
-    def on_each(self, finished_file):
+    def finish(self):
         self.bar.finish()
-        logging.info(f"Upload finished: {finished_file}")
-        self.index += 1
-        if self.index < len(self.files):
-            self.next_file()
 
 class Uploader:
-    def __init__(self, cmdline):
+    def __init__(self, cmdline, catalog: RecordingCatalog):
         self.gdrive_client = GDriveClient(Config)
         self.output_dir = cmdline.output
         self.root_id = cmdline.gdrive_parent or Config.root_id
+        self.catalog = catalog
 
-    def upload(self, outputs: Dict[str, List[str]]):
-        progress_sentry = GDriveProgressSentry(outputs)
+    def upload(self, outputs: Dict[str, List[str]], exitcodes: Dict[str, int]):
+        """Groups transcoded and uploaded in full are marked done in the catalog"""
+        progress_sentry = GDriveProgressSentry()
+        folder_ids = self.gdrive_client.makedirs_many(
+            [os.path.dirname(group_label) for group_label in outputs],
+            self.output_dir, self.root_id
+        )
         for group_label, entries in outputs.items():
-            local_dir = os.path.dirname(group_label)
-            folder_id = self.gdrive_client.makedirs(
-                local_dir, self.output_dir, self.root_id, exist_ok=True
-            )
-            self.gdrive_client.upload_files(entries, folder_id,
-                on_progress=progress_sentry.on_progress,
-                on_each=progress_sentry.on_each
+            folder_id = folder_ids[os.path.dirname(group_label)]
+            progress_sentry.start(entries)
+            results = self.gdrive_client.upload_files(entries, folder_id,
+                on_file_progress=progress_sentry.on_file_progress,
+                on_total_progress=progress_sentry.on_total_progress
             )
+            progress_sentry.finish()
+            if exitcodes.get(group_label) == 0 and entries and all(results.get(path) for path in entries):
+                self.catalog.complete(concat_ng.tasks.catalog_destination(group_label, self.output_dir))
+                self.catalog.save()
 
 def main():
     logging.basicConfig(level=logging.INFO)
     args = parse_cmdline()
     Config.update(args.config)
 
-    transcoder = functools.partial(transcode, args.profile or Config.ff_default_profile, stderr=sys.stderr)
-    outputs = concat_ng.tasks.execute_from_v2(args, transcoder)
+    run_transcode = transcode
+    if Config.transcode_cache_dir:
+        cache = OutputCache(Config.transcode_cache_dir, Config.transcode_cache_max_bytes)
+        run_transcode = lambda *params, **options: cache.transcode(*params, **options)[:2]
+    transcoder = functools.partial(run_transcode, args.profile or Config.ff_default_profile, stderr=sys.stderr,
+                                   segments=args.segments or Config.ff_segments)
+    probe_cache = ProbeCache(Config.probe_cache_path, Config.probe_cache_size)
+    catalog = RecordingCatalog(Config.catalog_path)
+    exitcodes = {}  # destination -> ffmpeg exit code
+
+    def transcode_group(inputs, destination):
+        exitcode, sinks = transcoder(inputs, destination)
+        exitcodes[destination] = exitcode
+        return exitcode, sinks
+
+    outputs = concat_ng.tasks.execute_from_v2(args, transcode_group, probe_cache, Config.probe_workers, catalog)
     if args.upload:
-        uploader = Uploader(args)
-        uploader.upload(outputs)
+        uploader = Uploader(args, catalog)
+        uploader.upload(outputs, exitcodes)
 
 if __name__ == "__main__":
     main()
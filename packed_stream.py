@@ -1,9 +1,17 @@
 import io
+import mmap
+import os
+import socket
 import struct
+import zlib
+from collections import namedtuple
+from contextlib import ExitStack
 from typing import List
 
 
-BUFFER_SIZE = 0x1000
+BUFFER_SIZE = 1 << 20
+SENDFILE_CHUNK = 16 << 20
+SIZE = struct.Struct(">Q")
 
 class StreamPackWriter:
     """Sequentially writes several streams into one.
@@ -11,72 +19,305 @@ class StreamPackWriter:
     Output format: number of stream and concatenation of (size, chunk) pairs
     for each input stream, where size is stream length and chunk is stream content.
     All inetegers are 8-byte unsigned big-endian.
+    dest may be a blocking socket, then inputs backed by files are sent with
+    os.sendfile without copying through userspace.
     """
-    
-    def __init__(self, dest: io.BufferedWriter):
+
+    def __init__(self, dest, buffer_size=BUFFER_SIZE, use_sendfile=True):
         self.inputs = []
         self.output = dest
-    
+        self.buffer_size = buffer_size
+        self.use_sendfile = use_sendfile and isinstance(dest, socket.socket)
+        self._buffer = None
+
     def add_input(self, stream: io.BufferedReader):
         self.inputs.append(stream)
-    
+
     def transmit(self):
-        self.output.write(struct.pack(">Q", len(self.inputs)))
+        self._write(SIZE.pack(len(self.inputs)))
         for stream in self.inputs:
             cpos = stream.tell()
             stream.seek(0, io.SEEK_END)
             size = stream.tell() - cpos
             stream.seek(cpos)
             self._transmit_stream(stream, size)
-    
+
+    def _write(self, data):
+        if isinstance(self.output, socket.socket):
+            self.output.sendall(data)
+        else:
+            self.output.write(data)
+
     def _transmit_stream(self, stream, size):
-        buf = struct.pack(">Q", size)
-        while buf:
-            print(f"{buf}")
-            self.output.write(buf)
-            buf = stream.read(BUFFER_SIZE)
+        self._write(SIZE.pack(size))
+        self._transmit_data(stream, size)
+
+    def _transmit_data(self, stream, size):
+        fileno = self._fileno(stream) if self.use_sendfile else None
+        if fileno is not None:
+            offset = stream.tell()
+            self._sendfile(fileno, offset, size)
+            stream.seek(offset + size)
+            return
+        if self._buffer is None:
+            self._buffer = memoryview(bytearray(self.buffer_size))
+        remaining = size
+        while remaining:
+            count = stream.readinto(self._buffer[:min(self.buffer_size, remaining)])
+            if not count:
+                raise EOFError("Input stream truncated")
+            self._write(self._buffer[:count])
+            remaining -= count
+
+    @staticmethod
+    def _fileno(stream):
+        try:
+            return stream.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return None
+
+    def _sendfile(self, fileno, offset, size):
+        out_fileno = self.output.fileno()
+        while size:
+            sent = os.sendfile(out_fileno, fileno, offset, min(size, SENDFILE_CHUNK))
+            if not sent:
+                raise EOFError("Input stream truncated")
+            offset += sent
+            size -= sent
 
 class StreamPackReader:
-    """Decodes stream pack into original streams. """
-    
-    def __init__(self, source: io.BufferedReader):
+    """Decodes stream pack into original streams.
+    source: binary stream or socket, read with readinto() into one reused buffer."""
+
+    def __init__(self, source, buffer_size=BUFFER_SIZE):
         self.source = source
-        stream_count_enc = source.read(8)
-        self.stream_count = struct.unpack(">Q", stream_count_enc)[0]
+        if isinstance(source, socket.socket):
+            self._readinto = source.recv_into
+        else:
+            self._readinto = source.readinto
+        self.buffer_size = buffer_size
+        self._buffer = memoryview(bytearray(max(buffer_size, SIZE.size)))
+        self.stream_count = self._read_size()
         self.outputs = None
-    
+
     def set_outputs(self, outputs: List[io.BufferedWriter]):
         self.outputs = outputs
-    
+
     def receive(self, outputs):
         if len(outputs) != self.stream_count:
             raise ValueError("Output count mismatch")
         for stream in outputs:
             self._receive_stream(stream)
-    
+
+    def _read_size(self) -> int:
+        received = 0
+        while received < SIZE.size:
+            count = self._readinto(self._buffer[received:SIZE.size])
+            if not count:
+                raise EOFError("Stream pack truncated")
+            received += count
+        return SIZE.unpack(self._buffer[:SIZE.size])[0]
+
     def _receive_stream(self, output):
-        stream_size_enc = self.source.read(8)
-        stream_size = struct.unpack(">Q", stream_size_enc)[0]
-        recv_size = 0
-        while recv_size < stream_size:
-            buf = self.source.read(min(BUFFER_SIZE, stream_size - recv_size))
-            recv_size += len(buf)
-            output.write(buf)
+        remaining = self._read_size()
+        while remaining:
+            count = self._readinto(self._buffer[:min(self.buffer_size, remaining)])
+            if not count:
+                raise EOFError("Stream pack truncated")
+            output.write(self._buffer[:count])
+            remaining -= count
+
+class ChecksumError(ValueError):
+    pass
+
+PackEntry = namedtuple("PackEntry", ["name", "offset", "size", "crc32"])
+PackEntry.__doc__ = """Member of an indexed pack, offset is absolute in the pack file"""
+
+TOC_ENTRY = struct.Struct(">QQIH")  # offset, size, crc32, name length
+FOOTER = struct.Struct(">QQ8s")  # toc offset, toc size, magic
+INDEXED_MAGIC = b"SPACKv2\0"
+
+class IndexedStreamPackWriter(StreamPackWriter):
+    """Writes stream pack v2: the same stream as StreamPackWriter (so that
+    StreamPackReader still reads it) followed by a table of contents and a
+    footer. TOC: number of entries, then (offset, size, crc32, name length,
+    utf-8 name) per input stream. Footer: TOC offset, TOC size, magic.
+    Members are read back with IndexedStreamPackReader."""
+
+    def __init__(self, dest, buffer_size=BUFFER_SIZE):
+        super(IndexedStreamPackWriter, self).__init__(dest, buffer_size, use_sendfile=False)
+        self.names = []
+        self.entries = []
+        self._position = 0
+        self._crc = None
+
+    def add_input(self, stream: io.BufferedReader, name: str = None):
+        super(IndexedStreamPackWriter, self).add_input(stream)
+        self.names.append(str(len(self.names)) if name is None else name)
+
+    def transmit(self):
+        super(IndexedStreamPackWriter, self).transmit()
+        toc = bytearray(SIZE.pack(len(self.entries)))
+        for entry in self.entries:
+            name = entry.name.encode()
+            toc += TOC_ENTRY.pack(entry.offset, entry.size, entry.crc32, len(name)) + name
+        toc_offset = self._position
+        self._write(toc)
+        self._write(FOOTER.pack(toc_offset, len(toc), INDEXED_MAGIC))
+
+    def _write(self, data):
+        super(IndexedStreamPackWriter, self)._write(data)
+        self._position += len(data)
+        if self._crc is not None:
+            self._crc = zlib.crc32(data, self._crc)
+
+    def _transmit_data(self, stream, size):
+        offset = self._position
+        self._crc = 0
+        super(IndexedStreamPackWriter, self)._transmit_data(stream, size)
+        self.entries.append(PackEntry(self.names[len(self.entries)], offset, size, self._crc))
+        self._crc = None
+
+class IndexedStreamPackReader:
+    """Random access to a stream pack v2 file through mmap.
+    member() returns zero-copy memoryview slices, each member's checksum is
+    verified on its first access (verify=False skips that). Views should be
+    released before close()."""
+
+    def __init__(self, path: str, verify=True):
+        self.path = path
+        self.verify = verify
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:  # empty file
+            self._file.close()
+            raise ValueError(f"Not an indexed stream pack: {path}") from e
+        self._view = memoryview(self._mmap)
+        try:
+            self.entries = self._read_toc()
+        except (ValueError, struct.error):
+            self.close()
+            raise
+        self._index = {entry.name: idx for idx, entry in enumerate(self.entries)}
+        self._verified = set()
+
+    def _read_toc(self) -> List[PackEntry]:
+        if len(self._view) < FOOTER.size:
+            raise ValueError(f"Not an indexed stream pack: {self.path}")
+        toc_offset, toc_size, magic = FOOTER.unpack(self._view[-FOOTER.size:])
+        if magic != INDEXED_MAGIC or toc_offset + toc_size + FOOTER.size != len(self._view):
+            raise ValueError(f"Not an indexed stream pack: {self.path}")
+        toc = self._view[toc_offset:toc_offset + toc_size]
+        try:
+            count = SIZE.unpack(toc[:SIZE.size])[0]
+            pos = SIZE.size
+            entries = []
+            for _ in range(count):
+                offset, size, crc32, name_size = TOC_ENTRY.unpack(toc[pos:pos + TOC_ENTRY.size])
+                pos += TOC_ENTRY.size
+                name = bytes(toc[pos:pos + name_size]).decode()
+                pos += name_size
+                if offset + size > toc_offset:
+                    raise ValueError(f"Member out of bounds: {name}")
+                entries.append(PackEntry(name, offset, size, crc32))
+            return entries
+        finally:
+            toc.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self) -> List[str]:
+        return [entry.name for entry in self.entries]
+
+    def entry(self, key) -> PackEntry:
+        """key: member name or index"""
+        return self.entries[self._index[key] if isinstance(key, str) else key]
+
+    def member(self, key) -> memoryview:
+        idx = self._index[key] if isinstance(key, str) else key
+        entry = self.entries[idx]
+        view = self._view[entry.offset:entry.offset + entry.size]
+        if self.verify and idx not in self._verified:
+            if zlib.crc32(view) != entry.crc32:
+                view.release()
+                raise ChecksumError(f"Checksum mismatch: {entry.name} in {self.path}")
+            self._verified.add(idx)
+        return view
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def write_indexed_pack(dest_path: str, paths: List[str], root: str = None):
+    """Archives files into one pack v2, members are named by path relative
+    to root (or as given)"""
+    with open(dest_path, "wb") as dest, ExitStack() as stack:
+        writer = IndexedStreamPackWriter(dest)
+        for path in paths:
+            name = os.path.relpath(path, root) if root else path
+            writer.add_input(stack.enter_context(open(path, "rb")), name)
+        writer.transmit()
+    return writer.entries
 
 if __name__ == "__main__":
+    import shutil
+    import sys
+    import tempfile
+    import time
+
     lines = ["qwerty", "1337"]
     inputs = [io.BytesIO(ln.encode()) for ln in lines]
-    
+
     dest = io.BytesIO()
     pack_writer = StreamPackWriter(dest)
     for istream in inputs:
         pack_writer.add_input(istream)
     pack_writer.transmit()
     dest.seek(0)
-    
+
     pack_reader = StreamPackReader(dest)
     outputs = [io.BytesIO() for i in range(pack_reader.stream_count)]
     print(f"Outputs: {outputs}")
     pack_reader.receive(outputs)
     for idx, stream in enumerate(outputs):
         print(f"Stream {idx}: {stream.getvalue()}")
+
+    # v2: pull the last chunk out of a card-sized pack
+    count, chunk_size = 32, int(sys.argv[1]) if len(sys.argv) > 1 else 32 << 20
+    workdir = tempfile.mkdtemp(prefix="packed_stream_")
+    try:
+        paths = []
+        for idx in range(count):
+            paths.append(os.path.join(workdir, f"{idx:05}.MTS"))
+            with open(paths[-1], "wb") as chunk_file:
+                chunk_file.write(os.urandom(chunk_size))
+        pack_path = os.path.join(workdir, "card.spack")
+        write_indexed_pack(pack_path, paths, workdir)
+
+        began = time.perf_counter()
+        with open(pack_path, "rb") as pack_file:
+            pack_reader = StreamPackReader(pack_file)
+            outputs = [io.BytesIO() for i in range(pack_reader.stream_count)]
+            pack_reader.receive(outputs)
+            sequential = outputs[-1].getvalue()
+        sequential_time = time.perf_counter() - began
+
+        began = time.perf_counter()
+        with IndexedStreamPackReader(pack_path) as indexed_reader:
+            member = indexed_reader.member(f"{count - 1:05}.MTS")
+            indexed = bytes(member)
+            member.release()
+        indexed_time = time.perf_counter() - began
+        print(f"last of {count} x {chunk_size >> 20} MiB: sequential {sequential_time * 1000:.1f} ms,"
+              f" indexed (crc32 verified) {indexed_time * 1000:.1f} ms, same: {sequential == indexed}")
+    finally:
+        shutil.rmtree(workdir)
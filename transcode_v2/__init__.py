@@ -1,16 +1,81 @@
+import functools
 import json
 import logging
 import os
+import re
+import shutil
 import subprocess
 import sys
-from typing import Dict, List, Tuple
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from concat_ng.probe import ffprobe_format_info
 from config import Config
 from transcode_v2.protocols import apply_protocol
 
 class TranscodeError(Exception):
     pass
 
+Cost = namedtuple("Cost", ["cpu", "io"])
+Cost.__doc__ = """Declared resource weight of a profile, as a fraction of one machine"""
+DEFAULT_COST = Cost(cpu=1.0, io=1.0)
+FRAGMENTED_MP4_OPTIONS = ["-movflags", "frag_keyframe+empty_moov+default_base_moof"]
+# Sink extension -> muxer options under which written bytes are never
+# rewritten; the mp3 muxer otherwise seeks back to fill in its Xing header
+APPEND_ONLY_OPTIONS = {".mp4": FRAGMENTED_MP4_OPTIONS, ".mp3": ["-write_xing", "0"], ".aac": []}
+PROGRESS_OPTIONS = ["-progress", "pipe:1", "-nostats"]
+PROFILE_SEPARATOR = "+"
+FILTER_LABEL = re.compile(r"\[([^\]]+)\]")
+STREAM_SPECIFIER = re.compile(r"^\d+(:|$)")
+
+Progress = namedtuple("Progress", ["out_time", "fps", "speed", "finished"])
+Progress.__doc__ = """One ffmpeg -progress report: out_time in seconds of output written,
+speed as a multiple of realtime; fps/speed are None while ffmpeg reports N/A"""
+
+def _parse_number(value, suffix=""):
+    try:
+        return float(value[:-len(suffix)] if suffix and value.endswith(suffix) else value)
+    except ValueError:
+        return None
+
+def read_progress(stream, on_progress: Callable[[Progress], None]):
+    """Reads `-progress` key=value blocks until EOF, calls on_progress once per block"""
+    block = {}
+    for line in stream:
+        key, _, value = line.decode(errors="replace").strip().partition("=")
+        if key != "progress":
+            block[key] = value
+            continue
+        out_time = _parse_number(block.get("out_time_us", "N/A"))
+        on_progress(Progress(
+            out_time=(out_time or 0.0) / 1e6,
+            fps=_parse_number(block.get("fps", "N/A")),
+            speed=_parse_number(block.get("speed", "N/A"), "x"),
+            finished=value == "end"
+        ))
+        block = {}
+
+def run_ffmpeg(cmdline, stderr=None, on_progress: Callable = None, on_start: Callable = None) -> int:
+    """on_progress: see read_progress, adds PROGRESS_OPTIONS to cmdline"""
+    if on_progress:
+        cmdline = cmdline[:1] + PROGRESS_OPTIONS + cmdline[1:]
+    stdout = subprocess.PIPE if on_progress else None
+    with subprocess.Popen(cmdline, stdout=stdout, stderr=stderr) as process:
+        if on_start:
+            on_start()
+        if on_progress:
+            try:
+                read_progress(process.stdout, on_progress)
+            except Exception as e:  # keep the encode running
+                logging.exception(e)
+                process.stdout.read()  # drain, or a full pipe stalls ffmpeg
+        return process.wait()
+
 def get_preset(profile) -> Dict:
+    """profile: a preset name, or several joined with "+" (see merge_presets)"""
+    if PROFILE_SEPARATOR in profile:
+        return merge_presets(profile.split(PROFILE_SEPARATOR))
     preset_path = os.path.join(Config.ff_preset_dir, f"{profile}.json")
     try:
         with open(preset_path, "r") as preset_file:
@@ -18,7 +83,110 @@ def get_preset(profile) -> Dict:
     except FileNotFoundError as e:
         raise TranscodeError(f"Bad profile: {profile}") from e
 
-def make_cmdline(inputs, output, profile_name) -> Tuple[List[str], List[str]]:
+@functools.lru_cache(maxsize=None)
+def _filter_input_types() -> Dict[str, str]:
+    """Filter name -> media type of its first input pad ("a" or "v"), per `ffmpeg -filters`"""
+    try:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-filters"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning("Cannot list ffmpeg filters: %s", e)
+        return {}
+    types = {}
+    for line in result.stdout.decode(errors="replace").splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and "->" in fields[2] and fields[2][0] in "AV":
+            types[fields[1]] = fields[2][0].lower()
+    return types
+
+def label_inputs(filtergraph) -> str:
+    """Gives unlabeled chain inputs the stream ffmpeg would bind them to:
+    the first unused stream of the filter's media type in the first input.
+    Filters unknown to ffmpeg -filters are taken by name: audio ones start with "a"."""
+    used = {}
+    chains = []
+    for chain in filtergraph.split(";"):
+        body = chain.strip()
+        if body and not body.startswith("["):
+            name = re.split(r"[=\[,\s@]", body, maxsplit=1)[0]
+            media = _filter_input_types().get(name) or ("a" if name.startswith(("a", "channel")) else "v")
+            body = f"[0:{media}:{used.get(media, 0)}]{body}"
+            used[media] = used.get(media, 0) + 1
+        chains.append(body)
+    return "; ".join(chains)
+
+def merge_presets(profile_names: List[str]) -> Dict:
+    """One ffmpeg run for several profiles: inputs are read and decoded once,
+    every profile's sinks come from it. Unlabeled filtergraph inputs get
+    explicit stream labels (see label_inputs), so several graphs can read
+    the same stream, then labels of the n-th profile get a "p<n>_" prefix.
+    A suffix already taken by an earlier profile gets "_<profile name>" in
+    front. Profiles must declare the same inputs.
+    Cost: CPU costs add up, IO is shared"""
+    presets = [get_preset(name) for name in profile_names]
+    inputs = presets[0]["inputs"]
+    filtergraphs, outputs, suffixes = [], [], set()
+    for idx, (name, preset) in enumerate(zip(profile_names, presets)):
+        if preset["inputs"] != inputs:
+            raise TranscodeError(f"Cannot merge profiles with different inputs: {profile_names}")
+
+        def namespace(match):
+            if STREAM_SPECIFIER.match(match.group(1)):
+                return match.group(0)
+            return f"[p{idx}_{match.group(1)}]"
+
+        if preset.get("filtergraph"):
+            filtergraphs.append(FILTER_LABEL.sub(namespace, label_inputs(preset["filtergraph"])))
+        for options in preset["outputs"]:
+            options = dict(options, input_nodes=[FILTER_LABEL.sub(namespace, node) for node in options["input_nodes"]])
+            if options["suffix"] in suffixes:
+                options["suffix"] = f"_{name}{options['suffix']}"
+            suffixes.add(options["suffix"])
+            outputs.append(options)
+    costs = [get_cost(name) for name in profile_names]
+    return {
+        "inputs": inputs,
+        "outputs": outputs,
+        "filtergraph": "; ".join(filtergraphs) or None,
+        "cost": {"cpu": sum(cost.cpu for cost in costs), "io": max(cost.io for cost in costs)}
+    }
+
+def get_cost(profile_name) -> Cost:
+    """Profiles without "cost" are assumed to occupy the whole machine"""
+    cost = get_preset(profile_name).get("cost")
+    if not cost:
+        return DEFAULT_COST
+    return Cost(float(cost.get("cpu", DEFAULT_COST.cpu)), float(cost.get("io", DEFAULT_COST.io)))
+
+def select_profile(profile_name, stream_info: Dict) -> Tuple[str, str]:
+    """Applies the preset's "remux_rule": its "profile" runs instead if the
+    source (see concat_ng.probe.ffprobe_stream_info) meets every limit.
+    Return value: (profile to run, reason)"""
+    rule = get_preset(profile_name).get("remux_rule")
+    if not rule:
+        return profile_name, "no remux rule"
+    codec = stream_info.get("video_codec")
+    limits = [("video_bit_rate", "max_video_bit_rate"), ("width", "max_width"), ("height", "max_height")]
+    if codec not in rule.get("video_codecs", []):
+        return profile_name, f"video codec {codec} not in {rule.get('video_codecs', [])}"
+    for key, limit_key in limits:
+        value, limit = stream_info.get(key), rule.get(limit_key)
+        if limit is None:
+            continue
+        if value is None:
+            return profile_name, f"{key} unknown"
+        if value > limit:
+            return profile_name, f"{key} {value} > {limit}"
+    return rule["profile"], "{} {}x{} at {} b/s meets the remux rule".format(
+        codec, stream_info.get("width"), stream_info.get("height"), stream_info.get("video_bit_rate"))
+
+def is_append_only(sink) -> bool:
+    """Whether a sink written with fragmented=True can be uploaded while growing"""
+    return os.path.splitext(sink)[1] in APPEND_ONLY_OPTIONS
+
+def make_cmdline(inputs, output, profile_name, fragmented=False) -> Tuple[List[str], List[str]]:
+    """fragmented: write sinks so that every byte is final once written
+    (see APPEND_ONLY_OPTIONS and upload-while-encoding)"""
     profile = get_preset(profile_name)
     
     cmdline = ["ffmpeg"]
@@ -39,15 +207,127 @@ def make_cmdline(inputs, output, profile_name) -> Tuple[List[str], List[str]]:
         for input_node in options["input_nodes"]:
             cmdline.extend(["-map", input_node])
         cmdline.extend(options["codec_options"])
+        if fragmented:
+            cmdline.extend(APPEND_ONLY_OPTIONS.get(os.path.splitext(sink)[1], []))
         cmdline.append(sink)
     
     return cmdline, sinks
 
-def transcode(profile, inputs, output, stderr=None) -> Tuple[int, List[str]]:
-    cmdline, sinks = make_cmdline(inputs, output, profile)
+def can_segment(profile) -> bool:
+    """Whether transcode_segmented splits the profile's input"""
+    return len(get_preset(profile)["inputs"]) == 1
+
+def transcode(profile, inputs, output, stderr=None, segments=1, workers=None,
+              fragmented=False, on_start: Callable = None,
+              on_progress: Callable[[Progress], None] = None) -> Tuple[int, List[str]]:
+    """segments, workers: see transcode_segmented. fragmented: see make_cmdline. on_start(sinks) is called once ffmpeg
+    is running. on_progress(Progress) is called from this thread on every
+    ffmpeg -progress report (each 0.5 s by default). Segmenting is not combined
+    with fragmented output, since joined sinks appear only at the very end."""
+    if segments > 1 and fragmented:
+        logging.warning("Fragmented output requested, not segmenting %s", output)
+    elif segments > 1:
+        return transcode_segmented(profile, inputs, output, segments, stderr=stderr, workers=workers,
+                                   on_progress=on_progress)
+    cmdline, sinks = make_cmdline(inputs, output, profile, fragmented)
     logging.info("cmdline = %s", cmdline)
-    result = subprocess.run(cmdline, stderr=stderr)
-    return result.returncode, sinks
+    returncode = run_ffmpeg(cmdline, stderr, on_progress,
+                            on_start=(lambda: on_start(sinks)) if on_start else None)
+    return returncode, sinks
+
+def transcode_segmented(profile, inputs, output, segments, stderr=None, workers=None,
+                        on_progress: Callable[[Progress], None] = None) -> Tuple[int, List[str]]:
+    """Split/encode/join. The input is cut with stream copy into `segments`
+    parts (the segment muxer cuts at keyframes), parts are encoded by up to
+    `workers` concurrent ffmpeg processes, then every profile output is joined
+    with the concat demuxer. Sinks are the same as transcode() would produce.
+    Only single-input profiles are split (see can_segment), others fall back
+    to transcode(). The parts are removed whether the job succeeds or not.
+    on_progress reports the encode stage: out_time and speed summed over parts."""
+    if not can_segment(profile):
+        logging.warning("Profile %s has several inputs, not segmenting", profile)
+        return transcode(profile, inputs, output, stderr=stderr, on_progress=on_progress)
+
+    workdir = f"{output}.segments"
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        return _transcode_parts(profile, inputs, output, segments, workdir, stderr, workers, on_progress)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def _transcode_parts(profile, inputs, output, segments, workdir, stderr, workers,
+                     on_progress) -> Tuple[int, List[str]]:
+    input_options = get_preset(profile)["inputs"][0]
+    source = inputs[0]
+    if "proto" in input_options:
+        source = apply_protocol(input_options["proto"], source)
+
+    duration = float(ffprobe_format_info(source)["duration"])
+    split_times = [duration * idx / segments for idx in range(1, segments)]
+
+    split_cmdline = ["ffmpeg"]
+    split_cmdline.extend(Config.ff_general_options)
+    split_cmdline.extend([
+        "-i", source, "-map", "0", "-c", "copy",
+        "-f", "segment", "-reset_timestamps", "1",
+        "-segment_times", ",".join(f"{t:.3f}" for t in split_times),
+        os.path.join(workdir, "part_%03d.ts")
+    ])
+    logging.info("split cmdline = %s", split_cmdline)
+    result = subprocess.run(split_cmdline, stderr=stderr)
+    if result.returncode != 0:
+        return result.returncode, []
+
+    parts = sorted(name for name in os.listdir(workdir) if name.endswith(".ts"))
+    encodes = []
+    for part in parts:
+        part_input = os.path.join(workdir, part)
+        part_inputs = [[part_input]] if "proto" in input_options else [part_input]
+        encodes.append(make_cmdline(part_inputs, os.path.join(workdir, part[:-len(".ts")]), profile))
+
+    part_progress = [Progress(0.0, None, None, False)] * len(encodes)
+    progress_lock = threading.Lock()
+
+    def report_part(idx, progress):
+        with progress_lock:
+            part_progress[idx] = progress
+            speeds = [part.speed for part in part_progress if part.speed is not None and not part.finished]
+            on_progress(Progress(
+                out_time=sum(part.out_time for part in part_progress),
+                fps=sum(part.fps or 0.0 for part in part_progress if not part.finished),
+                speed=sum(speeds) if speeds else None,
+                finished=all(part.finished for part in part_progress)
+            ))
+
+    def run_encode(idx):
+        cmdline, part_sinks = encodes[idx]
+        logging.info("segment cmdline = %s", cmdline)
+        part_on_progress = (lambda progress: report_part(idx, progress)) if on_progress else None
+        return run_ffmpeg(cmdline, stderr, part_on_progress)
+
+    with ThreadPoolExecutor(max_workers=workers or len(encodes)) as pool:
+        exitcodes = list(pool.map(run_encode, range(len(encodes))))
+    failed = [code for code in exitcodes if code != 0]
+    if failed:
+        return failed[0], []
+
+    _, sinks = make_cmdline(inputs, output, profile)
+    for sink_idx, sink in enumerate(sinks):
+        list_path = os.path.join(workdir, f"join_{sink_idx}.txt")
+        with open(list_path, "w") as list_file:
+            for _, part_sinks in encodes:
+                escaped = os.path.abspath(part_sinks[sink_idx]).replace("'", "'\\''")
+                list_file.write(f"file '{escaped}'\n")
+        join_cmdline = ["ffmpeg"]
+        join_cmdline.extend(Config.ff_general_options)
+        join_cmdline.extend(["-f", "concat", "-safe", "0", "-i", list_path,
+                             "-map", "0", "-c", "copy", sink])
+        logging.info("join cmdline = %s", join_cmdline)
+        result = subprocess.run(join_cmdline, stderr=stderr)
+        if result.returncode != 0:
+            return result.returncode, sinks
+
+    return 0, sinks
 
 def validate_args(inputs, output, profile_name):
     profile = get_preset(profile_name)
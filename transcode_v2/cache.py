@@ -0,0 +1,192 @@
+"""Content-addressed cache of transcode outputs.
+
+A key is the resolved make_cmdline argument vector, with every input path
+replaced by a fingerprint of the file's content and the output by a
+placeholder, plus the ffmpeg version. Sinks of a successful transcode are
+stored under root/<key>/ and linked into the requested output on a hit:
+hardlink, else reflink (FICLONE), else copy. Entries are evicted least
+recently used first once their total size exceeds max_bytes.
+"""
+
+import errno
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from concat_ng.catalog import fingerprint
+from transcode_v2 import make_cmdline, transcode
+
+FICLONE = 0x40049409
+FINGERPRINT_SAMPLES = 16
+OUTPUT_PLACEHOLDER = "{output}"
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_version() -> str:
+    try:
+        result = subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning("Cannot get ffmpeg version: %s", e)
+        return ""
+    return result.stdout.decode(errors="replace").partition("\n")[0]
+
+def _reflink(src_path, dst_path):
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def place_file(src_path, dst_path) -> str:
+    """Hardlink, else reflink, else copy. Return value: method used"""
+    try:
+        os.link(src_path, dst_path)
+        return "link"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+            raise
+    try:
+        _reflink(src_path, dst_path)
+        return "reflink"
+    except OSError:
+        pass
+    shutil.copyfile(src_path, dst_path)
+    return "copy"
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+class OutputCache:
+    """Thread-safe. Survives restarts: entries are found by scanning root"""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (suffixes, size), least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for name in os.listdir(self.root):
+            entry_dir = os.path.join(self.root, name)
+            if name.startswith(".tmp-"):  # interrupted store()
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            try:
+                with open(os.path.join(entry_dir, "meta.json"), "r") as meta_file:
+                    meta = json.load(meta_file)
+                found.append((os.path.getmtime(os.path.join(entry_dir, "meta.json")), name, meta))
+            except (OSError, ValueError):
+                logging.warning("Output cache: removing incomplete entry %s", entry_dir)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+        for _, key, meta in sorted(found):
+            self._entries[key] = (meta["suffixes"], meta["size"])
+            self._size += meta["size"]
+        self._evict()
+
+    def key(self, profile, inputs, fragmented=False) -> Optional[str]:
+        """None if an input cannot be fingerprinted"""
+        def substitute(source):
+            if isinstance(source, list):
+                return [substitute(path) for path in source]
+            return "fingerprint:" + fingerprint(source, samples=FINGERPRINT_SAMPLES, mtime=False)
+        try:
+            cmdline, _ = make_cmdline(substitute(inputs), OUTPUT_PLACEHOLDER, profile, fragmented)
+        except OSError as e:
+            logging.warning("Output cache: cannot fingerprint inputs: %s", e)
+            return None
+        payload = json.dumps([cmdline, ffmpeg_version()])
+        return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+    def _sink_path(self, key, suffix):
+        return os.path.join(self.root, key, "sink" + suffix)
+
+    def materialize(self, key, output) -> Optional[List[str]]:
+        """Links cached sinks into output + suffix. None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        sinks, methods = [], set()
+        if entry is not None:
+            try:
+                for suffix in entry[0]:
+                    sink = output + suffix
+                    _unlink(sink)
+                    methods.add(place_file(self._sink_path(key, suffix), sink))
+                    sinks.append(sink)
+                os.utime(os.path.join(self.root, key, "meta.json"))
+            except OSError as e:  # evicted meanwhile
+                logging.warning("Output cache: cannot materialize %s: %s", key, e)
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is None:
+            return None
+        logging.info("Output cache hit (%s): %s", ",".join(sorted(methods)), output)
+        return sinks
+
+    def store(self, key, output, sinks: List[str]):
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        try:
+            suffixes = [sink[len(output):] for sink in sinks]
+            for sink, suffix in zip(sinks, suffixes):
+                place_file(sink, os.path.join(tmp_dir, "sink" + suffix))
+            size = sum(os.path.getsize(sink) for sink in sinks)
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as meta_file:
+                json.dump({"suffixes": suffixes, "size": size}, meta_file)
+            os.rename(tmp_dir, os.path.join(self.root, key))
+        except OSError as e:  # also stored concurrently
+            logging.warning("Output cache: cannot store %s: %s", output, e)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with self._lock:
+            self._entries[key] = (suffixes, size)
+            self._size += size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self._size}
+
+    def transcode(self, profile, inputs, output, fragmented=False, **kwargs) -> Tuple[int, List[str], bool]:
+        """Drop-in for transcode_v2.transcode, also returns whether the
+        outputs came from the cache (on_start and on_progress are not
+        called then)"""
+        key = self.key(profile, inputs, fragmented)
+        if key is not None:
+            sinks = self.materialize(key, output)
+            if sinks is not None:
+                return 0, sinks, True
+        for sink in make_cmdline(inputs, output, profile, fragmented)[1]:
+            _unlink(sink)  # may be linked to an entry, ffmpeg would overwrite it in place
+        exitcode, sinks = transcode(profile, inputs, output, fragmented=fragmented, **kwargs)
+        if exitcode == 0 and key is not None:
+            self.store(key, output, sinks)
+        return exitcode, sinks, False